@@ -4,61 +4,751 @@ import argparse
 import sys
 import os
 
-from data_allocator.allocator import Allocator
-from data_allocator.storage_manager import StorageManager
-from data_allocator.tree_visualizer import TreeVisualizer
+# Package modules are imported inside each command so that a command
+# only pays for the imports it uses. `get` is run from many job
+# scripts, and the interpreter start-up dominates its run time.
 
 CONFIG_PATH=os.path.join(os.environ.get("HOME"), ".YuLabDataAllocator", "config.json")
 DB_PATH=os.path.join(os.environ.get("HOME"), ".YuLabDataAllocator", "YuLabDataAllocator.db")
+SOCKET_PATH=os.path.join(os.environ.get("HOME"), ".YuLabDataAllocator", "daemon.sock")
+SNAPSHOT_PATH=os.path.join(os.environ.get("HOME"), ".YuLabDataAllocator", "branches.snapshot")
 
-def allocate_branch(branch_name):
+# Set to False by --no-daemon
+USE_DAEMON = True
+
+def call_daemon(command, **args):
     """
-    Allocate a new branch.
+    Run a command in the allocator daemon if one is running.
+
+    Returns:
+    - (True, result), or (False, None) if the command is to be run in-process.
+      A read that a wedged daemon does not answer in time is run in-process.
+    """
+    if not USE_DAEMON:
+        return False, None
+
+    from data_allocator.client import DaemonClient
+    from data_allocator.exceptions import DaemonTimeoutException
+
+    client = DaemonClient.connect(SOCKET_PATH)
+    if client is None:
+        return False, None
+    with client:
+        try:
+            return True, client.call(command, **args)
+        except DaemonTimeoutException:
+            # allocate and delete may still be carried out by the daemon
+            if command not in ("get", "ls"):
+                raise
+            return False, None
+
+def open_storage():
+    """
+    Open the database without an Allocator, in the journal mode set in the config.
     """
-    allocator = Allocator(config_path=CONFIG_PATH, 
-                          db_path=DB_PATH, 
+    from data_allocator.constants import JOURNAL_MODE
+    from data_allocator.config_handler import ConfigHandler
+    from data_allocator.storage_manager import StorageManager
+
+    config = ConfigHandler(config_path=CONFIG_PATH)
+    return StorageManager(db_path=DB_PATH, 
+                          journal_mode=config.get_option("journal_mode", JOURNAL_MODE), 
                           )
 
-    try:
-        path = allocator.allocate(branch_name)
+def allocate_branch(branch_name, expected_size=None):
+    """
+    Allocate a new branch.
+    """
+    served, path = call_daemon("allocate", branch_name=branch_name, expected_size=expected_size)
+    if served:
+        sys.stdout.write(path + "\n")
+        return
+
+    from data_allocator.allocator import Allocator
+
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        size = Allocator.parse_size(expected_size) if expected_size else None
+        path = allocator.allocate(branch_name, expected_size=size)
         sys.stdout.write(path + "\n")
-    except Exception as e:
-        raise e
+
+def read_branch_names(file_path, batch_size):
+    """
+    Yield lists of branch names read from a file, one name per line.
+    A file path of "-" reads from stdin. Blank lines are skipped.
+    """
+    stream = sys.stdin if file_path == "-" else open(file_path, "r")
+    try:
+        batch = []
+        for line in stream:
+            branch_name = line.strip()
+            if not branch_name:
+                continue
+            batch.append(branch_name)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+def allocate_branches_from_file(file_path, batch_size, expected_size=None):
+    """
+    Allocate every branch listed in a file, writing each path
+    as soon as its batch is recorded.
+    """
+    from data_allocator.allocator import Allocator
+
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        size = Allocator.parse_size(expected_size) if expected_size else None
+        for batch in read_branch_names(file_path, batch_size):
+            for path in allocator.allocate_many(batch, expected_size=size):
+                sys.stdout.write(path + "\n")
+            sys.stdout.flush()
 
 def get_branch_path(branch_name):
     """
     Get the full path of an existing branch.
     """
-    allocator = Allocator(config_path=CONFIG_PATH, 
-                          db_path=DB_PATH, 
-                          )
-    try:
+    served, path = call_daemon("get", branch_name=branch_name)
+    if served:
+        sys.stdout.write(path + "\n")
+        return
+
+    # a fresh snapshot answers without opening the database
+    from data_allocator.snapshot import BranchSnapshot
+
+    snapshot = BranchSnapshot.open(SNAPSHOT_PATH)
+    if snapshot is not None:
+        with snapshot:
+            drive = snapshot.get_drive(branch_name) if snapshot.is_fresh(DB_PATH) else None
+        if drive is not None:
+            from data_allocator.config_handler import ConfigHandler
+
+            drive_paths = ConfigHandler(config_path=CONFIG_PATH).get_drive_paths()
+            if drive in drive_paths:
+                sys.stdout.write(os.path.join(drive_paths[drive], branch_name) + "\n")
+                return
+
+    from data_allocator.allocator import Allocator
+
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
         path = allocator.get_path(branch_name)
         sys.stdout.write(path + "\n")
-    except Exception as e:
-        raise e
 
-def delete_branch(branch_name):
+def get_branch_paths(file_path, batch_size):
+    """
+    Get the paths of the branches listed in a file, one per line, in the
+    same order. A branch that is not recorded gets an empty line, and an
+    error on stderr. Exits with status 1 if any branch was not found.
+    """
+    from data_allocator.allocator import Allocator
+
+    missing = 0
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   snapshot_path=SNAPSHOT_PATH, 
+                   ) as allocator:
+        for batch in read_branch_names(file_path, batch_size):
+            for branch_name, path in zip(batch, allocator.get_paths(batch)):
+                if path is None:
+                    missing += 1
+                    sys.stderr.write(f"[ERROR] No location found for '{branch_name}'\n")
+                    path = ""
+                sys.stdout.write(path + "\n")
+            sys.stdout.flush()
+
+    if missing:
+        sys.exit(1)
+
+def which_branches(paths, file_path, batch_size):
+    """
+    Write the branch and drive owning each path as "path<TAB>branch<TAB>drive",
+    in the same order. A path in no branch gets empty fields, and an error on
+    stderr. Exits with status 1 if any path was not resolved.
+    """
+    from data_allocator.allocator import Allocator
+
+    batches = read_branch_names(file_path, batch_size) if file_path else [paths]
+    unresolved = 0
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        for batch in batches:
+            for path, (branch_name, drive) in zip(batch, allocator.resolve_paths(batch)):
+                if drive is None:
+                    unresolved += 1
+                    sys.stderr.write(f"[ERROR] Path '{path}' is not in any of the configured drives.\n")
+                elif branch_name is None:
+                    unresolved += 1
+                    sys.stderr.write(f"[ERROR] Path '{path}' is not in any branch.\n")
+                sys.stdout.write("{}\t{}\t{}\n".format(path, branch_name or "", drive or ""))
+            sys.stdout.flush()
+
+    if unresolved:
+        sys.exit(1)
+
+def delete_branch(branch_name, defer=False):
     """
     Delete a branch and its record.
     """
-    allocator = Allocator(config_path=CONFIG_PATH, 
-                          db_path=DB_PATH, 
-                          )
+    served, _ = call_daemon("delete", branch_name=branch_name, defer=defer)
+    if served:
+        return
+
+    from data_allocator.allocator import Allocator
+
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        allocator.delete_branch(branch_name, defer=defer)
+
+def delete_subtree(args):
+    """
+    Delete a branch and every branch below it. With --dry-run, only
+    print the branches that would be deleted, with their paths.
+    """
+    from data_allocator.allocator import Allocator
+    from data_allocator.tree_visualizer import TreeVisualizer
+    from data_allocator.exceptions import AllocatorException
+
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        if args.dry_run:
+            locations = allocator.get_subtree_locations(args.branch_name)
+            if not locations:
+                raise AllocatorException(f"[ERROR] No location found for '{args.branch_name}'")
+
+            drive_paths = allocator.config.get_drive_paths()
+            annotations = {branch_path: os.path.join(drive_paths[drive], branch_path)
+                           for branch_path, drive in locations.items()}
+            tree = TreeVisualizer(storage_manager=allocator.storage).build_tree(root_branch=args.branch_name)
+            sys.stdout.write(TreeVisualizer.tree2str(tree, annotations=annotations))
+            sys.stdout.write("Would delete {} branches\n".format(len(locations)))
+            return
+
+        allocator.delete_branch(args.branch_name, 
+                                defer=args.defer, 
+                                recursive=True, 
+                                workers=args.workers, 
+                                )
+
+def reap_trash(args):
+    """
+    Empty the trash filled by `delete --defer`, once or every --watch seconds.
+    """
+    import time
+
+    from data_allocator.allocator import Allocator
+    from data_allocator.reaper import Reaper
+
+    def report(result):
+        sys.stderr.write("\rremoved {} files, {} directories in {:.0f} s".format(result.files_removed, 
+                                                                                  result.dirs_removed, 
+                                                                                  result.elapsed, 
+                                                                                  ))
+        sys.stderr.flush()
+
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        trash_paths = allocator.get_trash_paths().values()
+
+    reaper = Reaper(trash_paths, 
+                    workers=args.workers, 
+                    rate=args.rate, 
+                    progress=None if args.quiet else report, 
+                    )
+    while True:
+        result = reaper.reap(min_age=args.min_age)
+        if not args.quiet:
+            sys.stderr.write("\n")
+        sys.stdout.write("Removed {} trash entries ({} files, {} directories, {} errors)\n".format(result.entries_removed, 
+                                                                                                  result.files_removed, 
+                                                                                                  result.dirs_removed, 
+                                                                                                  result.error_count, 
+                                                                                                  ))
+        sys.stdout.flush()
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
+
+def import_branches(args):
+    """
+    Record existing directories as branches, found by scanning the drives
+    or listed in a manifest. Conflicts are written to stdout, one per line.
+    Exits with status 1 if there were conflicts.
+    """
+    from data_allocator.allocator import Allocator
+    from data_allocator.import_export import Importer, scan_drives, read_manifest, detect_format
+
+    def report(branch_path, drive_name, reason):
+        sys.stdout.write("conflict\t{}\t{}\t{}\n".format(branch_path, drive_name, reason))
+
+    # directories found on several drives, rejected before the import
+    scan_conflicts = 0
+
+    def report_scan(branch_path, drive_name, reason):
+        nonlocal scan_conflicts
+        scan_conflicts += 1
+        report(branch_path, drive_name, reason)
+
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        errors = []
+        if args.manifest is not None:
+            stream = sys.stdin if args.manifest == "-" else open(args.manifest, "r", newline="")
+            locations = read_manifest(stream, fmt=detect_format(args.manifest, args.format))
+        else:
+            stream = None
+            locations = scan_drives(allocator.config.get_drive_paths(), 
+                                    args.depth, 
+                                    report_scan, 
+                                    errors=errors, 
+                                    storage=allocator.storage, 
+                                    )
+
+        importer = Importer(allocator, 
+                            chunk_size=args.chunk_size, 
+                            verify=args.manifest is not None, 
+                            dry_run=args.dry_run, 
+                            nested=args.manifest is not None, 
+                            )
+        try:
+            result = importer.import_locations(locations, report)
+        finally:
+            if stream is not None and stream is not sys.stdin:
+                stream.close()
+
+    for drive, rel_path, message in errors:
+        sys.stderr.write("[ERROR] Unable to list '{}' on {}: {}\n".format(rel_path, drive, message))
+    sys.stderr.write("{} {} branches, {} already recorded, {} conflicts\n".format("Would import" if args.dry_run else "Imported", 
+                                                                              result.imported, 
+                                                                              result.existing, 
+                                                                              result.conflicts + scan_conflicts, 
+                                                                              ))
+    if result.conflicts or scan_conflicts:
+        sys.exit(1)
+
+def export_branches(args):
+    """
+    Write every branch record as JSONL or CSV.
+    """
+    from data_allocator.import_export import write_export, detect_format
+
+    fmt = detect_format(args.output, args.format)
+    stream = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
     try:
-        allocator.delete_branch(branch_name)
-    except Exception as e:
-        raise e
+        with open_storage() as storage:
+            count = write_export(storage, stream, fmt=fmt)
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+    sys.stderr.write("Exported {} branches\n".format(count))
+
+def write_branch_snapshot(args):
+    """
+    Write the snapshot of the records that `get` reads. With --watch,
+    keep rewriting it whenever the database has changed.
+    """
+    import time
+
+    from data_allocator.snapshot import BranchSnapshot, write_snapshot
+
+    with open_storage() as storage:
+        while True:
+            snapshot = BranchSnapshot.open(args.output)
+            fresh = snapshot is not None and snapshot.is_fresh(DB_PATH)
+            if snapshot is not None:
+                snapshot.close()
+
+            if not fresh or args.watch is None:
+                count = write_snapshot(storage, args.output)
+                sys.stdout.write("Wrote {} branches to {}\n".format(count, args.output))
+                sys.stdout.flush()
+            if args.watch is None:
+                break
+            time.sleep(args.watch)
+
+def disk_usage(args):
+    """
+    Print the disk usage of a branch.
+    """
+    from data_allocator.allocator import Allocator
+
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        usage = allocator.measure_branch_disk_usage(args.branch_name, 
+                                                    workers=args.workers, 
+                                                    breakdown_depth=args.max_depth, 
+                                                    use_cache=args.cache or args.refresh or args.max_age is not None, 
+                                                    refresh=args.refresh, 
+                                                    max_age=args.max_age, 
+                                                    )
+
+    def fmt(size):
+        return Allocator.format_size(size) if args.human_readable else str(size)
+
+    size_index = 1 if args.allocated else 0
+    for rel_path in sorted(usage.by_depth):
+        if rel_path:
+            size = usage.by_depth[rel_path][size_index]
+            sys.stdout.write("{}\t{}\n".format(fmt(size), args.branch_name + "/" + rel_path))
+    sys.stdout.write("{}\t{}\n".format(fmt(usage.size(allocated=args.allocated)), args.branch_name))
+
+def usage_report(args):
+    """
+    Print the disk usage of every branch, rolled up the branch tree.
+    """
+    import json
+
+    from data_allocator.allocator import Allocator
+    from data_allocator.usage_report import UsageReport
+
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        report = UsageReport(allocator, 
+                             workers=args.workers, 
+                             use_cache=args.cache or args.refresh, 
+                             refresh=args.refresh, 
+                             ).build(root_branch=args.root)
+
+    if args.json:
+        json.dump(report.to_records(allocated=args.allocated), sys.stdout, indent=4)
+        sys.stdout.write("\n")
+    else:
+        format_size = Allocator.format_size if args.human_readable else str
+        sys.stdout.write(report.tree2str(short_tree=args.short_tree, 
+                                         allocated=args.allocated, 
+                                         format_size=format_size, 
+                                         ))
+
+def dedup_report(args):
+    """
+    Print the sets of identical files across the branches, with the space
+    each would free, and optionally hard link the copies on each drive.
+    """
+    import json
+
+    from data_allocator.allocator import Allocator
+    from data_allocator.dedup import Deduplicator
+
+    def fmt(size):
+        return Allocator.format_size(size) if args.human_readable else str(size)
+
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        deduplicator = Deduplicator(allocator, 
+                                    workers=args.workers, 
+                                    min_size=Allocator.parse_size(args.min_size), 
+                                    use_cache=not args.no_cache, 
+                                    )
+        result = deduplicator.scan(root_branch=args.root)
+
+        if args.json:
+            records = [{"size": size, 
+                        "sha256": digest, 
+                        "copies": result.copies(files), 
+                        "files": [{"drive": drive, "branch": branch_path, "path": path} 
+                                  for drive, branch_path, path, _ in files], 
+                        } for size, digest, files in result.groups]
+            json.dump(records, sys.stdout, indent=4)
+            sys.stdout.write("\n")
+        else:
+            for size, digest, files in result.groups:
+                sys.stdout.write("{}\t{} copies\t{}\n".format(fmt(size), result.copies(files), digest))
+                for drive, branch_path, path, _ in files:
+                    sys.stdout.write("\t{}\t{}\t{}\n".format(drive, branch_path, path))
+
+        sys.stderr.write("Scanned {} files in {} directories: {} duplicate sets, {} reclaimable "
+                         "({} partial and {} full hashes, {} cached, {} read, {} errors)\n".format(result.file_count, 
+                                                                                                result.dir_count, 
+                                                                                                len(result.groups), 
+                                                                                                fmt(result.reclaimable_bytes()), 
+                                                                                                result.partial_hashes, 
+                                                                                                result.full_hashes, 
+                                                                                                result.cache_hits, 
+                                                                                                fmt(result.bytes_hashed), 
+                                                                                                result.error_count, 
+                                                                                                ))
+        if args.hardlink:
+            linked = deduplicator.hardlink(result)
+            sys.stderr.write("Linked {} files, reclaimed {} ({} skipped, {} errors)\n".format(linked.files_linked, 
+                                                                                             fmt(linked.bytes_reclaimed), 
+                                                                                             linked.skipped, 
+                                                                                             linked.error_count, 
+                                                                                             ))
+
+def rebalance(args):
+    """
+    Move branches between drives to even out their free space.
+    Unfinished moves of an interrupted run are finished first.
+    """
+    from data_allocator.allocator import Allocator
+    from data_allocator.rebalancer import Rebalancer
+
+    def fmt(size):
+        return Allocator.format_size(size) if args.human_readable else str(size)
+
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        rebalancer = Rebalancer(allocator, 
+                                workers=args.workers, 
+                                bandwidth=Allocator.parse_size(args.bwlimit) if args.bwlimit else None, 
+                                checksum=args.checksum, 
+                                )
+
+        pending = rebalancer.pending_moves()
+        if pending:
+            sys.stdout.write("Resuming {} unfinished move(s)\n".format(len(pending)))
+            moves = [move[:4] for move in pending]
+        else:
+            if args.band.endswith("%"):
+                free = allocator.check_space(update_cache=not args.dry_run)
+                band = int(float(args.band[:-1]) / 100 * sum(free.values()))
+            else:
+                band = Allocator.parse_size(args.band)
+            moves, free_before, free_after = rebalancer.plan(band, dry_run=args.dry_run)
+            for drive in sorted(free_before):
+                sys.stdout.write("{}\t{} -> {}\n".format(drive, fmt(free_before[drive]), fmt(free_after[drive])))
+
+        for branch_path, source, target, size in moves:
+            sys.stdout.write("{}\t{} -> {}\t{}\n".format(branch_path, source, target, fmt(size)))
+
+        if args.dry_run:
+            return
+
+        results = rebalancer.resume() if pending else rebalancer.execute(moves)
+        for branch_path, source, target, size, status in results:
+            sys.stdout.write("{}\t{}\n".format(status, branch_path))
+            sys.stdout.flush()
+
+def move_branch(args):
+    """
+    Rename a branch or move it to another drive, printing the progress
+    and throughput of the copy to stderr. With --resume, finish the
+    moves that were interrupted instead.
+    """
+    import time
+    import threading
+
+    from data_allocator.allocator import Allocator
+
+    def fmt(size):
+        return Allocator.format_size(size) if args.human_readable else str(size)
+
+    lock = threading.Lock()
+    state = {"stage": None, "started_at": 0.0, "reported_at": 0.0, "line": False}
+
+    def report(stage, files, size):
+        # called by the worker threads after every file, printed every half second
+        with lock:
+            now = time.monotonic()
+            if stage != state["stage"]:
+                end_line()
+                state["stage"] = stage
+                state["started_at"] = state["reported_at"] = now
+            if now - state["reported_at"] < 0.5:
+                return
+            state["reported_at"] = now
+            state["line"] = True
+            sys.stderr.write("\r{}: {} files, {} ({}/s)".format(stage, 
+                                                               files, 
+                                                               fmt(size), 
+                                                               fmt(int(size / (now - state["started_at"]))), 
+                                                               ))
+            sys.stderr.flush()
+
+    def end_line():
+        if state["line"]:
+            sys.stderr.write("\n")
+            state["line"] = False
+
+    def summary(branch_path, source, target, result, elapsed):
+        end_line()
+        state["stage"] = None
+        sys.stdout.write("{}\t{} -> {}\t{} files, {} in {:.1f} s ({}/s)\n".format(branch_path, 
+                                                                             source, 
+                                                                             target, 
+                                                                             result.files_copied, 
+                                                                             fmt(result.bytes_copied), 
+                                                                             elapsed, 
+                                                                             fmt(int(result.bytes_copied / max(elapsed, 1e-6))), 
+                                                                             ))
+        sys.stdout.flush()
+
+    kwargs = {"workers": args.workers, 
+              "bandwidth": Allocator.parse_size(args.bwlimit) if args.bwlimit else None, 
+              "checksum": args.checksum, 
+              "progress": None if args.quiet else report, 
+              }
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        if args.resume:
+            started_at = time.monotonic()
+            for branch_path, source, target, result in allocator.resume_moves(**kwargs):
+                if result is None:
+                    sys.stdout.write("{}\t{} -> {}\tskipped\n".format(branch_path, source, target))
+                else:
+                    summary(branch_path, source, target, result, time.monotonic() - started_at)
+                started_at = time.monotonic()
+            return
+
+        source = allocator.storage.get_drive(args.branch_name)
+        started_at = time.monotonic()
+        result = allocator.move_branch(args.branch_name, 
+                                       new_name=args.new_name, 
+                                       drive=args.drive, 
+                                       **kwargs, 
+                                       )
+        new_name = args.new_name or args.branch_name
+        target = allocator.storage.get_drive(new_name)
+        if source != target:
+            summary(new_name, source, target, result, time.monotonic() - started_at)
+        elif new_name != args.branch_name:
+            sys.stdout.write("{} -> {}\n".format(args.branch_name, new_name))
+        else:
+            sys.stdout.write("'{}' is already on '{}'\n".format(new_name, target))
+
+def fsck(args):
+    """
+    Check the records against the drives, and optionally repair them.
+    Exits with status 1 if problems remain.
+    """
+    from data_allocator.allocator import Allocator
+    from data_allocator.fsck import Fsck
+
+    with Allocator(config_path=CONFIG_PATH, 
+                   db_path=DB_PATH, 
+                   ) as allocator:
+        checker = Fsck(allocator, workers=args.workers)
+        result = checker.check()
+        drive_paths = allocator.config.get_drive_paths()
+
+        for drive, branch_path in result.missing:
+            sys.stdout.write("missing\t{}\t{}\n".format(drive, branch_path))
+        for branch_path, drive, other in result.wrong_drive:
+            sys.stdout.write("wrong-drive\t{}\t{} -> {}\n".format(branch_path, drive, other))
+        for drive, rel_path in result.unregistered:
+            sys.stdout.write("unregistered\t{}\t{}\n".format(drive, os.path.join(drive_paths[drive], rel_path)))
+        for drive, rel_path, message in result.errors:
+            sys.stdout.write("error\t{}\t{}\t{}\n".format(drive, os.path.join(drive_paths[drive], rel_path), message))
+
+        sys.stderr.write("Checked {} records, listed {} directories: {} problems\n".format(result.record_count, 
+                                                                                       result.dir_count, 
+                                                                                       result.problem_count(), 
+                                                                                       ))
+        remaining = result.problem_count()
+        if args.repair and remaining:
+            fixed = checker.repair(result, trash_unregistered=args.trash_unregistered)
+            sys.stderr.write("Repaired {} wrong-drive records, dropped {} missing records, "
+                             "trashed {} unregistered directories\n".format(fixed["wrong_drive"], 
+                                                                           fixed["missing"], 
+                                                                           fixed["unregistered"], 
+                                                                           ))
+            remaining -= sum(fixed.values())
+
+    if remaining:
+        sys.exit(1)
 
 def ls_root(args): 
-    visualizer = TreeVisualizer(storage_manager=StorageManager(db_path=DB_PATH))
-    tree = visualizer.build_tree(root_branch=args.root)
+    served, output_str = call_daemon("ls", root=args.root, max_depth=args.max_depth, short_tree=args.short_tree)
+    if served:
+        sys.stdout.write(output_str)
+        return
+
+    from data_allocator.tree_visualizer import TreeVisualizer
+
+    with open_storage() as storage:
+        visualizer = TreeVisualizer(storage_manager=storage)
+        tree = visualizer.build_tree(root_branch=args.root, 
+                                     max_depth=args.max_depth, 
+                                     )
     output_str = TreeVisualizer.tree2str(tree, 
                                          short_tree=args.short_tree, 
                                          )
 
     sys.stdout.write(output_str)
 
+def run_daemon(args):
+    """
+    Serve allocate/get/delete/ls on the daemon socket until stopped.
+    """
+    if args.stop:
+        served, _ = call_daemon("shutdown")
+        if not served:
+            sys.stderr.write("No daemon is running on {}\n".format(SOCKET_PATH))
+            sys.exit(1)
+        return
+
+    import signal
+
+    from data_allocator.daemon import AllocatorDaemon
+
+    daemon = AllocatorDaemon(socket_path=SOCKET_PATH, 
+                             config_path=CONFIG_PATH, 
+                             db_path=DB_PATH, 
+                             )
+    # SIGTERM stops the daemon as cleanly as Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    sys.stdout.write("Serving on {}\n".format(SOCKET_PATH))
+    sys.stdout.flush()
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+
+def run_profiled(command, args):
+    """
+    Run a command with the instrumentation enabled, and under cProfile
+    with --cprofile. The breakdown is written even if the command exits.
+    """
+    from data_allocator import instrumentation
+
+    profile = instrumentation.enable()
+    # imports the commands would make lazily, timed on their own
+    with instrumentation.timer("cli.imports"):
+        import data_allocator.allocator
+        import data_allocator.tree_visualizer
+
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        with instrumentation.timer("cli.command"):
+            command()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+        instrumentation.disable()
+
+        if args.profile_json:
+            import json
+            with open(args.profile_json, "w") as f:
+                json.dump(profile.to_dict(), f, indent=4)
+        if args.profile or not args.profile_json:
+            sys.stderr.write(profile.report())
+
 def main():
     """
     Main function to parse arguments and call the appropriate function.
@@ -67,19 +757,128 @@ def main():
         description="Yulab Data Allocator: Manage data allocation across multiple drives."
     )
     
+    parser.add_argument("--no-daemon", 
+                        action="store_true", 
+                        dest="no_daemon", 
+                        help="Run the command in-process even if the daemon is running", 
+                        )
+    parser.add_argument("--profile", 
+                        action="store_true", 
+                        help="Run the command in-process and print the time spent per operation to stderr", 
+                        )
+    parser.add_argument("--profile-json", 
+                        type=str, 
+                        dest="profile_json", 
+                        help="Like --profile, but write the breakdown to this JSON file", 
+                        default=None, 
+                        )
+    parser.add_argument("--cprofile", 
+                        type=str, 
+                        help="Also run the command under cProfile and write the stats to this file", 
+                        default=None, 
+                        )
     subparsers = parser.add_subparsers(dest="command", help="Commands")
 
     # Allocate Command
     allocate_parser = subparsers.add_parser("allocate", help="Allocate a new branch")
-    allocate_parser.add_argument("branch_name", type=str, help="Name of the branch to allocate")
+    allocate_parser.add_argument("branch_name", type=str, nargs="?", help="Name of the branch to allocate")
+    allocate_parser.add_argument("--from-file", 
+                                 type=str, 
+                                 dest="from_file", 
+                                 help="Allocate every branch listed in this file, one per line ('-' for stdin)", 
+                                 default=None, 
+                                 )
+    allocate_parser.add_argument("--expected-size", 
+                                 type=str, 
+                                 dest="expected_size", 
+                                 help="Expected size of each branch, e.g. 500G. The space is reserved on the chosen drive", 
+                                 default=None, 
+                                 )
+    allocate_parser.add_argument("--batch-size", 
+                                 type=int, 
+                                 dest="batch_size", 
+                                 help="Number of branches allocated per transaction with --from-file", 
+                                 default=1000, 
+                                 )
 
     # Get Path Command
     get_parser = subparsers.add_parser("get", help="Get the path of an existing branch")
-    get_parser.add_argument("branch_name", type=str, help="Name of the branch to get the path")
+    get_parser.add_argument("branch_name", type=str, nargs="?", help="Name of the branch to get the path")
+    get_parser.add_argument("--stdin", 
+                            action="store_true", 
+                            help="Read branch names from stdin, one per line, and write their paths in the same order", 
+                            )
+    get_parser.add_argument("--batch-size", 
+                            type=int, 
+                            dest="batch_size", 
+                            help="Number of branches looked up per query batch with --stdin", 
+                            default=1000, 
+                            )
+
+    # Which Command
+    which_parser = subparsers.add_parser("which", help="Find the branch and drive that own filesystem paths")
+    which_parser.add_argument("paths", type=str, nargs="*", help="Paths to resolve")
+    which_parser.add_argument("--stdin", 
+                              action="store_true", 
+                              help="Read paths from stdin, one per line", 
+                              )
+    which_parser.add_argument("--batch-size", 
+                              type=int, 
+                              dest="batch_size", 
+                              help="Number of paths resolved per query batch with --stdin", 
+                              default=1000, 
+                              )
 
     # Delete Command
     delete_parser = subparsers.add_parser("delete", help="Delete a branch and its record")
     delete_parser.add_argument("branch_name", type=str, help="Name of the branch to delete")
+    delete_parser.add_argument("--defer", 
+                               action="store_true", 
+                               help="Move the branch into the drive's trash and return at once; `reap` removes it", 
+                               )
+    delete_parser.add_argument("-r", "--recursive", 
+                               action="store_true", 
+                               help="Also delete every branch below the branch, on any drive", 
+                               )
+    delete_parser.add_argument("--dry-run", 
+                               action="store_true", 
+                               dest="dry_run", 
+                               help="With -r, print the branches that would be deleted and exit", 
+                               )
+    delete_parser.add_argument("--workers", 
+                               type=int, 
+                               help="Number of threads removing the directories with -r", 
+                               default=16, 
+                               )
+
+    # reap command
+    reap_parser = subparsers.add_parser("reap", help="Remove the branches deleted with --defer")
+    reap_parser.add_argument("--workers", 
+                             type=int, 
+                             help="Number of parallel unlink threads", 
+                             default=16, 
+                             )
+    reap_parser.add_argument("--rate", 
+                             type=int, 
+                             help="Cap on the files removed per second", 
+                             default=None, 
+                             )
+    reap_parser.add_argument("--min-age", 
+                             type=float, 
+                             dest="min_age", 
+                             help="Only remove branches deleted at least this many seconds ago", 
+                             default=None, 
+                             )
+    reap_parser.add_argument("--watch", 
+                             type=float, 
+                             help="Keep running, emptying the trash every this many seconds", 
+                             default=None, 
+                             )
+    reap_parser.add_argument("-q", 
+                             "--quiet", 
+                             action="store_true", 
+                             help="Do not report progress", 
+                             )
 
     # ls command
     ls_parser = subparsers.add_parser("ls", help="List all branches")
@@ -88,6 +887,12 @@ def main():
                            help="Root branch to list", 
                            default="", 
                            )
+    ls_parser.add_argument("--max-depth", 
+                           type=int, 
+                           dest="max_depth", 
+                           help="Only list branches up to this many levels below the root", 
+                           default=None, 
+                           )
     ls_parser.add_argument("-s", 
                            "--short_tree", 
                            action="store_true",
@@ -95,21 +900,356 @@ def main():
                            help="Print a short version of the tree",
                            )
 
+    # du command
+    du_parser = subparsers.add_parser("du", help="Show the disk usage of a branch")
+    du_parser.add_argument("branch_name", type=str, help="Name of the branch to measure")
+    du_parser.add_argument("--allocated", 
+                           action="store_true", 
+                           help="Report allocated blocks instead of apparent file sizes", 
+                           )
+    du_parser.add_argument("--max-depth", 
+                           type=int, 
+                           dest="max_depth", 
+                           help="Also show directories up to this many levels below the branch", 
+                           default=None, 
+                           )
+    du_parser.add_argument("--workers", 
+                           type=int, 
+                           help="Number of parallel scanner threads", 
+                           default=16, 
+                           )
+    du_parser.add_argument("--cache", 
+                           action="store_true", 
+                           help="Reuse the usage of directories whose mtime has not changed; "
+                                "files grown in place are missed", 
+                           )
+    du_parser.add_argument("--refresh", 
+                           action="store_true", 
+                           help="Walk the whole branch and rewrite the usage cache", 
+                           )
+    du_parser.add_argument("--max-age", 
+                           type=float, 
+                           dest="max_age", 
+                           help="Print the cached total without scanning if it is at most this many seconds old", 
+                           default=None, 
+                           )
+    du_parser.add_argument("-H", 
+                           "--human-readable", 
+                           action="store_true", 
+                           dest="human_readable", 
+                           help="Print sizes in KB/MB/GB", 
+                           )
+
+    # usage-report command
+    report_parser = subparsers.add_parser("usage-report", help="Show the disk usage of every branch")
+    report_parser.add_argument("--root", 
+                               type=str, 
+                               help="Root branch to report on", 
+                               default="", 
+                               )
+    report_parser.add_argument("--json", 
+                               action="store_true", 
+                               help="Print JSON records sorted by size instead of a tree", 
+                               )
+    report_parser.add_argument("--allocated", 
+                               action="store_true", 
+                               help="Report allocated blocks instead of apparent file sizes", 
+                               )
+    report_parser.add_argument("--workers", 
+                               type=int, 
+                               help="Number of parallel scanner threads per drive", 
+                               default=16, 
+                               )
+    report_parser.add_argument("--cache", 
+                               action="store_true", 
+                               help="Reuse the usage of directories whose mtime has not changed; "
+                                    "files grown in place are missed", 
+                               )
+    report_parser.add_argument("--refresh", 
+                               action="store_true", 
+                               help="Walk the drives completely and rewrite the usage cache", 
+                               )
+    report_parser.add_argument("-s", 
+                               "--short_tree", 
+                               action="store_true", 
+                               dest="short_tree", 
+                               help="Print a short version of the tree", 
+                               )
+    report_parser.add_argument("-H", 
+                               "--human-readable", 
+                               action="store_true", 
+                               dest="human_readable", 
+                               help="Print sizes in KB/MB/GB", 
+                               )
+
+    # dedup-report command
+    dedup_parser = subparsers.add_parser("dedup-report", help="Find identical files across the branches")
+    dedup_parser.add_argument("--root", 
+                              type=str, 
+                              help="Root branch to search", 
+                              default="", 
+                              )
+    dedup_parser.add_argument("--min-size", 
+                              type=str, 
+                              dest="min_size", 
+                              help="Smallest file size considered, e.g. 1M", 
+                              default="1", 
+                              )
+    dedup_parser.add_argument("--workers", 
+                              type=int, 
+                              help="Number of parallel listing and hashing threads", 
+                              default=16, 
+                              )
+    dedup_parser.add_argument("--no-cache", 
+                              action="store_true", 
+                              dest="no_cache", 
+                              help="Hash every candidate file instead of reusing the hash cache", 
+                              )
+    dedup_parser.add_argument("--hardlink", 
+                              action="store_true", 
+                              help="Replace the copies on each drive with hard links to one of them", 
+                              )
+    dedup_parser.add_argument("--json", 
+                              action="store_true", 
+                              help="Print the duplicate sets as JSON", 
+                              )
+    dedup_parser.add_argument("-H", 
+                              "--human-readable", 
+                              action="store_true", 
+                              dest="human_readable", 
+                              help="Print sizes in KB/MB/GB", 
+                              )
+
+    # rebalance command
+    rebalance_parser = subparsers.add_parser("rebalance", help="Move branches between drives to even out free space")
+    rebalance_parser.add_argument("--band", 
+                                  type=str, 
+                                  help="Largest free-space difference left between drives, as a size (e.g. 100G) "
+                                       "or a percentage of the total free space", 
+                                  default="10%", 
+                                  )
+    rebalance_parser.add_argument("--dry-run", 
+                                  action="store_true", 
+                                  dest="dry_run", 
+                                  help="Print the planned moves without moving anything", 
+                                  )
+    rebalance_parser.add_argument("--workers", 
+                                  type=int, 
+                                  help="Number of parallel file copy threads", 
+                                  default=8, 
+                                  )
+    rebalance_parser.add_argument("--bwlimit", 
+                                  type=str, 
+                                  help="Cap on the copy rate per second, e.g. 200M", 
+                                  default=None, 
+                                  )
+    rebalance_parser.add_argument("--no-checksum", 
+                                  action="store_false", 
+                                  dest="checksum", 
+                                  help="Verify copies by file sizes instead of by SHA-256", 
+                                  )
+    rebalance_parser.add_argument("-H", 
+                                  "--human-readable", 
+                                  action="store_true", 
+                                  dest="human_readable", 
+                                  help="Print sizes in KB/MB/GB", 
+                                  )
+
+    # mv command
+    mv_parser = subparsers.add_parser("mv", help="Rename a branch or move it to another drive")
+    mv_parser.add_argument("branch_name", type=str, nargs="?", help="Name of the branch to move")
+    mv_parser.add_argument("new_name", type=str, nargs="?", help="New name of the branch, with the branches below it")
+    mv_parser.add_argument("--drive", 
+                           type=str, 
+                           help="Drive to move the branch to, copying its data", 
+                           default=None, 
+                           )
+    mv_parser.add_argument("--resume", 
+                           action="store_true", 
+                           help="Finish the moves to another drive that were interrupted", 
+                           )
+    mv_parser.add_argument("--workers", 
+                           type=int, 
+                           help="Number of parallel file copy threads", 
+                           default=8, 
+                           )
+    mv_parser.add_argument("--bwlimit", 
+                           type=str, 
+                           help="Cap on the copy rate per second, e.g. 200M", 
+                           default=None, 
+                           )
+    mv_parser.add_argument("--size-only", 
+                           action="store_false", 
+                           dest="checksum", 
+                           help="Verify the copy by file sizes instead of by SHA-256", 
+                           )
+    mv_parser.add_argument("-q", 
+                           "--quiet", 
+                           action="store_true", 
+                           help="Do not print the copy progress", 
+                           )
+    mv_parser.add_argument("-H", 
+                           "--human-readable", 
+                           action="store_true", 
+                           dest="human_readable", 
+                           help="Print sizes in KB/MB/GB", 
+                           )
+
+    # import command
+    import_parser = subparsers.add_parser("import", help="Record existing directories as branches")
+    import_parser.add_argument("--depth", 
+                               type=int, 
+                               help="Depth below the drive roots of the directories to record (without --manifest)", 
+                               default=1, 
+                               )
+    import_parser.add_argument("--manifest", 
+                               type=str, 
+                               help="Record the branches listed in this JSONL or CSV file ('-' for stdin) instead of scanning", 
+                               default=None, 
+                               )
+    import_parser.add_argument("--format", 
+                               choices=["jsonl", "csv"], 
+                               help="Format of the manifest, by default from its extension", 
+                               default=None, 
+                               )
+    import_parser.add_argument("--chunk-size", 
+                               type=int, 
+                               dest="chunk_size", 
+                               help="Records per transaction", 
+                               default=10000, 
+                               )
+    import_parser.add_argument("--dry-run", 
+                               action="store_true", 
+                               dest="dry_run", 
+                               help="Report what would be recorded without writing to the database", 
+                               )
+
+    # export command
+    export_parser = subparsers.add_parser("export", help="Write every branch record as JSONL or CSV")
+    export_parser.add_argument("--output", 
+                               type=str, 
+                               help="File to write ('-' for stdout)", 
+                               default="-", 
+                               )
+    export_parser.add_argument("--format", 
+                               choices=["jsonl", "csv"], 
+                               help="Output format, by default from the file extension", 
+                               default=None, 
+                               )
+
+    # snapshot command
+    snapshot_parser = subparsers.add_parser("snapshot", help="Write the read-only snapshot of the records used by get")
+    snapshot_parser.add_argument("--output", 
+                                 type=str, 
+                                 help="Path of the snapshot file", 
+                                 default=SNAPSHOT_PATH, 
+                                 )
+    snapshot_parser.add_argument("--watch", 
+                                 type=float, 
+                                 help="Keep running and rewrite the snapshot when the database changed, checking every this many seconds", 
+                                 default=None, 
+                                 )
+
+    # fsck command
+    fsck_parser = subparsers.add_parser("fsck", help="Check the records against the directories on the drives")
+    fsck_parser.add_argument("--workers", 
+                             type=int, 
+                             help="Number of parallel directory listing threads", 
+                             default=16, 
+                             )
+    fsck_parser.add_argument("--repair", 
+                             action="store_true", 
+                             help="Point wrong-drive records at the drive holding the directory and drop missing records", 
+                             )
+    fsck_parser.add_argument("--trash-unregistered", 
+                             action="store_true", 
+                             dest="trash_unregistered", 
+                             help="With --repair, also move unregistered directories into the drive's trash", 
+                             )
+
+    # daemon command
+    daemon_parser = subparsers.add_parser("daemon", help="Serve allocate/get/delete/ls from a long-running process")
+    daemon_parser.add_argument("--stop", 
+                               action="store_true", 
+                               help="Stop the running daemon", 
+                               )
+
     # Parse arguments
     args = parser.parse_args()
 
-    # Handle commands
-    if args.command == "allocate":
-        allocate_branch(args.branch_name)
-    elif args.command == "get":
-        get_branch_path(args.branch_name)
-    elif args.command == "delete":
-        delete_branch(args.branch_name)
-    elif args.command == "ls":
-        ls_root(args)
+    global USE_DAEMON
+    profiling = args.profile or args.profile_json or args.cprofile
+    USE_DAEMON = not args.no_daemon and not profiling
+
+    def run_command():
+        # Handle commands
+        if args.command == "allocate":
+            if args.from_file is not None:
+                allocate_branches_from_file(args.from_file, args.batch_size, args.expected_size)
+            elif args.branch_name is not None:
+                allocate_branch(args.branch_name, args.expected_size)
+            else:
+                allocate_parser.error("either branch_name or --from-file is required")
+        elif args.command == "get":
+            if args.stdin:
+                get_branch_paths("-", args.batch_size)
+            elif args.branch_name is not None:
+                get_branch_path(args.branch_name)
+            else:
+                get_parser.error("either branch_name or --stdin is required")
+        elif args.command == "which":
+            if args.stdin:
+                which_branches(None, "-", args.batch_size)
+            elif args.paths:
+                which_branches(args.paths, None, args.batch_size)
+            else:
+                which_parser.error("either paths or --stdin is required")
+        elif args.command == "delete":
+            if args.recursive:
+                delete_subtree(args)
+            elif args.dry_run:
+                delete_parser.error("--dry-run needs -r")
+            else:
+                delete_branch(args.branch_name, args.defer)
+        elif args.command == "reap":
+            reap_trash(args)
+        elif args.command == "du":
+            disk_usage(args)
+        elif args.command == "usage-report":
+            usage_report(args)
+        elif args.command == "dedup-report":
+            dedup_report(args)
+        elif args.command == "rebalance":
+            rebalance(args)
+        elif args.command == "mv":
+            if args.resume:
+                move_branch(args)
+            elif args.branch_name is None:
+                mv_parser.error("either branch_name or --resume is required")
+            elif args.new_name is None and args.drive is None:
+                mv_parser.error("either new_name or --drive is required")
+            else:
+                move_branch(args)
+        elif args.command == "import":
+            import_branches(args)
+        elif args.command == "export":
+            export_branches(args)
+        elif args.command == "snapshot":
+            write_branch_snapshot(args)
+        elif args.command == "fsck":
+            fsck(args)
+        elif args.command == "daemon":
+            run_daemon(args)
+        elif args.command == "ls":
+            ls_root(args)
+        else:
+            parser.print_help()
+            sys.exit(1)
+
+    if profiling:
+        run_profiled(run_command, args)
     else:
-        parser.print_help()
-        sys.exit(1)
+        run_command()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Latency of `get` through the allocator daemon versus in-process.
+
+A daemon is started with `YuLabDataAllocator.py daemon` against a
+throwaway HOME holding a database of --branches records. The script
+reports the median time of:
+
+- a request over an open connection to the daemon,
+- a connection plus a request, as made by each CLI call,
+- building an Allocator and calling get_path, as made by each CLI call
+  without the daemon,
+- the whole CLI command, with and without the daemon.
+
+Usage:
+    python benchmarks/daemon_latency.py [--branches N] [--calls N] [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_PATH = os.path.join(REPO_DIR, "YuLabDataAllocator.py")
+sys.path.insert(0, REPO_DIR)
+
+def make_home(tmp_dir, branches):
+    """
+    Create a HOME with a config pointing at two drives and a database
+    of branches records. Returns (home, config path, db path).
+    """
+    from data_allocator.storage_manager import StorageManager
+
+    home = os.path.join(tmp_dir, "home")
+    config_dir = os.path.join(home, ".YuLabDataAllocator")
+    os.makedirs(config_dir)
+
+    drives = {}
+    for name in ("drive1", "drive2"):
+        drives[name] = os.path.join(tmp_dir, name)
+        os.makedirs(drives[name])
+
+    config_path = os.path.join(config_dir, "config.json")
+    with open(config_path, "w") as f:
+        json.dump({"drives": drives}, f)
+
+    db_path = os.path.join(config_dir, "YuLabDataAllocator.db")
+    with StorageManager(db_path) as storage:
+        storage.record_locations(("bench/b{}".format(i), "drive{}".format(i % 2 + 1)) for i in range(branches))
+
+    return home, config_path, db_path
+
+def median_us(func, calls):
+    times = []
+    for i in range(calls):
+        start = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1e6
+
+def run_cli(home, args):
+    env = dict(os.environ, HOME=home)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, CLI_PATH] + args, env=env, cwd=REPO_DIR, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare get latency through the daemon and in-process.")
+    parser.add_argument("--branches", type=int, default=100000, help="Records in the database")
+    parser.add_argument("--calls", type=int, default=2000, help="Calls per measurement")
+    parser.add_argument("--cli-calls", type=int, default=10, dest="cli_calls", help="CLI runs per measurement")
+    parser.add_argument("--json", type=str, default=None, dest="json_path", help="Write results to this file")
+    args = parser.parse_args()
+
+    from data_allocator.allocator import Allocator
+    from data_allocator.client import DaemonClient
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        home, config_path, db_path = make_home(tmp_dir, args.branches)
+        socket_path = os.path.join(home, ".YuLabDataAllocator", "daemon.sock")
+
+        def in_process(i):
+            with Allocator(config_path=config_path, db_path=db_path) as allocator:
+                allocator.get_path("bench/b{}".format(i % args.branches))
+
+        results["in_process_us"] = median_us(in_process, args.calls)
+        results["cli_in_process_ms"] = statistics.median(run_cli(home, ["get", "bench/b1"])
+                                                         for _ in range(args.cli_calls)) * 1e3
+
+        daemon = subprocess.Popen([sys.executable, CLI_PATH, "daemon"],
+                                  env=dict(os.environ, HOME=home),
+                                  cwd=REPO_DIR,
+                                  stdout=subprocess.PIPE,
+                                  )
+        try:
+            # wait for "Serving on ..."
+            daemon.stdout.readline()
+
+            with DaemonClient.connect(socket_path) as client:
+                results["daemon_request_us"] = median_us(lambda i: client.call("get", branch_name="bench/b{}".format(i % args.branches)),
+                                                         args.calls)
+
+            def connect_and_get(i):
+                with DaemonClient.connect(socket_path) as client:
+                    client.call("get", branch_name="bench/b{}".format(i % args.branches))
+
+            results["daemon_connect_request_us"] = median_us(connect_and_get, args.calls)
+            results["cli_daemon_ms"] = statistics.median(run_cli(home, ["get", "bench/b1"])
+                                                         for _ in range(args.cli_calls)) * 1e3
+        finally:
+            run_cli(home, ["daemon", "--stop"])
+            daemon.wait()
+
+    for key, value in results.items():
+        sys.stdout.write("{:<28}{:>10.1f}\n".format(key, value))
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
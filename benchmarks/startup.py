@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark for the YuLabDataAllocator CLI.
+
+Each subcommand is run in a fresh interpreter against a throwaway HOME
+(config, database and drives under a temporary directory). For every
+command the script reports the wall-clock time over several runs and
+the total module import time reported by `python -X importtime`.
+
+Usage:
+    python benchmarks/startup.py [--repeat N] [--json results.json]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI_PATH = os.path.join(REPO_DIR, "YuLabDataAllocator.py")
+
+def make_home(tmp_dir):
+    """
+    Create a HOME with a config pointing at two empty drives.
+    """
+    home = os.path.join(tmp_dir, "home")
+    config_dir = os.path.join(home, ".YuLabDataAllocator")
+    os.makedirs(config_dir)
+
+    drives = {}
+    for name in ("drive1", "drive2"):
+        drives[name] = os.path.join(tmp_dir, name)
+        os.makedirs(drives[name])
+
+    with open(os.path.join(config_dir, "config.json"), "w") as f:
+        json.dump({"drives": drives}, f)
+
+    return home
+
+def run_cli(home, args, importtime=False):
+    """
+    Run the CLI once. Returns (wall seconds, stderr).
+    """
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ["-X", "importtime"]
+    cmd += [CLI_PATH] + args
+
+    env = dict(os.environ, HOME=home)
+    start = time.perf_counter()
+    result = subprocess.run(cmd, env=env, cwd=REPO_DIR, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+
+    if result.returncode != 0:
+        raise RuntimeError("{} failed:\n{}".format(" ".join(args), result.stderr))
+    return elapsed, result.stderr
+
+def total_import_us(stderr):
+    """
+    Sum the cumulative time of the top-level imports in -X importtime output.
+    """
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        # top-level imports are the ones whose name is indented by one space
+        if not fields[2].startswith("  "):
+            total += int(fields[1])
+    return total
+
+def command_args(command, label):
+    """
+    Arguments for one run of a command. allocate and delete
+    work on the branch named by label.
+    """
+    if command == "allocate":
+        return ["allocate", "bench/{}".format(label)]
+    if command == "get":
+        return ["get", "bench/existing"]
+    if command == "delete":
+        return ["delete", "bench/{}".format(label)]
+    if command == "ls":
+        return ["ls"]
+    raise ValueError(command)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CLI cold-start time per subcommand.")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per command")
+    parser.add_argument("--json", type=str, default=None, dest="json_path", help="Write results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        home = make_home(tmp_dir)
+        run_cli(home, ["allocate", "bench/existing"])
+
+        # allocate runs first so that delete has branches to remove
+        labels = ["run{}".format(i) for i in range(args.repeat)] + ["importtime"]
+        for command in ("allocate", "get", "ls", "delete"):
+            times = [run_cli(home, command_args(command, label))[0] for label in labels[:-1]]
+
+            # one more run under -X importtime
+            _, stderr = run_cli(home, command_args(command, labels[-1]), importtime=True)
+
+            results[command] = {"min_s": min(times),
+                                "median_s": statistics.median(times),
+                                "import_us": total_import_us(stderr),
+                                }
+
+    sys.stdout.write("{:<10}{:>12}{:>12}{:>14}\n".format("command", "min (ms)", "median (ms)", "imports (ms)"))
+    for command, result in results.items():
+        sys.stdout.write("{:<10}{:>12.1f}{:>12.1f}{:>14.1f}\n".format(command,
+                                                                    result["min_s"] * 1e3,
+                                                                    result["median_s"] * 1e3,
+                                                                    result["import_us"] / 1e3,
+                                                                    ))
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
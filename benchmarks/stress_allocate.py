@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Concurrent allocation stress test.
+
+Many processes allocate from the same list of branch names against one
+database and two drives under a temporary directory. Every name should be
+recorded exactly once, with exactly one directory, whatever the interleaving.
+The script checks that and reports the throughput.
+
+Usage:
+    python benchmarks/stress_allocate.py [--procs N] [--allocations N] [--overlap F] [--json results.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+def make_config(tmp_dir):
+    """
+    Write a config pointing at two empty drives. Returns (config path, drive paths).
+    """
+    drives = {}
+    for name in ("drive1", "drive2"):
+        drives[name] = os.path.join(tmp_dir, name)
+        os.makedirs(drives[name])
+
+    config_path = os.path.join(tmp_dir, "config.json")
+    with open(config_path, "w") as f:
+        json.dump({"drives": drives}, f)
+
+    return config_path, drives
+
+def worker(config_path, db_path, branch_names, start_event):
+    """
+    Allocate branch_names in one process.
+    Returns (allocated, duplicates, other errors).
+    """
+    from data_allocator.allocator import Allocator
+    from data_allocator.exceptions import AllocatorException
+
+    allocated = duplicates = errors = 0
+    with Allocator(config_path=config_path, db_path=db_path) as allocator:
+        start_event.wait()
+        for branch_name in branch_names:
+            try:
+                allocator.allocate(branch_name)
+                allocated += 1
+            except AllocatorException as e:
+                if "Duplicate entry" in str(e):
+                    duplicates += 1
+                else:
+                    errors += 1
+    return allocated, duplicates, errors
+
+def branch_names_for(proc, allocations, overlap):
+    """
+    Names allocated by one process. The first overlap share of them
+    is the same for every process, the rest are its own.
+    """
+    shared = int(allocations * overlap)
+    names = ["shared/b{}".format(i) for i in range(shared)]
+    names += ["p{}/b{}".format(proc, i) for i in range(allocations - shared)]
+    return names
+
+def directories_on(drives):
+    """
+    Branch directories (two levels deep) found on the drives.
+    """
+    found = []
+    for drive_path in drives.values():
+        for group in os.listdir(drive_path):
+            for name in os.listdir(os.path.join(drive_path, group)):
+                found.append("{}/{}".format(group, name))
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress concurrent allocation from many processes.")
+    parser.add_argument("--procs", type=int, default=64, help="Number of processes")
+    parser.add_argument("--allocations", type=int, default=1000, help="Allocations per process")
+    parser.add_argument("--overlap", type=float, default=0.5, help="Share of names every process tries")
+    parser.add_argument("--json", type=str, default=None, dest="json_path", help="Write results to this file")
+    args = parser.parse_args()
+
+    from data_allocator.storage_manager import StorageManager
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path, drives = make_config(tmp_dir)
+        db_path = os.path.join(tmp_dir, "data_location.db")
+        StorageManager(db_path).close()
+
+        expected = set()
+        tasks = []
+        ctx = multiprocessing.get_context("spawn")
+        start_event = ctx.Manager().Event()
+        for proc in range(args.procs):
+            names = branch_names_for(proc, args.allocations, args.overlap)
+            expected.update(names)
+            tasks.append((config_path, db_path, names, start_event))
+
+        with ctx.Pool(args.procs) as pool:
+            pending = pool.starmap_async(worker, tasks)
+            # let every process open its connection before timing
+            time.sleep(1.0)
+            start = time.perf_counter()
+            start_event.set()
+            counts = pending.get()
+            elapsed = time.perf_counter() - start
+
+        with StorageManager(db_path) as storage:
+            recorded = storage.get_all_locations2drive()
+        on_disk = directories_on(drives)
+
+    allocated = sum(count[0] for count in counts)
+    attempts = args.procs * args.allocations
+    results = {"procs": args.procs,
+               "attempts": attempts,
+               "allocated": allocated,
+               "duplicates": sum(count[1] for count in counts),
+               "errors": sum(count[2] for count in counts),
+               "seconds": elapsed,
+               "attempts_per_s": attempts / elapsed,
+               "allocations_per_s": allocated / elapsed,
+               "records_ok": sorted(recorded) == sorted(expected) and allocated == len(expected),
+               "directories_ok": sorted(on_disk) == sorted(expected),
+               }
+
+    for key, value in results.items():
+        sys.stdout.write("{:<20}{}\n".format(key, round(value, 1) if isinstance(value, float) else value))
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if not (results["records_ok"] and results["directories_ok"]):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
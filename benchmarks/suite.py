@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Scaling benchmarks for the allocator operations.
+
+`run` builds a synthetic database per size (branches nested 1 to 6
+levels deep, spread over two drives) and a synthetic drive tree, then
+times:
+
+- allocate, get_path and delete_branch, per call,
+- build_tree and tree2str, over the whole tree and over one project,
+- calculate_branch_disk_usage, with a cold and a warm usage cache,
+- the CLI cold start of `get` and `ls --max-depth 1`, against the same database.
+
+Results are written as JSON, one file per commit, and `compare` reports
+the change of the median time of every measurement between two files.
+
+Usage:
+    python benchmarks/suite.py run [--sizes 10000,100000,1000000] [--output results.json]
+    python benchmarks/suite.py compare old.json new.json [--threshold 0.1]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from startup import run_cli
+
+DRIVES = ("drive1", "drive2")
+
+# Depth of the synthetic branches and how common each one is,
+# e.g. lab/project/experiment/run/...
+DEPTH_WEIGHTS = {1: 1, 2: 4, 3: 10, 4: 20, 5: 10, 6: 5}
+
+def synthetic_branches(count, seed=0):
+    """
+    Yield count distinct (branch_path, drive) pairs. Siblings share
+    few names at the top and many at the bottom, as in a lab tree.
+    """
+    rng = random.Random(seed)
+    depths = list(DEPTH_WEIGHTS)
+    weights = list(DEPTH_WEIGHTS.values())
+    # names per level, so that the tree is wide at the bottom
+    fanout = [10, 30, 100, 1000, 1000, 1000]
+
+    seen = set()
+    while len(seen) < count:
+        depth = rng.choices(depths, weights)[0]
+        names = ["l{}n{}".format(level, rng.randrange(fanout[level])) for level in range(depth)]
+        branch_path = "/".join(names)
+        if branch_path in seen:
+            continue
+        seen.add(branch_path)
+        yield branch_path, DRIVES[len(seen) % len(DRIVES)]
+
+def make_drive_tree(path, dirs, files_per_dir, file_size=1024):
+    """
+    Create a branch directory of dirs subdirectories
+    holding files_per_dir files each.
+    """
+    payload = b"\0" * file_size
+    for i in range(dirs):
+        dir_path = os.path.join(path, "d{}".format(i // 32), "d{}".format(i))
+        os.makedirs(dir_path)
+        for j in range(files_per_dir):
+            with open(os.path.join(dir_path, "f{}".format(j)), "wb") as f:
+                f.write(payload)
+
+def make_home(tmp_dir, size):
+    """
+    Create a HOME with a config pointing at two drives and a database
+    of size synthetic branches. Returns (home, config path, db path).
+    """
+    from data_allocator.storage_manager import StorageManager
+
+    home = os.path.join(tmp_dir, "home")
+    config_dir = os.path.join(home, ".YuLabDataAllocator")
+    os.makedirs(config_dir)
+
+    drives = {}
+    for name in DRIVES:
+        drives[name] = os.path.join(tmp_dir, name)
+        os.makedirs(drives[name])
+
+    config_path = os.path.join(config_dir, "config.json")
+    with open(config_path, "w") as f:
+        json.dump({"drives": drives}, f)
+
+    db_path = os.path.join(config_dir, "YuLabDataAllocator.db")
+    with StorageManager(db_path) as storage:
+        storage.record_locations(synthetic_branches(size))
+
+    return home, config_path, db_path
+
+def measure(func, calls):
+    """
+    Call func(i) for i in range(calls).
+    Returns {"median_s", "min_s", "calls"} of the calls.
+    """
+    times = []
+    for i in range(calls):
+        start = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - start)
+    return {"median_s": statistics.median(times), "min_s": min(times), "calls": calls}
+
+def run_size(size, calls, cli_calls, usage_dirs):
+    """
+    Run every measurement against a database of size branches.
+    """
+    from data_allocator.allocator import Allocator
+    from data_allocator.tree_visualizer import TreeVisualizer
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        home, config_path, db_path = make_home(tmp_dir, size)
+        elapsed = time.perf_counter() - start
+        results["build_db"] = {"median_s": elapsed, "min_s": elapsed, "calls": 1}
+
+        existing = [branch_path for branch_path, _ in synthetic_branches(min(size, calls))]
+        with Allocator(config_path=config_path, db_path=db_path) as allocator:
+            results["allocate"] = measure(lambda i: allocator.allocate("bench/new{}".format(i)), calls)
+            results["get_path"] = measure(lambda i: allocator.get_path(existing[i % len(existing)]), calls)
+            results["delete_branch"] = measure(lambda i: allocator.delete_branch("bench/new{}".format(i)), calls)
+
+            visualizer = TreeVisualizer(storage_manager=allocator.storage)
+            tree = visualizer.build_tree()
+            results["build_tree"] = measure(lambda i: visualizer.build_tree(), 5)
+            results["tree2str"] = measure(lambda i: TreeVisualizer.tree2str(tree), 5)
+            results["build_tree_project"] = measure(lambda i: visualizer.build_tree("l0n{}".format(i % 10)), calls // 10)
+            results["build_tree_depth1"] = measure(lambda i: visualizer.build_tree(max_depth=1), 10)
+
+            allocator.allocate("bench/usage")
+            make_drive_tree(allocator.get_path("bench/usage"), usage_dirs, 32)
+            results["disk_usage_cold"] = measure(lambda i: allocator.calculate_branch_disk_usage("bench/usage"), 1)
+            results["disk_usage_warm"] = measure(lambda i: allocator.calculate_branch_disk_usage("bench/usage"), 3)
+
+        existing_branch = existing[0]
+        results["cli_get"] = measure(lambda i: run_cli(home, ["--no-daemon", "get", existing_branch]), cli_calls)
+        results["cli_ls_depth1"] = measure(lambda i: run_cli(home, ["--no-daemon", "ls", "--max-depth", "1"]), cli_calls)
+
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    sizes = [int(size) for size in args.sizes.split(",")]
+    report = {"meta": {"commit": git_commit(),
+                       "python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       },
+              "results": {},
+              }
+
+    for size in sizes:
+        sys.stderr.write("Running {} branches...\n".format(size))
+        results = run_size(size, args.calls, args.cli_calls, args.usage_dirs)
+        report["results"][str(size)] = results
+        for name, result in results.items():
+            sys.stdout.write("{:>9} {:<22}{:>12.3f} ms\n".format(size, name, result["median_s"] * 1e3))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+
+def compare(args):
+    """
+    Print the median time of each measurement in two result files.
+    Exits with status 1 if one got slower by more than the threshold.
+    """
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    sys.stdout.write("old: {}  new: {}\n".format(old["meta"].get("commit"), new["meta"].get("commit")))
+    sys.stdout.write("{:>9} {:<22}{:>12}{:>12}{:>9}\n".format("size", "measurement", "old (ms)", "new (ms)", "change"))
+
+    regressions = 0
+    for size, results in new["results"].items():
+        for name, result in results.items():
+            before = old["results"].get(size, {}).get(name)
+            if before is None:
+                continue
+            change = result["median_s"] / before["median_s"] - 1 if before["median_s"] else 0.0
+            flag = ""
+            if change > args.threshold:
+                flag = "  SLOWER"
+                regressions += 1
+            elif change < -args.threshold:
+                flag = "  faster"
+            sys.stdout.write("{:>9} {:<22}{:>12.3f}{:>12.3f}{:>+8.0%}{}\n".format(size,
+                                                                                 name,
+                                                                                 before["median_s"] * 1e3,
+                                                                                 result["median_s"] * 1e3,
+                                                                                 change,
+                                                                                 flag,
+                                                                                 ))
+
+    if regressions:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark allocator operations at scale.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--sizes", type=str, default="10000,100000,1000000", help="Comma-separated database sizes")
+    run_parser.add_argument("--calls", type=int, default=1000, help="Calls per per-branch measurement")
+    run_parser.add_argument("--cli-calls", type=int, default=5, dest="cli_calls", help="Runs per CLI measurement")
+    run_parser.add_argument("--usage-dirs", type=int, default=512, dest="usage_dirs", help="Directories of the disk usage tree")
+    run_parser.add_argument("--output", type=str, default=None, help="Write results to this JSON file")
+
+    compare_parser = subparsers.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument("old", type=str, help="Results of the baseline")
+    compare_parser.add_argument("new", type=str, help="Results to check")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown reported as a regression")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    elif args.command == "compare":
+        compare(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,126 @@
 
 import os
+import time
+import errno
 import shutil
+import threading
 
-import numpy as np
-
+from data_allocator import instrumentation
+from data_allocator.constants import SPACE_CHECK_TIMEOUT, SPACE_CACHE_TTL, RESERVATION_TTL, TRASH_DIR_NAME, JOURNAL_MODE
 from data_allocator.config_handler import ConfigHandler
 from data_allocator.storage_manager import StorageManager
-from data_allocator.exceptions import AllocatorException
+from data_allocator.snapshot import BranchSnapshot
+from data_allocator.path_index import PathIndex
+from data_allocator.disk_usage import DiskUsageScanner, DEFAULT_WORKERS
+from data_allocator.reaper import Reaper, deleted_name, DEFAULT_REAP_WORKERS
+from data_allocator.transfer import copy_tree, compare_trees, remove_tree, progress_counter, TransferResult, DEFAULT_COPY_WORKERS
+from data_allocator.exceptions import AllocatorException, StorageManagerException
+
+# Free-space probe thread of each mount path, kept until the next probe of
+# the path so that a hung mount is not probed by one more thread each time.
+_running_probes = {}
+_running_probes_lock = threading.Lock()
+
+def probe_free_space(drive_paths, timeout):
+    """
+    Query the free space of several drives concurrently.
+
+    Each drive is queried from its own daemon thread, so a hung mount
+    delays the result by at most timeout and never blocks exit. A drive
+    whose probe from an earlier call is still running is not probed again
+    and is unavailable until that probe returns.
+
+    Keyword arguments:
+    - drive_paths: dictionary of drive name and mount path
+    - timeout: Seconds to wait for all drives to answer.
+
+    Returns:
+    - drive2free: dictionary of drive name and free bytes, None for
+                  drives that failed or did not answer in time
+    """
+    answers = {}
+
+    def probe(drive, path):
+        try:
+            answers[drive] = int(shutil.disk_usage(path).free)
+        except OSError:
+            answers[drive] = None
+
+    threads = []
+    with _running_probes_lock:
+        for drive, path in drive_paths.items():
+            running = _running_probes.get(path)
+            if running is not None and running.is_alive():
+                continue
+            thread = threading.Thread(target=probe, args=(drive, path), daemon=True)
+            thread.start()
+            _running_probes[path] = thread
+            threads.append(thread)
+    instrumentation.count("fs.statvfs", len(threads))
+
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+
+    return {drive: answers.get(drive) for drive in drive_paths}
 
 class Allocator:
-    def __init__(self, config_path, db_path):
+    def __init__(self, config_path, db_path, snapshot_path=None):
         """
         Initialize the Allocator with ConfigHandler and StorageManager.
+        The database is opened in the config's "journal_mode" (see JOURNAL_MODE).
+
+        Keyword arguments:
+        - config_path: Path to the configuration file.
+        - db_path: Path to the database.
+        - snapshot_path: Snapshot of the records written by write_snapshot.
+                         get_path and get_paths look branches up there
+                         while it is fresh, and in the database otherwise.
         """
         self.config = ConfigHandler(config_path=config_path)
-        self.storage = StorageManager(db_path=db_path)
+        self.storage = StorageManager(db_path=db_path, 
+                                      journal_mode=self.config.get_option("journal_mode", JOURNAL_MODE), 
+                                      )
+        self.snapshot = BranchSnapshot.open(snapshot_path) if snapshot_path else None
+        self._path_index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Release the database connection held by the StorageManager.
+        """
+        self.storage.close()
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
+    @property
+    def path_index(self):
+        """
+        PathIndex over the configured drives, rebuilt when the config is reloaded.
+        """
+        drive_paths = self.config.get_drive_paths()
+        if self._path_index is None or self._path_index.drive_paths is not drive_paths:
+            self._path_index = PathIndex(drive_paths)
+        return self._path_index
 
     def make_directory(self, path):
         '''
         Create a directory if it does not exist.
         Also perform sanity checks.
         '''
-        drive_paths = self.config.get_drive_paths().values()
-        if not np.any([path.startswith(drive_path) for drive_path in drive_paths]):
+        if self.path_index.find_drive(path) is None:
             raise AllocatorException(f"[ERROR] Path '{path}' is not in any of the configured drives.")
 
+        for trash_path in self.get_trash_paths().values():
+            if path == trash_path or path.startswith(trash_path + os.sep):
+                raise AllocatorException(f"[ERROR] Path '{path}' is in the trash directory.")
+
         os.makedirs(path, exist_ok=True)
     
     def remove_directory(self, path):
@@ -32,8 +128,7 @@ class Allocator:
         Remove a directory if it exists.
         Also perform sanity checks.
         '''
-        drive_paths = self.config.get_drive_paths().values()
-        if not np.any([path.startswith(drive_path) for drive_path in drive_paths]):
+        if self.path_index.find_drive(path) is None:
             raise AllocatorException(f"[ERROR] Path '{path}' is not in any of the configured drives.")
 
         if os.path.exists(path):
@@ -41,93 +136,825 @@ class Allocator:
         else:
             raise AllocatorException(f"[ERROR] Path '{path}' does not exist.")
 
-    def check_space(self):
+    @instrumentation.timed("allocator.check_space")
+    def check_space(self, include_unavailable=False, update_cache=True):
         """
         Check available space on each drive.
+
+        Drives are queried concurrently with a timeout, and measurements
+        younger than the cache TTL are reused, so bursts of allocations do
+        not re-query every mount. Drives that fail or time out are
+        unavailable for placement.
+
+        Keyword arguments:
+        - include_unavailable: Also return unavailable drives, with None.
+        - update_cache: Store the new measurements for later calls.
+
+        Returns:
+        - space_info: dictionary of drive name and free bytes
         """
-        space_info = {}
-        for drive, path in self.config.get_drive_paths().items():
-            usage = shutil.disk_usage(path)
-            space_info[drive] = int(usage.free)
-        return space_info
+        drive_paths = self.config.get_drive_paths()
+        ttl = self.config.get_option("space_cache_ttl", SPACE_CACHE_TTL)
+        timeout = self.config.get_option("space_check_timeout", SPACE_CHECK_TIMEOUT)
+
+        now = time.time()
+        cached = self.storage.get_space_cache()
+        space_info = {drive: cached[drive][0] for drive in drive_paths
+                      if drive in cached and 0 <= now - cached[drive][1] <= ttl}
 
-    def allocate(self, branch_name):
+        stale = {drive: path for drive, path in drive_paths.items() if drive not in space_info}
+        if stale:
+            probed = probe_free_space(stale, timeout)
+            if update_cache:
+                self.storage.put_space_cache(probed, checked_at=now)
+            space_info.update(probed)
+
+        if include_unavailable:
+            return space_info
+        return {drive: free for drive, free in space_info.items() if free is not None}
+
+    def _available_space(self, space_info):
+        """
+        Free space for placement: the measured free space minus the space
+        reserved by outstanding reservations. Raises if no drive is available.
+
+        Called inside the allocation transaction, so the reservations read
+        here cannot change before the new ones are recorded.
+        """
+        if not space_info:
+            raise AllocatorException("[ERROR] No drive is available for allocation.")
+
+        reserved = self.storage.get_reserved_bytes(now=time.time())
+        return {drive: free - reserved.get(drive, 0) for drive, free in space_info.items()}
+
+    @instrumentation.timed("allocator.make_directories")
+    def _make_directories(self, path):
+        """
+        Create a directory with its missing parents.
+
+        Returns:
+        - list: The directories that did not exist before, deepest first.
+        """
+        created = []
+        parent = path
+        while parent and not os.path.exists(parent):
+            created.append(parent)
+            parent = os.path.dirname(parent)
+
+        try:
+            self.make_directory(path)
+        except OSError:
+            self._remove_created(created)
+            raise
+
+        instrumentation.count("fs.stat", len(created) + 1)
+        instrumentation.count("fs.mkdir", len(created))
+        return created
+
+    @staticmethod
+    def _remove_created(created):
+        """
+        Undo _make_directories: remove the directories it created, deepest first,
+        leaving any that something else has written into since.
+        """
+        for path in created:
+            try:
+                os.rmdir(path)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                break
+
+    def _reservation_expiry(self):
+        return time.time() + self.config.get_option("reservation_ttl", RESERVATION_TTL)
+
+    @instrumentation.timed("allocator.allocate")
+    def allocate(self, branch_name, expected_size=None):
         """
         Allocate the branch to the appropriate drive based on available space.
+
+        Keyword arguments:
+        - branch_name: The branch to allocate.
+        - expected_size: Bytes the branch is expected to grow to. The space is
+                         reserved on the chosen drive, so that allocations made
+                         before the data is written see it as used. The
+                         reservation is released when the branch's usage is
+                         measured, or when it expires.
         """
-        if self.storage.check_duplicates(branch_name):
-            raise AllocatorException(f"[ERROR] Duplicate entry for '{branch_name}' exists.")
-        
+        # querying the drives can be slow, so it is done before taking the write lock
         space_info = self.check_space()
-        target_drive = max(space_info, key=space_info.get)
-        target_path = os.path.join(self.config.get_drive_paths()[target_drive], 
-                                   branch_name, 
-                                   )
 
-        # Create the directory with all parent directories
-        self.make_directory(target_path)
+        # The record is inserted first and the branch_path primary key rejects
+        # a concurrent duplicate. The directory is made in the same transaction,
+        # so a failed mkdir leaves no record and a failed insert leaves no directory.
+        created = []
+        try:
+            with self.storage.transaction():
+                space_info = self._available_space(space_info)
+                target_drive = max(space_info, key=space_info.get)
+                if expected_size and space_info[target_drive] < expected_size:
+                    raise AllocatorException(f"[ERROR] No drive has {self.format_size(expected_size)} free for '{branch_name}'.")
+
+                target_path = os.path.join(self.config.get_drive_paths()[target_drive], 
+                                           branch_name, 
+                                           )
+
+                self.storage.record_location(branch_name, 
+                                             target_drive, 
+                                             reserved_bytes=expected_size, 
+                                             expires_at=self._reservation_expiry(), 
+                                             )
 
-        # Record the location
-        self.storage.record_location(branch_name, target_drive)
+                # Create the directory with all parent directories
+                created = self._make_directories(target_path)
+        except StorageManagerException as e:
+            self._remove_created(created)
+            raise AllocatorException(str(e)) from e
+        except BaseException:
+            self._remove_created(created)
+            raise
 
         return target_path
 
+    @instrumentation.timed("allocator.allocate_many")
+    def allocate_many(self, branch_names, expected_size=None):
+        """
+        Allocate a batch of branches with a single space check
+        and a single database transaction.
+
+        Each branch goes to the drive with the most projected free space.
+        With expected_size, that is the free space minus the expected size
+        of the branches already placed on the drive, and the space is
+        reserved as in allocate(). Without it, a drive's free space is shared
+        among the branches already placed on it in this batch, so the batch
+        is spread across the drives in proportion to their free space.
+
+        Keyword arguments:
+        - branch_names: Iterable of branch names.
+        - expected_size: Expected size in bytes of each branch.
+
+        Returns:
+        - list: Full paths of the allocated branches, in input order.
+
+        Raises:
+        - AllocatorException: If a branch is repeated in the batch or
+                              already recorded. Nothing is allocated.
+        """
+        branch_names = list(branch_names)
+        if len(set(branch_names)) != len(branch_names):
+            seen = set()
+            for branch_name in branch_names:
+                if branch_name in seen:
+                    raise AllocatorException(f"[ERROR] Duplicate entry for '{branch_name}' in batch.")
+                seen.add(branch_name)
+
+        space_info = self.check_space()
+        drive_paths = self.config.get_drive_paths()
+
+        created = []
+        try:
+            with self.storage.transaction():
+                space_info = self._available_space(space_info)
+                placed = {drive: 0 for drive in space_info}
+
+                locations = []
+                target_paths = []
+                for branch_name in branch_names:
+                    if expected_size:
+                        target_drive = max(space_info, key=lambda d: space_info[d] - placed[d] * expected_size)
+                        if space_info[target_drive] - placed[target_drive] * expected_size < expected_size:
+                            raise AllocatorException(f"[ERROR] No drive has {self.format_size(expected_size)} free for '{branch_name}'.")
+                    else:
+                        target_drive = max(space_info, key=lambda d: space_info[d] / (placed[d] + 1))
+                    placed[target_drive] += 1
+                    locations.append((branch_name, target_drive))
+                    target_paths.append(os.path.join(drive_paths[target_drive], branch_name))
+
+                # records first, as in allocate()
+                self.storage.record_locations(locations, 
+                                              reserved_bytes=expected_size, 
+                                              expires_at=self._reservation_expiry(), 
+                                              )
+                for target_path in target_paths:
+                    created.extend(self._make_directories(target_path))
+        except BaseException as e:
+            # Undo the directories made for this batch, deepest first
+            created.sort(key=lambda path: path.count(os.sep), reverse=True)
+            self._remove_created(created)
+            if isinstance(e, StorageManagerException):
+                raise AllocatorException(str(e)) from e
+            raise
+
+        return target_paths
+
+    @instrumentation.timed("allocator.get_path")
     def get_path(self, branch_name):
         """
         Retrieve the full path for a given branch name.
         """
-        drive = self.storage.get_drive(branch_name)
+        drive = None
+        if self.snapshot is not None and self.snapshot.is_fresh(self.storage.db_path):
+            drive = self.snapshot.get_drive(branch_name)
+        if drive is None:
+            drive = self.storage.get_drive(branch_name)
         if drive:
             path = os.path.join(self.config.get_drive_paths()[drive], branch_name)
             return path
         else:
             raise AllocatorException(f"[ERROR] No location found for '{branch_name}'")
 
-    def delete_branch(self, branch_name):
+    @instrumentation.timed("allocator.get_paths")
+    def get_paths(self, branch_names):
+        """
+        Retrieve the full paths of many branches with chunked IN (...) queries.
+
+        Keyword arguments:
+        - branch_names: Iterable of branch names.
+
+        Returns:
+        - list: The path of each branch, in the order of branch_names,
+                None for branches that are not recorded.
+        """
+        branch_names = list(branch_names)
+        branch2drive = {}
+        if self.snapshot is not None and self.snapshot.is_fresh(self.storage.db_path):
+            for branch_name in branch_names:
+                drive = self.snapshot.get_drive(branch_name)
+                if drive is not None:
+                    branch2drive[branch_name] = drive
+        if len(branch2drive) < len(set(branch_names)):
+            branch2drive.update(self.storage.get_drives(branch_name for branch_name in branch_names
+                                                        if branch_name not in branch2drive))
+        drive_paths = self.config.get_drive_paths()
+
+        paths = []
+        for branch_name in branch_names:
+            drive = branch2drive.get(branch_name)
+            paths.append(os.path.join(drive_paths[drive], branch_name) if drive else None)
+        return paths
+
+    @instrumentation.timed("allocator.resolve_paths")
+    def resolve_paths(self, paths):
+        """
+        Find the branch and drive owning each of many filesystem paths.
+
+        Keyword arguments:
+        - paths: Iterable of paths to files or directories, which need not exist.
+
+        Returns:
+        - list: (branch_name, drive) for each path, in the order of paths.
+                branch_name is None for paths on a drive but in no branch,
+                and both are None for paths on no configured drive.
+        """
+        return self.path_index.resolve(paths, self.storage)
+
+    @instrumentation.timed("allocator.delete_branch")
+    def delete_branch(self, branch_name, defer=False, recursive=False, workers=DEFAULT_REAP_WORKERS):
         """
         Delete the branch and its record from storage.
+
+        Keyword arguments:
+        - branch_name: The branch to delete.
+        - defer: Move the directory into the drive's trash directory and
+                 return without removing it. The trash is emptied by Reaper
+                 (the `reap` command). The trash must be on the same
+                 filesystem as the branch.
+        - recursive: Also delete every branch below branch_name, on any
+                     drive. See detach_subtree.
+        - workers: Threads removing the directories of a recursive delete.
+        """
+        if not recursive:
+            doomed = self.detach_branch(branch_name, defer=defer)
+            if not defer:
+                shutil.rmtree(doomed)
+            return
+
+        detached = self.detach_subtree(branch_name, defer=defer)
+        if not defer and detached:
+            # the directories of all drives are emptied by one pool
+            doomed = [doomed for _, _, doomed in detached]
+            result = Reaper([], workers=workers).remove(doomed)
+            if result.error_count:
+                raise AllocatorException(f"[ERROR] {result.error_count} entries of branch '{branch_name}' could not be removed.")
+
+        # directories left empty between branch_name and the branches removed,
+        # e.g. for branches on another drive than their parent
+        drive_paths = self.config.get_drive_paths()
+        for branch_path, drive, _ in detached:
+            parent = branch_path
+            while parent != branch_name:
+                parent = parent.rpartition("/")[0]
+                try:
+                    os.rmdir(os.path.join(drive_paths[drive], parent))
+                except OSError:
+                    break
+
+    def get_subtree_locations(self, branch_name):
+        """
+        Return a branch and every branch below it, with their drives.
+        The branches below are found with one range scan on branch_path.
+        branch_name itself need not be recorded.
+        """
+        locations = self.storage.get_locations2drive_under(branch_name)
+        drive = self.storage.get_drive(branch_name)
+        if drive is not None:
+            locations[branch_name] = drive
+        return locations
+
+    @staticmethod
+    def subtree_tops(locations):
+        """
+        The topmost branches on each drive of a subtree: those not nested in
+        another branch of the subtree on the same drive. Their directories
+        hold the directories of all other branches of the subtree.
+
+        Returns:
+        - list: (branch_path, drive), sorted by branch_path + "/".
+        """
+        # in the order of branch_path + "/", a branch's subtree follows it
+        tops = []
+        last_top = {}
+        for branch_path in sorted(locations, key=lambda branch_path: branch_path + "/"):
+            drive = locations[branch_path]
+            top = last_top.get(drive)
+            if top is not None and branch_path.startswith(top + "/"):
+                continue
+            last_top[drive] = branch_path
+            tops.append((branch_path, drive))
+        return tops
+
+    @instrumentation.timed("allocator.detach_subtree")
+    def detach_subtree(self, branch_name, defer=False):
+        """
+        Delete the records of a branch and of every branch below it, on any
+        drive, and rename their directories out of the way, in one transaction.
+
+        Only the topmost branch directories on each drive are renamed, as the
+        branches nested in them on the same drive go with them. Directories
+        that are already missing are skipped, so dangling records are
+        deleted too.
+
+        Keyword arguments:
+        - branch_name: The root of the subtree to delete.
+        - defer: Rename into the drives' trash directories instead of
+                 next to the branches.
+
+        Returns:
+        - list: (branch_path, drive, new path) of each directory renamed.
+
+        Raises:
+        - AllocatorException: If no branch is recorded at or below branch_name.
+        """
+        if not branch_name.strip("/"):
+            raise AllocatorException("[ERROR] A recursive delete needs a branch name.")
+
+        drive_paths = self.config.get_drive_paths()
+        renamed = []
+        try:
+            with self.storage.transaction():
+                locations = self.get_subtree_locations(branch_name)
+                if not locations:
+                    raise AllocatorException(f"[ERROR] No location found for '{branch_name}'")
+
+                tops = self.subtree_tops(locations)
+                self.storage.delete_locations_under(branch_name)
+                self.storage.delete_usage_entries_under([os.path.abspath(os.path.join(drive_paths[drive], branch_path))
+                                                         for branch_path, drive in tops])
+
+                for branch_path, drive in tops:
+                    path = os.path.join(drive_paths[drive], branch_path)
+                    if os.path.exists(path):
+                        renamed.append((branch_path, drive, self._rename_away(path, drive, defer)))
+        except BaseException as e:
+            # the commit failed after the renames, so the records are still there
+            for branch_path, drive, doomed in reversed(renamed):
+                if os.path.exists(doomed):
+                    os.rename(doomed, os.path.join(drive_paths[drive], branch_path))
+            if isinstance(e, StorageManagerException):
+                raise AllocatorException(str(e)) from e
+            raise
+
+        return renamed
+
+    @instrumentation.timed("allocator.detach_branch")
+    def detach_branch(self, branch_name, defer=False):
+        """
+        Delete the record of a branch and rename its directory out of the
+        way, leaving the removal of the directory to the caller.
+
+        The record is deleted and the directory renamed in one transaction,
+        so a concurrent allocate of the same name either fails as a duplicate
+        or gets a fresh directory, and the database is not locked while the
+        directory is emptied.
+
+        Keyword arguments:
+        - branch_name: The branch to delete.
+        - defer: Rename into the drive's trash directory instead of
+                 next to the branch.
+
+        Returns:
+        - str: Where the directory was renamed to.
+        """
+        doomed = None
+        try:
+            with self.storage.transaction():
+                path = self.get_path(branch_name)
+                drive = self.storage.get_drive(branch_name)
+                if self.path_index.find_drive(path) is None:
+                    raise AllocatorException(f"[ERROR] Path '{path}' is not in any of the configured drives.")
+                if not os.path.exists(path):
+                    raise AllocatorException(f"[ERROR] Path '{path}' does not exist.")
+
+                self.storage.delete_location(branch_name)
+                self.storage.release_reservations([branch_name])
+                self.storage.delete_usage_entries_under([os.path.abspath(path)])
+
+                doomed = self._rename_away(path, drive, defer)
+        except BaseException as e:
+            # the commit failed after the rename, so the record is still there
+            if doomed is not None and os.path.exists(doomed):
+                os.rename(doomed, path)
+            if isinstance(e, StorageManagerException):
+                raise AllocatorException(str(e)) from e
+            raise
+
+        return doomed
+
+    def _rename_away(self, path, drive, defer):
+        """
+        Rename a branch directory into the drive's trash, or with defer
+        False to a hidden sibling. Returns the new path.
+        """
+        head, name = os.path.split(path)
+        if defer:
+            doomed = self.make_trash_entry_path(drive, name)
+        else:
+            doomed = os.path.join(head, deleted_name(name))
+
+        try:
+            os.rename(path, doomed)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                raise AllocatorException(f"[ERROR] Trash '{os.path.dirname(doomed)}' is not on the same filesystem as '{path}'.")
+            raise
+        return doomed
+
+    def make_trash_entry_path(self, drive, name):
+        """
+        Return a new path in a drive's trash directory for a directory
+        called name, creating the trash directory if needed.
+        """
+        trash_path = self.get_trash_paths()[drive]
+        os.makedirs(trash_path, exist_ok=True)
+        # the time first, so the trash is reaped oldest first
+        return os.path.join(trash_path, f"{time.time_ns()}-{os.getpid()}-{name}")
+
+    def get_trash_paths(self):
+        """
+        Return the trash directory of every drive.
+
+        Returns:
+        - drive2trash: dictionary of drive name and trash directory path
+        """
+        return {drive: os.path.join(drive_path, TRASH_DIR_NAME)
+                for drive, drive_path in self.config.get_drive_paths().items()}
+
+    @instrumentation.timed("allocator.rename_subtree")
+    def rename_subtree(self, branch_name, new_name):
+        """
+        Rename a branch and every branch below it, on any drive, in one
+        transaction. branch_name itself need not be recorded.
+
+        The records are renamed by rewriting their branch_path prefix, and
+        the topmost branch directory on each drive is renamed with os.rename,
+        so the branches nested in it on the same drive go with it. Missing
+        directories are skipped. If the commit fails, the directories are
+        renamed back. Directories left empty between branch_name and the
+        branches, e.g. for branches on another drive than their parent,
+        are removed.
+
+        Keyword arguments:
+        - branch_name: The root of the subtree to rename.
+        - new_name: Its new name.
+
+        Raises:
+        - AllocatorException: If no branch is recorded at or below branch_name,
+                              a branch is recorded at or below new_name,
+                              new_name is below branch_name, a directory
+                              exists at one of the new paths, or a branch
+                              of the subtree is being moved to another drive.
+        """
+        if not branch_name.strip("/") or not new_name.strip("/"):
+            raise AllocatorException("[ERROR] A move needs a branch name and a new name.")
+        if new_name == branch_name or new_name.startswith(branch_name + "/"):
+            raise AllocatorException(f"[ERROR] Cannot move '{branch_name}' to '{new_name}', which is inside it.")
+
+        drive_paths = self.config.get_drive_paths()
+        renamed = []
+        created = []
+        try:
+            with self.storage.transaction():
+                locations = self.get_subtree_locations(branch_name)
+                if not locations:
+                    raise AllocatorException(f"[ERROR] No location found for '{branch_name}'")
+                if self.get_subtree_locations(new_name):
+                    raise AllocatorException(f"[ERROR] A branch at or below '{new_name}' exists.")
+                for branch_path, _, target, _ in self.storage.get_branch_moves():
+                    if branch_path in locations:
+                        raise AllocatorException(f"[ERROR] '{branch_path}' is being moved to '{target}', "
+                                                 f"finish that move first.")
+
+                moves = []
+                for branch_path, drive in self.subtree_tops(locations):
+                    path = os.path.join(drive_paths[drive], branch_path)
+                    if not os.path.exists(path):
+                        continue
+                    new_path = os.path.join(drive_paths[drive], new_name + branch_path[len(branch_name):])
+                    if os.path.lexists(new_path):
+                        raise AllocatorException(f"[ERROR] Path '{new_path}' exists.")
+                    moves.append((branch_path, drive, path, new_path))
+
+                self.storage.rename_locations_under(branch_name, new_name)
+                self.storage.delete_usage_entries_under([os.path.abspath(path) for _, _, path, _ in moves])
+
+                for branch_path, drive, path, new_path in moves:
+                    created.append(self._make_directories(os.path.dirname(new_path)))
+                    os.rename(path, new_path)
+                    renamed.append((branch_path, drive, path, new_path))
+        except BaseException as e:
+            # the commit failed after the renames, so the records still have the old names
+            for _, _, path, new_path in reversed(renamed):
+                if os.path.exists(new_path):
+                    os.rename(new_path, path)
+            for dirs in reversed(created):
+                self._remove_created(dirs)
+            if isinstance(e, StorageManagerException):
+                raise AllocatorException(str(e)) from e
+            raise
+
+        for branch_path, drive, _, _ in renamed:
+            parent = branch_path
+            while parent != branch_name:
+                parent = parent.rpartition("/")[0]
+                try:
+                    os.rmdir(os.path.join(drive_paths[drive], parent))
+                except OSError:
+                    break
+
+    @instrumentation.timed("allocator.move_branch")
+    def move_branch(self, branch_name, new_name=None, drive=None, workers=DEFAULT_COPY_WORKERS, 
+                    bandwidth=None, checksum=True, progress=None):
+        """
+        Rename a branch, move it to another drive, or both.
+
+        A rename is done first, with rename_subtree. A move to another drive
+        then copies the branch directory, with the branches nested in it on
+        the same drive, verifies the copy, points their records at the new
+        drive in one transaction and removes the old copy. Branches below it
+        on other drives stay where they are.
+
+        The move is recorded in the branch_moves table before the copy
+        starts. An interrupted move is finished by calling move_branch again
+        with the same drive, or by resume_moves; files that were copied
+        completely are not copied again. As with Rebalancer, the branch
+        should not be written to while it is copied.
+
+        Keyword arguments:
+        - branch_name: The branch to move.
+        - new_name: The new name of the branch. None to keep the name.
+        - drive: The drive to move the branch to. None to keep the drive.
+        - workers: Number of file copy and hashing threads.
+        - bandwidth: Cap on the copy rate in bytes per second. None for no cap.
+        - checksum: Verify the copy by SHA-256. False to compare only the file
+                    sizes, which is faster but misses corrupted contents.
+        - progress: Called with (stage, files, bytes) as files are copied
+                    ("copy") and verified ("verify"), from the worker threads.
+                    files and bytes are the totals of the stage so far.
+
+        Returns:
+        - TransferResult of the copy, empty if the drive did not change.
+
+        Raises:
+        - AllocatorException: If the branch is not recorded, the drive is not
+                              configured, the rename fails (see rename_subtree),
+                              the branch's path on the new drive exists, or
+                              the copy does not verify. A move that fails
+                              while copying stays recorded.
+        """
+        if new_name in (None, branch_name) and drive is None:
+            raise AllocatorException("[ERROR] A move needs a new name or a drive.")
+        if drive is not None:
+            if drive not in self.config.get_drive_paths():
+                raise AllocatorException(f"[ERROR] Drive '{drive}' is not configured.")
+            if self.storage.get_drive(branch_name) is None:
+                raise AllocatorException(f"[ERROR] No location found for '{branch_name}'")
+
+        if new_name not in (None, branch_name):
+            self.rename_subtree(branch_name, new_name)
+            branch_name = new_name
+
+        if drive is None:
+            return TransferResult()
+
+        try:
+            with self.storage.transaction():
+                source = self.storage.get_drive(branch_name)
+                move = next((move for move in self.storage.get_branch_moves() if move[0] == branch_name), None)
+                if move is not None and move[2] != drive:
+                    raise AllocatorException(f"[ERROR] '{branch_name}' is being moved to '{move[2]}', "
+                                             f"finish that move first.")
+                if move is None:
+                    if source == drive:
+                        return TransferResult()
+                    target_path = os.path.join(self.config.get_drive_paths()[drive], branch_name)
+                    if os.path.lexists(target_path):
+                        raise AllocatorException(f"[ERROR] Path '{target_path}' exists.")
+                    self.storage.put_branch_move(branch_name, source, drive)
+                    move = (branch_name, source, drive, "pending")
+        except StorageManagerException as e:
+            raise AllocatorException(str(e)) from e
+
+        result = self._finish_move(*move, workers=workers, bandwidth=bandwidth, checksum=checksum, progress=progress)
+        if result is None:
+            raise AllocatorException(f"[ERROR] '{branch_name}' is no longer recorded on '{move[1]}'.")
+        return result
+
+    def pending_moves(self):
+        """
+        Moves to another drive that did not finish.
+
+        Returns:
+        - list of (branch_path, source_drive, target_drive, state)
+        """
+        return self.storage.get_branch_moves()
+
+    def resume_moves(self, workers=DEFAULT_COPY_WORKERS, bandwidth=None, checksum=True, progress=None):
+        """
+        Finish the moves to another drive that were interrupted, in the order
+        they were started. See move_branch for the keyword arguments.
+
+        Yields:
+        - (branch_path, source_drive, target_drive, result) after each move,
+          where result is the TransferResult of the copy, or None if the
+          branch was deleted or moved elsewhere since and the move was dropped.
+        """
+        for branch_path, source, target, state in self.pending_moves():
+            result = self._finish_move(branch_path, source, target, state, 
+                                       workers=workers, 
+                                       bandwidth=bandwidth, 
+                                       checksum=checksum, 
+                                       progress=progress, 
+                                       )
+            yield branch_path, source, target, result
+
+    def remove_partial_copy(self, branch_path, drive):
+        """
+        Remove what an abandoned copy of a branch left on a drive. Nothing is
+        removed if the branch is now recorded on that drive, and the branches
+        recorded there below it are kept, with the directories leading to them.
+
+        Keyword arguments:
+        - branch_path: The branch that was being copied.
+        - drive: The drive it was being copied to.
         """
-        path = self.get_path(branch_name)
-        self.remove_directory(path)
-        self.storage.delete_location(branch_name)
+        storage = self.storage
+        path = os.path.join(self.config.get_drive_paths()[drive], branch_path)
+        if storage.get_drive(branch_path) == drive or not os.path.isdir(path):
+            return
+
+        prefix_len = len(branch_path) + 1
+        exclude = {nested[prefix_len:] for nested, nested_drive in storage.get_locations2drive_under(branch_path).items()
+                   if nested_drive == drive}
+        remove_tree(path, exclude=exclude)
 
-    def calculate_branch_disk_usage(self, branch_name):
+    def _finish_move(self, branch_path, source, target, state, workers, bandwidth, checksum, progress):
+        """
+        Carry out a recorded move from its state. Returns the TransferResult
+        of the copy, or None if the branch is no longer on the source drive,
+        in which case its partial copy is removed.
+        """
+        storage = self.storage
+        drive_paths = self.config.get_drive_paths()
+        source_path = os.path.join(drive_paths[source], branch_path)
+        target_path = os.path.join(drive_paths[target], branch_path)
+        result = TransferResult()
+
+        if state == "pending":
+            if storage.get_drive(branch_path) != source:
+                self.remove_partial_copy(branch_path, target)
+                storage.delete_branch_move(branch_path)
+                return None
+
+            result = copy_tree(source_path, 
+                               target_path, 
+                               workers=workers, 
+                               bandwidth=bandwidth, 
+                               progress=progress_counter(progress, "copy"), 
+                               )
+            mismatched = compare_trees(source_path, 
+                                       target_path, 
+                                       workers=workers, 
+                                       checksum=checksum, 
+                                       progress=progress_counter(progress, "verify"), 
+                                       )
+            if mismatched:
+                raise AllocatorException(f"[ERROR] Copy of '{branch_path}' on '{target}' differs at '{mismatched[0]}' "
+                                         f"and {len(mismatched) - 1} more path(s).")
+
+            try:
+                storage.switch_branch_move(branch_path, source, target)
+            except StorageManagerException as e:
+                raise AllocatorException(str(e)) from e
+
+        # switched: the records point at the copy, so the old one can go
+        if os.path.isdir(source_path):
+            remove_tree(source_path)
+        storage.delete_usage_entries_under([os.path.abspath(source_path)])
+        storage.delete_branch_move(branch_path)
+        return result
+
+    @instrumentation.timed("allocator.measure_branch_disk_usage")
+    def measure_branch_disk_usage(self, branch_name, workers=DEFAULT_WORKERS, breakdown_depth=None, 
+                                  use_cache=False, refresh=False, max_age=None, release=True):
+        """
+        Scan a branch directory in parallel and return its usage totals.
+
+        Keyword arguments:
+        - branch_name: The branch name as stored in the database.
+        - workers: Number of scanner threads.
+        - breakdown_depth: Also total each directory up to this depth.
+        - use_cache: Reuse the per-directory totals stored by earlier scans
+                     for directories whose mtime has not changed. Faster,
+                     but a file that grows in place does not change its
+                     directory's mtime, so the totals can be stale.
+        - refresh: Walk everything and rewrite the cache.
+        - max_age: Return the stored branch totals without touching the
+                   filesystem if they are at most this many seconds old.
+        - release: Release the space reserved for the branch, which is
+                   counted in the drive's free space once it is written.
+
+        Returns:
+        - DiskUsageResult: Apparent and allocated sizes, counts and breakdown.
+
+        Raises:
+        - AllocatorException: If the branch is not found in the database 
+                              or path is not a directory.
+        """
+        path = os.path.abspath(self.get_path(branch_name))
+
+        if max_age is None or refresh or not use_cache:
+            if not os.path.exists(path):
+                raise AllocatorException(f"[ERROR] Path '{path}' does not exist.")
+            
+            if not os.path.isdir(path):
+                raise AllocatorException(f"[ERROR] Path '{path}' is not a directory.")
+
+        scanner = DiskUsageScanner(workers=workers, 
+                                   breakdown_depth=breakdown_depth, 
+                                   cache=self.storage if use_cache else None, 
+                                   refresh=refresh, 
+                                   )
+        usage = scanner.scan(path, max_age=max_age)
+
+        # the data is on disk now, so it shows up in the drive's free space
+        if release:
+            self.storage.release_reservations([branch_name])
+        return usage
+
+    def calculate_branch_disk_usage(self, branch_name, allocated=False):
         """
         Calculate the total disk usage of a branch directory.
 
         Keyword arguments:
         - branch_name: The branch name as stored in the database.
+        - allocated: Return allocated instead of apparent size.
 
         Returns:
-        - int: Total size in bytes.
+        - int: Total size in bytes. Hard-linked files are counted once.
         
         Raises:
         - AllocatorException: If the branch is not found in the database 
                               or path is not a directory.
         """
-        path = self.get_path(branch_name)
-        
-        if not os.path.exists(path):
-            raise AllocatorException(f"[ERROR] Path '{path}' does not exist.")
-        
-        if not os.path.isdir(path):
-            raise AllocatorException(f"[ERROR] Path '{path}' is not a directory.")
+        return self.measure_branch_disk_usage(branch_name).size(allocated=allocated)
         
-        total_size = 0
+    @staticmethod
+    def parse_size(size_str):
+        """
+        Parse a size such as "512", "10K", "1.5GB" or "2T" into bytes.
+        Units are powers of 1024, as in format_size.
+        """
+        units = {"": 1, "B": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4, "P": 1024**5}
+        text = size_str.strip().upper()
+        if text.endswith("B") and len(text) > 1 and text[-2] in units:
+            text = text[:-1]
+        number = text.rstrip("BKMGTP")
+        unit = text[len(number):]
         try:
-            for dirpath, dirnames, filenames in os.walk(path):
-                for filename in filenames:
-                    filepath = os.path.join(dirpath, filename)
-                    try:
-                        total_size += os.path.getsize(filepath)
-                    except (OSError, IOError):
-                        # Skip files that can't be accessed
-                        pass
-        except (OSError, IOError) as e:
-            raise AllocatorException(f"[ERROR] Unable to calculate disk usage for '{path}': {e}")
-        
-        return total_size
-        
+            return int(float(number) * units[unit])
+        except (ValueError, KeyError):
+            raise AllocatorException(f"[ERROR] Invalid size '{size_str}'.")
+
     @staticmethod
     def format_size(size):
         """
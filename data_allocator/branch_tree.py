@@ -0,0 +1,162 @@
+# data_allocator/branch_tree.py
+
+from data_allocator.exceptions import TreeVisualizerException
+
+class BranchNode:
+    """
+    A node of a BranchTree. Leaves keep children as None
+    so that the many leaf nodes of a large namespace stay small.
+    """
+    __slots__ = ("name", "parent", "children")
+
+    def __init__(self, name, parent=None):
+        self.name = name
+        self.parent = parent
+        self.children = None
+
+    @property
+    def path(self):
+        """
+        Full branch path of the node.
+        """
+        names = []
+        node = self
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        if node.name:
+            names.append(node.name)
+        return "/".join(reversed(names))
+
+class BranchTree:
+    def __init__(self, root_branch=""):
+        """
+        Initialize an empty tree rooted at root_branch.
+
+        Keyword arguments:
+        - root_branch: Full path of the root node, "" for the whole namespace.
+        """
+        self.root = BranchNode(root_branch)
+        self.root_branch = root_branch
+
+    @classmethod
+    def _from_node(cls, node):
+        """
+        Make a tree whose root is an existing node. The nodes are shared.
+        """
+        tree = cls.__new__(cls)
+        tree.root = node
+        tree.root_branch = node.path
+        return tree
+
+    def _relative_names(self, branch_path):
+        """
+        Split a branch path into its components below the root.
+        """
+        if not self.root_branch:
+            return branch_path.split("/") if branch_path else []
+        if branch_path == self.root_branch:
+            return []
+        if not branch_path.startswith(self.root_branch + "/"):
+            raise TreeVisualizerException(f"Branch '{branch_path}' is not under '{self.root_branch}'")
+        return branch_path[len(self.root_branch) + 1:].split("/")
+
+    def insert(self, branch_path):
+        """
+        Add a branch and any missing ancestors. Returns its node.
+        """
+        node = self.root
+        for name in self._relative_names(branch_path):
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = BranchNode(name, node)
+            node = child
+        return node
+
+    def find(self, branch_path):
+        """
+        Return the node for a branch, or None if it is not in the tree.
+        """
+        try:
+            names = self._relative_names(branch_path)
+        except TreeVisualizerException:
+            return None
+
+        node = self.root
+        for name in names:
+            if node.children is None or name not in node.children:
+                return None
+            node = node.children[name]
+        return node
+
+    def has_node(self, branch_path):
+        return self.find(branch_path) is not None
+
+    def has_edge(self, parent_path, child_path):
+        child = self.find(child_path)
+        return child is not None and child is not self.root and child.parent.path == parent_path
+
+    def subtree(self, branch_path):
+        """
+        Return the subtree rooted at a branch. Nodes are shared, not copied.
+        """
+        node = self.find(branch_path)
+        if node is None:
+            raise TreeVisualizerException(f"Branch '{branch_path}' is not in the tree")
+        return BranchTree._from_node(node)
+
+    def walk(self):
+        """
+        Yield (branch_path, node, level) for every node in depth-first
+        order with children sorted by name. The root is at level 0.
+        """
+        stack = [(self.root, self.root_branch, 0)]
+        while stack:
+            node, path, level = stack.pop()
+            yield path, node, level
+
+            if node.children:
+                prefix = path + "/" if path else ""
+                # push in reverse so the smallest child is popped first
+                for name in sorted(node.children, reverse=True):
+                    stack.append((node.children[name], prefix + name, level + 1))
+
+    def descendant_count(self, branch_path=None):
+        """
+        Number of nodes below a branch (the root by default).
+        """
+        node = self.root if branch_path is None else self.find(branch_path)
+        if node is None:
+            raise TreeVisualizerException(f"Branch '{branch_path}' is not in the tree")
+
+        count = 0
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                count += len(node.children)
+                stack.extend(node.children.values())
+        return count
+
+    def __len__(self):
+        return self.descendant_count() + 1
+
+    def __contains__(self, branch_path):
+        return self.has_node(branch_path)
+
+    def to_networkx(self):
+        """
+        Convert the tree to a NetworkX DiGraph keyed by full branch path.
+        """
+        import networkx as nx
+
+        graph = nx.DiGraph()
+        graph.add_node(self.root_branch)
+        paths = {}
+        for path, node, _ in self.walk():
+            paths[node] = path
+            if node is not self.root:
+                graph.add_edge(paths[node.parent], path)
+        return graph
@@ -0,0 +1,83 @@
+# data_allocator/client.py
+
+# Imported by every CLI call, so it only uses modules the interpreter
+# loads anyway and the exceptions module.
+
+import json
+import socket
+
+from data_allocator import exceptions
+
+# Seconds to wait for the daemon to accept a connection or to answer a request.
+DAEMON_TIMEOUT = 10.0
+
+class DaemonClient:
+    def __init__(self, sock):
+        self._sock = sock
+        self._reader = sock.makefile("rb")
+
+    @classmethod
+    def connect(cls, socket_path, timeout=DAEMON_TIMEOUT):
+        """
+        Connect to the daemon serving on socket_path.
+
+        Keyword arguments:
+        - socket_path: Path of the daemon's Unix socket.
+        - timeout: Seconds to wait for the connection and for each answer.
+
+        Returns:
+        - DaemonClient, or None if no daemon is running there or it does
+          not accept the connection in time.
+        """
+        if not hasattr(socket, "AF_UNIX"):
+            return None
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            sock.close()
+            return None
+        return cls(sock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._reader.close()
+        self._sock.close()
+
+    def call(self, command, **args):
+        """
+        Run a command in the daemon.
+
+        Returns:
+        - The command's result.
+
+        Raises:
+        - The exception the command raised in the daemon, as the class of
+          the same name from data_allocator.exceptions, or AllocatorException.
+        - DaemonTimeoutException: If the daemon does not answer in time.
+          The command may still be carried out.
+        """
+        request = json.dumps({"command": command, "args": args}).encode() + b"\n"
+        try:
+            self._sock.sendall(request)
+            line = self._reader.readline()
+        except socket.timeout as e:
+            raise exceptions.DaemonTimeoutException(f"[ERROR] The daemon did not answer '{command}' "
+                                                    f"within {self._sock.gettimeout()} s.") from e
+        if not line:
+            raise exceptions.AllocatorException("[ERROR] The daemon closed the connection.")
+
+        response = json.loads(line)
+        if not response["ok"]:
+            exception_class = getattr(exceptions, response.get("error_type", ""), exceptions.AllocatorException)
+            if not (isinstance(exception_class, type) and issubclass(exception_class, Exception)):
+                exception_class = exceptions.AllocatorException
+            raise exception_class(response["error"])
+        return response["result"]
@@ -3,6 +3,7 @@
 import os
 import json
 
+from data_allocator import instrumentation
 from data_allocator.constants import CONFIG_PATH
 from data_allocator.exceptions import ConfigHandlerException
 
@@ -16,6 +17,7 @@ class ConfigHandler:
         self.load_config(config_path=config_path)
         self.validate_paths()
 
+    @instrumentation.timed("config.load_config")
     def load_config(self, config_path):
         """
         Loads the configuration from the specified CONFIG_PATH.
@@ -28,6 +30,7 @@ class ConfigHandler:
         except json.JSONDecodeError:
             raise json.JSONDecodeError("[ERROR] Invalid JSON format in the configuration file {}.")
 
+    @instrumentation.timed("config.validate_paths")
     def validate_paths(self):
         """
         Validates the mounted paths specified in the configuration.
@@ -44,6 +47,12 @@ class ConfigHandler:
         """
         return self._config.get("drives", {})
 
+    def get_option(self, name, default=None):
+        """
+        Returns an optional top-level setting from the configuration.
+        """
+        return self._config.get(name, default)
+
     def reload_config(self):
         """
         Reloads the configuration at runtime.
@@ -2,3 +2,29 @@
 import os
 
 CONFIG_PATH=os.path.join(os.environ.get("HOME"), ".YuLabDataAllocatorRC.json")
+
+# Seconds to wait for a drive to answer a free-space query
+# before treating it as unavailable (config key "space_check_timeout").
+SPACE_CHECK_TIMEOUT = 5.0
+
+# Seconds a free-space measurement is reused by later allocations
+# (config key "space_cache_ttl").
+SPACE_CACHE_TTL = 10.0
+
+# Seconds before an unreleased space reservation made with an expected
+# branch size stops counting against its drive (config key "reservation_ttl").
+RESERVATION_TTL = 24 * 3600.0
+
+# SQLite journal mode of the database (config key "journal_mode"). The
+# rollback journal works for a database shared by several hosts over NFS.
+# "WAL" lets readers run alongside a writer, but only on one host, as its
+# index lives in shared memory.
+JOURNAL_MODE = "DELETE"
+
+# Directory at the root of every drive that `delete --defer` moves branches
+# into, and that `reap` empties.
+TRASH_DIR_NAME = ".allocator_trash"
+
+# A branch directory being deleted is first renamed to the hidden sibling
+# ".<name>.deleted-<pid>-<time>", and removed from there.
+DELETED_INFIX = ".deleted-"
@@ -0,0 +1,167 @@
+# data_allocator/daemon.py
+
+import os
+import json
+import shutil
+import socket
+import threading
+import socketserver
+
+from data_allocator.allocator import Allocator
+from data_allocator.tree_visualizer import TreeVisualizer
+from data_allocator.exceptions import AllocatorException
+
+class AllocatorService:
+    def __init__(self, config_path, db_path):
+        """
+        Initialize the state a daemon keeps between requests: the Allocator
+        with its parsed config and open database connection, and an
+        in-memory index of every branch and its drive.
+
+        The index is reloaded when another process commits to the database
+        (SQLite's data_version changes), and the config when its file
+        changes, so in-process commands run next to the daemon stay visible.
+
+        Keyword arguments:
+        - config_path: Path to the configuration file.
+        - db_path: Path to the database.
+        """
+        self.config_path = config_path
+        self.allocator = Allocator(config_path=config_path, db_path=db_path)
+        self._lock = threading.Lock()
+        self._config_mtime_ns = os.stat(config_path).st_mtime_ns
+        self._data_version = None
+        self._index = {}
+
+    def close(self):
+        self.allocator.close()
+
+    def _refresh(self):
+        """
+        Reload the config and the index if they changed.
+        """
+        mtime_ns = os.stat(self.config_path).st_mtime_ns
+        if mtime_ns != self._config_mtime_ns:
+            self.allocator.config.reload_config()
+            self._config_mtime_ns = mtime_ns
+
+        data_version = self.allocator.storage.get_data_version()
+        if data_version != self._data_version:
+            self._index = self.allocator.storage.get_all_locations2drive()
+            self._data_version = data_version
+
+    def get(self, branch_name):
+        with self._lock:
+            self._refresh()
+            drive = self._index.get(branch_name)
+            if drive is None:
+                raise AllocatorException(f"[ERROR] No location found for '{branch_name}'")
+            return os.path.join(self.allocator.config.get_drive_paths()[drive], branch_name)
+
+    def allocate(self, branch_name, expected_size=None):
+        size = Allocator.parse_size(expected_size) if expected_size else None
+        with self._lock:
+            self._refresh()
+            path = self.allocator.allocate(branch_name, expected_size=size)
+            # our own commits do not change data_version
+            self._index[branch_name] = self.allocator.storage.get_drive(branch_name)
+        return path
+
+    def delete(self, branch_name, defer=False):
+        with self._lock:
+            self._refresh()
+            doomed = self.allocator.detach_branch(branch_name, defer=defer)
+            self._index.pop(branch_name, None)
+
+        # other requests are served while the directory is emptied
+        if not defer:
+            shutil.rmtree(doomed)
+
+    def ls(self, root="", max_depth=None, short_tree=False):
+        with self._lock:
+            self._refresh()
+            visualizer = TreeVisualizer(storage_manager=self.allocator.storage)
+            tree = visualizer.build_tree(root_branch=root, max_depth=max_depth)
+        return TreeVisualizer.tree2str(tree, short_tree=short_tree)
+
+    def handle(self, request):
+        """
+        Run one request and return the response.
+
+        Keyword arguments:
+        - request: {"command": name, "args": {keyword arguments}}
+
+        Returns:
+        - {"ok": True, "result": ...} or
+          {"ok": False, "error": message, "error_type": exception class name}
+        """
+        commands = {"get": self.get,
+                    "allocate": self.allocate,
+                    "delete": self.delete,
+                    "ls": self.ls,
+                    "ping": lambda: "pong",
+                    }
+        try:
+            command = commands.get(request.get("command"))
+            if command is None:
+                raise AllocatorException(f"[ERROR] Unknown command '{request.get('command')}'.")
+            result = command(**request.get("args", {}))
+        except Exception as e:
+            return {"ok": False, "error": str(e), "error_type": type(e).__name__}
+
+        return {"ok": True, "result": result}
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        """
+        Serve JSON requests, one per line, until the client disconnects.
+        """
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {"ok": False, "error": f"[ERROR] Invalid request: {e}", "error_type": "ValueError"}
+            else:
+                if isinstance(request, dict) and request.get("command") == "shutdown":
+                    self.wfile.write(b'{"ok": true, "result": null}\n')
+                    self.server.shutdown()
+                    return
+                response = self.server.service.handle(request)
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+class AllocatorDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, config_path, db_path):
+        """
+        Initialize a daemon serving an AllocatorService on a Unix domain
+        socket. Only the owner of the socket may connect.
+
+        Raises:
+        - AllocatorException: If another daemon is serving on socket_path.
+        """
+        if os.path.exists(socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                # left behind by a daemon that did not shut down cleanly
+                os.remove(socket_path)
+            else:
+                raise AllocatorException(f"[ERROR] A daemon is already serving on '{socket_path}'.")
+            finally:
+                probe.close()
+
+        self.socket_path = socket_path
+        self.service = AllocatorService(config_path=config_path, db_path=db_path)
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self):
+        super().server_close()
+        self.service.close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
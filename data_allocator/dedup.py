@@ -0,0 +1,428 @@
+# data_allocator/dedup.py
+
+import os
+import filecmp
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from data_allocator import instrumentation
+
+DEFAULT_DEDUP_WORKERS = 16
+
+# Bytes hashed at each end of a file for its partial hash. Files of at
+# most twice this size are hashed whole, so their partial hash is final.
+PARTIAL_BLOCK_SIZE = 64 * 1024
+
+# Bytes read per call when a file is hashed whole.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+class DedupResult:
+    def __init__(self):
+        """
+        Findings of Deduplicator.scan.
+
+        - groups: (size, full_hash, files) of each set of identical files held
+                  in at least two inodes, most reclaimable space first. files
+                  is a list of (drive, branch_path, path, stat_result), sorted
+                  by path. Hard links of one inode are all listed.
+        - file_count: Number of files walked.
+        - dir_count: Number of directories walked.
+        - error_count: Number of entries that could not be read, or that
+                       changed while they were hashed, and were skipped.
+        - partial_hashes: Partial hashes computed.
+        - full_hashes: Full hashes computed.
+        - cache_hits: Hashes taken from the hash cache.
+        - bytes_hashed: Bytes read to compute hashes.
+        """
+        self.groups = []
+        self.file_count = 0
+        self.dir_count = 0
+        self.error_count = 0
+        self.partial_hashes = 0
+        self.full_hashes = 0
+        self.cache_hits = 0
+        self.bytes_hashed = 0
+
+    @staticmethod
+    def copies(files):
+        """
+        Number of distinct inodes among the files of a group.
+        """
+        return len({(st.st_dev, st.st_ino) for _, _, _, st in files})
+
+    def reclaimable_bytes(self):
+        """
+        Bytes freed if every group were reduced to one inode.
+        """
+        return sum(size * (self.copies(files) - 1) for size, _, files in self.groups)
+
+class LinkResult:
+    def __init__(self):
+        """
+        Totals of Deduplicator.hardlink.
+
+        - files_linked: Paths replaced by a hard link.
+        - bytes_reclaimed: Bytes of the inodes whose last link was replaced.
+        - skipped: Paths left alone because they changed since the scan, differ
+                   from the file kept, or have another owner or mode.
+        - error_count: Paths that could not be replaced.
+        """
+        self.files_linked = 0
+        self.bytes_reclaimed = 0
+        self.skipped = 0
+        self.error_count = 0
+
+def _list_directory(path):
+    """
+    List one directory. Runs in a worker thread.
+
+    Returns:
+    - (files, subdirs, errors) where files holds (name, stat_result) of the
+      regular files and subdirs the names of the subdirectories. Symbolic
+      links are skipped.
+    """
+    files = []
+    subdirs = []
+    errors = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append((entry.name, entry.stat(follow_symlinks=False)))
+            except OSError:
+                errors += 1
+    return files, subdirs, errors
+
+def _unchanged(st, f):
+    """
+    Whether an open file still has the size and mtime of st.
+    """
+    current = os.fstat(f.fileno())
+    return current.st_size == st.st_size and current.st_mtime_ns == st.st_mtime_ns
+
+def partial_hash(path, st, block_size=PARTIAL_BLOCK_SIZE):
+    """
+    SHA-256 of the size and of the first and last block_size bytes of a file,
+    or of the whole file if it is at most two blocks long. Runs in a worker thread.
+
+    Returns:
+    - (digest, bytes read), digest None if the file changed since st was taken.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        if st.st_size <= 2 * block_size:
+            data = f.read()
+        else:
+            digest.update(str(st.st_size).encode() + b"\0")
+            data = f.read(block_size)
+            f.seek(-block_size, os.SEEK_END)
+            data += f.read(block_size)
+        digest.update(data)
+        if not _unchanged(st, f):
+            return None, len(data)
+    return digest.hexdigest(), len(data)
+
+def full_hash(path, st):
+    """
+    SHA-256 of a whole file. Runs in a worker thread.
+
+    Returns:
+    - (digest, bytes read), digest None if the file changed since st was taken.
+    """
+    digest = hashlib.sha256()
+    read = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            read += len(chunk)
+        if not _unchanged(st, f):
+            return None, read
+    return digest.hexdigest(), read
+
+class Deduplicator:
+    def __init__(self, allocator, workers=DEFAULT_DEDUP_WORKERS, min_size=1, use_cache=True,
+                 block_size=PARTIAL_BLOCK_SIZE):
+        """
+        Initialize a search for identical files across the registered branches.
+
+        The branch directories of all drives are listed in parallel and the
+        files bucketed by size. Only sizes shared by two or more inodes are
+        read: first a partial hash of the head and tail blocks, then, for
+        files whose partial hashes still collide, a full hash. Hard links
+        of one inode are read once.
+
+        Hashes are cached in the hash_cache table by (st_dev, st_ino) and are
+        reused while the file's mtime and size are unchanged, so a rerun only
+        reads new and changed files. st_dev can change when a network drive
+        is remounted, which costs a rehash but gives no wrong matches.
+
+        Keyword arguments:
+        - allocator: Allocator giving access to the config and the database.
+        - workers: Number of listing and hashing threads.
+        - min_size: Smallest file size considered, in bytes.
+        - use_cache: Read and update the hash cache.
+        - block_size: Bytes hashed at each end of a file for the partial hash.
+        """
+        self.allocator = allocator
+        self.workers = workers
+        self.min_size = max(min_size, 1)
+        self.use_cache = use_cache
+        self.block_size = block_size
+
+    def _walk(self, pool, root_branch, result):
+        """
+        List the directories of the branches at and below root_branch.
+
+        Returns:
+        - dictionary of size and the list of (drive, branch_path, path, stat_result)
+          of the files of that size. Each file is attributed to the deepest
+          branch recorded on its drive that contains it.
+        """
+        locations = self.allocator.get_subtree_locations(root_branch)
+        drive_paths = self.allocator.config.get_drive_paths()
+        registered = set(locations.items())
+
+        by_size = {}
+        pending = {}
+        for branch_path, drive in self.allocator.subtree_tops(locations):
+            path = os.path.join(drive_paths[drive], branch_path)
+            if os.path.isdir(path):
+                pending[pool.submit(_list_directory, path)] = (drive, branch_path, path, branch_path)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                drive, rel_path, path, owner = pending.pop(future)
+                try:
+                    files, subdirs, errors = future.result()
+                except OSError:
+                    result.error_count += 1
+                    continue
+
+                instrumentation.count("fs.scandir")
+                result.dir_count += 1
+                result.error_count += errors
+                result.file_count += len(files)
+                for name, st in files:
+                    if st.st_size >= self.min_size:
+                        by_size.setdefault(st.st_size, []).append((drive, owner, os.path.join(path, name), st))
+
+                for name in subdirs:
+                    child = rel_path + "/" + name
+                    child_owner = child if (child, drive) in registered else owner
+                    child_path = os.path.join(path, name)
+                    pending[pool.submit(_list_directory, child_path)] = (drive, child, child_path, child_owner)
+
+        return by_size
+
+    def _hash(self, pool, inodes, kind, cached, result, cache_rows):
+        """
+        Hash one file of each inode, taking valid hashes from cached.
+
+        Keyword arguments:
+        - inodes: dictionary of (st_dev, st_ino) and the files of that inode.
+        - kind: "partial" or "full".
+        - cached: get_hash_entries of the inodes.
+        - cache_rows: dictionary of (st_dev, st_ino) and the hash cache row
+                      to write, updated in place.
+
+        Returns:
+        - dictionary of (st_dev, st_ino) and digest. Inodes that could not be
+          read or changed are left out.
+        """
+        digests = {}
+        futures = {}
+        for key, files in inodes.items():
+            path, st = files[0][2], files[0][3]
+            entry = cached.get(key)
+            if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size):
+                digest = entry[2] if kind == "partial" else entry[3]
+                if digest is not None:
+                    digests[key] = digest
+                    result.cache_hits += 1
+                    continue
+
+            if kind == "partial":
+                futures[pool.submit(partial_hash, path, st, self.block_size)] = key
+            else:
+                futures[pool.submit(full_hash, path, st)] = key
+
+        for future, key in futures.items():
+            try:
+                digest, read = future.result()
+            except OSError:
+                digest, read = None, 0
+            result.bytes_hashed += read
+            instrumentation.count("fs.bytes_hashed", read)
+            if digest is None:
+                result.error_count += 1
+                continue
+
+            digests[key] = digest
+            st = inodes[key][0][3]
+            row = cache_rows.setdefault(key, [key[0], key[1], st.st_mtime_ns, st.st_size, None, None])
+            if kind == "partial":
+                result.partial_hashes += 1
+                row[4] = digest
+            else:
+                result.full_hashes += 1
+                row[5] = digest
+
+        # a partial hash of a short file covers all of it
+        if kind == "partial":
+            for key, digest in digests.items():
+                if inodes[key][0][3].st_size <= 2 * self.block_size:
+                    row = cache_rows.get(key)
+                    if row is not None:
+                        row[5] = digest
+
+        return digests
+
+    @instrumentation.timed("dedup.scan")
+    def scan(self, root_branch=""):
+        """
+        Find the files held more than once at and below root_branch.
+
+        Keyword arguments:
+        - root_branch: The branch to search, "" for every branch.
+
+        Returns:
+        - DedupResult
+        """
+        result = DedupResult()
+        storage = self.allocator.storage
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            by_size = self._walk(pool, root_branch or "", result)
+
+            # stage 1: sizes shared by at least two inodes
+            candidates = {}
+            for size, files in by_size.items():
+                inodes = {}
+                for file in files:
+                    inodes.setdefault((file[3].st_dev, file[3].st_ino), []).append(file)
+                if len(inodes) > 1:
+                    candidates.update(inodes)
+            del by_size
+
+            cached = storage.get_hash_entries(candidates) if self.use_cache else {}
+            cache_rows = {}
+
+            # stage 2: partial hashes
+            partial = self._hash(pool, candidates, "partial", cached, result, cache_rows)
+            groups = {}
+            for key, digest in partial.items():
+                groups.setdefault((candidates[key][0][3].st_size, digest), []).append(key)
+
+            # stage 3: full hashes of the files whose partial hashes still collide
+            short = {}
+            colliding = {}
+            for (size, digest), keys in groups.items():
+                if len(keys) < 2:
+                    continue
+                for key in keys:
+                    if size <= 2 * self.block_size:
+                        short[key] = digest
+                    else:
+                        colliding[key] = candidates[key]
+            full = self._hash(pool, colliding, "full", cached, result, cache_rows)
+            full.update(short)
+
+        if self.use_cache and cache_rows:
+            for key, row in cache_rows.items():
+                entry = cached.get(key)
+                if entry is not None and entry[:2] == tuple(row[2:4]):
+                    # keep the half of a valid row that was not recomputed
+                    row[4] = row[4] or entry[2]
+                    row[5] = row[5] or entry[3]
+            storage.put_hash_entries(cache_rows.values())
+
+        duplicates = {}
+        for key, digest in full.items():
+            duplicates.setdefault((candidates[key][0][3].st_size, digest), []).append(key)
+
+        for (size, digest), keys in duplicates.items():
+            if len(keys) > 1:
+                files = sorted((file for key in keys for file in candidates[key]), key=lambda file: file[2])
+                result.groups.append((size, digest, files))
+        result.groups.sort(key=lambda group: (-group[0] * (DedupResult.copies(group[2]) - 1), group[2][0][2]))
+        return result
+
+    @instrumentation.timed("dedup.hardlink")
+    def hardlink(self, result):
+        """
+        Replace the duplicate copies on each drive with hard links to one copy.
+
+        Within a group, the files on one drive and filesystem are linked to
+        the inode with the most links (the first path on a tie). Before a
+        path is replaced, it and the file kept are checked against the scan
+        and compared byte by byte, and they must have the same owner, group
+        and mode. The new link is made next to the path and renamed over it,
+        so the path always names one of the two files. Copies on different
+        drives are not touched.
+
+        Keyword arguments:
+        - result: DedupResult of scan.
+
+        Returns:
+        - LinkResult
+        """
+        linked = LinkResult()
+        for size, _, files in result.groups:
+            by_device = {}
+            for file in files:
+                by_device.setdefault((file[0], file[3].st_dev), []).append(file)
+
+            for device_files in by_device.values():
+                inodes = {}
+                for file in device_files:
+                    inodes.setdefault(file[3].st_ino, []).append(file)
+                if len(inodes) < 2:
+                    continue
+
+                keep = max(inodes.values(), key=lambda files: files[0][3].st_nlink)[0]
+                for inode, inode_files in inodes.items():
+                    if inode == keep[3].st_ino:
+                        continue
+                    replaced = sum(self._link(keep, file, linked) for file in inode_files)
+                    if replaced and replaced == inode_files[0][3].st_nlink:
+                        linked.bytes_reclaimed += size
+
+        return linked
+
+    @staticmethod
+    def _link(keep, file, linked):
+        """
+        Replace file with a hard link to keep. Returns 1 if it was replaced.
+        """
+        def same(path, st):
+            current = os.lstat(path)
+            return (current.st_ino, current.st_size, current.st_mtime_ns) == (st.st_ino, st.st_size, st.st_mtime_ns)
+
+        keep_path, keep_st = keep[2], keep[3]
+        path, st = file[2], file[3]
+        try:
+            if (not same(keep_path, keep_st) or not same(path, st)
+                    or (st.st_mode, st.st_uid, st.st_gid) != (keep_st.st_mode, keep_st.st_uid, keep_st.st_gid)
+                    or not filecmp.cmp(keep_path, path, shallow=False)):
+                linked.skipped += 1
+                return 0
+
+            tmp_path = "{}.dedup-{}".format(path, os.getpid())
+            os.link(keep_path, tmp_path)
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            linked.error_count += 1
+            return 0
+
+        linked.files_linked += 1
+        return 1
@@ -0,0 +1,306 @@
+# data_allocator/disk_usage.py
+
+import os
+import json
+import stat
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from data_allocator import instrumentation
+from data_allocator.exceptions import AllocatorException
+
+DEFAULT_WORKERS = 16
+
+# A directory changed within this window of its last scan may have been
+# modified again in the same mtime tick, so its cached listing is not trusted.
+RACY_WINDOW_NS = 2 * 10**9
+
+class DiskUsageResult:
+    def __init__(self):
+        """
+        Totals of a disk usage scan.
+
+        - apparent_size: Sum of file sizes in bytes (st_size).
+        - allocated_size: Bytes of storage allocated to the files (st_blocks * 512).
+        - file_count: Number of files, hard links counted once.
+        - dir_count: Number of directories, including the root.
+        - error_count: Number of entries that could not be read and were skipped.
+        - by_depth: With a breakdown depth, maps the path of every directory
+                    at most that deep, relative to the root ("" for the root),
+                    to its (apparent_size, allocated_size) including subdirectories.
+        - by_owner: With owners, maps each owner (and "" for the root) to the
+                    (apparent_size, allocated_size) of the files it owns.
+        """
+        self.apparent_size = 0
+        self.allocated_size = 0
+        self.file_count = 0
+        self.dir_count = 0
+        self.error_count = 0
+        self.by_depth = {}
+        self.by_owner = {}
+
+    def size(self, allocated=False):
+        """
+        Return the allocated or the apparent size.
+        """
+        return self.allocated_size if allocated else self.apparent_size
+
+def _allocated_bytes(st):
+    """
+    Bytes allocated to a file. Falls back to st_size where st_blocks is unavailable.
+    """
+    blocks = getattr(st, "st_blocks", None)
+    return st.st_size if blocks is None else blocks * 512
+
+def _scan_directory(path):
+    """
+    List one directory. Runs in a worker thread.
+
+    Returns:
+    - (apparent, allocated, files, subdirs, linked, errors) where subdirs are
+      the names of the subdirectories and linked holds (st_dev, st_ino,
+      apparent, allocated) for files with more than one hard link.
+    """
+    apparent = 0
+    allocated = 0
+    files = 0
+    errors = 0
+    subdirs = []
+    linked = []
+    stats = 0
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                    continue
+
+                # DirEntry caches this, and no other stat is made for the file
+                st = entry.stat(follow_symlinks=False)
+                stats += 1
+            except OSError:
+                errors += 1
+                continue
+
+            if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                linked.append((st.st_dev, st.st_ino, st.st_size, _allocated_bytes(st)))
+            else:
+                apparent += st.st_size
+                allocated += _allocated_bytes(st)
+                files += 1
+
+    instrumentation.count("fs.scandir")
+    instrumentation.count("fs.stat", stats)
+    instrumentation.count("fs.bytes_walked", apparent + sum(link[2] for link in linked))
+    return apparent, allocated, files, subdirs, linked, errors
+
+def _revalidate_directory(path, entry):
+    """
+    Reuse a cached listing if the directory has not changed since,
+    otherwise list it again. Runs in a worker thread.
+
+    Returns:
+    - (mtime_ns, changed, scan) where scan is as returned by _scan_directory.
+    """
+    mtime_ns = os.lstat(path).st_mtime_ns
+    instrumentation.count("fs.stat")
+    if entry is not None:
+        cached_mtime_ns, apparent, allocated, files, subdirs, linked, scanned_at_ns = entry[:7]
+        if cached_mtime_ns == mtime_ns and scanned_at_ns - mtime_ns > RACY_WINDOW_NS:
+            scan = (apparent, allocated, files, json.loads(subdirs), [tuple(l) for l in json.loads(linked)], 0)
+            return mtime_ns, False, scan
+
+    return mtime_ns, True, _scan_directory(path)
+
+class DiskUsageScanner:
+    def __init__(self, workers=DEFAULT_WORKERS, breakdown_depth=None, cache=None, refresh=False, owners=None,
+                 exclude=None):
+        """
+        Initialize a parallel disk usage scanner.
+
+        Directories are listed with os.scandir by a pool of worker threads,
+        one directory per task, and each file is stat'ed exactly once through
+        its DirEntry. Symbolic links are counted as links, not followed.
+
+        With a cache, every directory's own totals, subdirectory names and
+        mtime are stored in the usage_cache table. Later scans stat each
+        directory and only list the ones whose mtime changed. A file rewritten
+        in place does not change its directory's mtime, so use refresh after
+        such writes.
+
+        Keyword arguments:
+        - workers: Number of worker threads.
+        - breakdown_depth: Also total every directory up to this depth
+                           below the root. None for no breakdown.
+        - cache: StorageManager holding the usage_cache table. None to
+                 always walk everything.
+        - refresh: Ignore the cached listings and walk everything,
+                   then rewrite the cache.
+        - owners: Set of directory paths relative to the scan root. Every
+                  file is attributed to the deepest owner above it, or to
+                  "" if there is none, and the totals go to by_owner.
+        - exclude: Called with the path of each subdirectory relative to the
+                   scan root; the ones it returns True for are not scanned.
+        """
+        self.workers = workers
+        self.breakdown_depth = breakdown_depth
+        self.cache = cache
+        self.refresh = refresh
+        self.owners = owners
+        self.exclude = exclude
+
+    def _add_breakdown(self, result, rel_path, apparent, allocated):
+        """
+        Add a directory's own totals to itself and its ancestors
+        up to the breakdown depth.
+        """
+        names = rel_path.split("/") if rel_path else []
+        for depth in range(min(len(names), self.breakdown_depth) + 1):
+            key = "/".join(names[:depth])
+            sizes = result.by_depth.get(key, (0, 0))
+            result.by_depth[key] = (sizes[0] + apparent, sizes[1] + allocated)
+
+    def _cached_totals(self, path, max_age):
+        """
+        Return the stored totals of path if they are at most max_age seconds old.
+        """
+        entry = self.cache.get_usage_entries([path]).get(path)
+        if entry is None or entry[11] is None:
+            return None
+        if time.time_ns() - entry[11] > max_age * 1e9:
+            return None
+
+        result = DiskUsageResult()
+        result.apparent_size, result.allocated_size, result.file_count, result.dir_count = entry[7:11]
+        return result
+
+    def _submit(self, pool, pending, dir_paths, owner=""):
+        """
+        Queue the listing (or revalidation) of directories
+        whose parent is attributed to owner.
+        """
+        if self.cache is None:
+            for dir_path in dir_paths:
+                pending[pool.submit(_scan_directory, dir_path)] = (dir_path, None, owner)
+            return
+
+        entries = {} if self.refresh else self.cache.get_usage_entries(dir_paths)
+        for dir_path in dir_paths:
+            entry = entries.get(dir_path)
+            pending[pool.submit(_revalidate_directory, dir_path, entry)] = (dir_path, entry, owner)
+
+    @instrumentation.timed("disk_usage.scan")
+    def scan(self, path, max_age=None):
+        """
+        Scan a directory tree.
+
+        Keyword arguments:
+        - path: Root directory of the scan.
+        - max_age: With a cache, return the totals stored by an earlier scan
+                   of the same root if they are at most this many seconds
+                   old, without touching the filesystem.
+
+        Returns:
+        - DiskUsageResult
+
+        Raises:
+        - AllocatorException: If the root directory cannot be listed.
+        """
+        if (self.cache is not None and max_age is not None and not self.refresh
+                and self.breakdown_depth is None and self.owners is None and self.exclude is None):
+            result = self._cached_totals(path, max_age)
+            if result is not None:
+                return result
+
+        result = DiskUsageResult()
+        seen_links = set()
+        root_prefix_len = len(path.rstrip(os.sep)) + 1
+        scanned_at_ns = time.time_ns()
+        cache_rows = {}
+        # a refresh rewrites the whole subtree, dropping rows of vanished directories
+        removed_dirs = [path] if self.refresh else []
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {}
+            self._submit(pool, pending, [path])
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_path, entry, owner = pending.pop(future)
+                    try:
+                        if self.cache is None:
+                            scan = future.result()
+                        else:
+                            mtime_ns, changed, scan = future.result()
+                    except OSError as e:
+                        if dir_path == path:
+                            raise AllocatorException(f"[ERROR] Unable to calculate disk usage for '{path}': {e}")
+                        result.error_count += 1
+                        continue
+
+                    apparent, allocated, files, subdirs, linked, errors = scan
+                    own = (apparent, allocated, files)
+
+                    # hard-linked files are counted at the first link found
+                    for dev, ino, link_apparent, link_allocated in linked:
+                        if (dev, ino) not in seen_links:
+                            seen_links.add((dev, ino))
+                            apparent += link_apparent
+                            allocated += link_allocated
+                            files += 1
+
+                    result.apparent_size += apparent
+                    result.allocated_size += allocated
+                    result.file_count += files
+                    result.dir_count += 1
+                    result.error_count += errors
+
+                    rel_path = dir_path[root_prefix_len:] if dir_path != path else ""
+                    if self.breakdown_depth is not None:
+                        self._add_breakdown(result, rel_path, apparent, allocated)
+
+                    if self.owners is not None:
+                        if rel_path in self.owners:
+                            owner = rel_path
+                        sizes = result.by_owner.get(owner, (0, 0))
+                        result.by_owner[owner] = (sizes[0] + apparent, sizes[1] + allocated)
+
+                    if self.cache is not None and (changed or dir_path == path):
+                        # a reused root listing keeps the time it was last listed
+                        cache_rows[dir_path] = [dir_path, mtime_ns, *own,
+                                                json.dumps(subdirs), json.dumps(linked),
+                                                scanned_at_ns if changed else entry[6],
+                                                None, None, None, None, None,
+                                                ]
+                        if changed and entry is not None:
+                            current = set(subdirs)
+                            removed_dirs.extend(os.path.join(dir_path, name)
+                                                for name in json.loads(entry[4]) if name not in current)
+
+                    if self.exclude is not None:
+                        prefix = rel_path + "/" if rel_path else ""
+                        subdirs = [name for name in subdirs if not self.exclude(prefix + name)]
+                    self._submit(pool, pending, [os.path.join(dir_path, name) for name in subdirs], owner)
+
+        if self.cache is not None:
+            self._store(path, result, scanned_at_ns, cache_rows, removed_dirs)
+
+        return result
+
+    def _store(self, path, result, scanned_at_ns, cache_rows, removed_dirs):
+        """
+        Write the changed directories and the root totals to the cache.
+        """
+        root_row = cache_rows.get(path)
+        if root_row is not None:
+            root_row[8:13] = [result.apparent_size, result.allocated_size,
+                              result.file_count, result.dir_count, scanned_at_ns,
+                              ]
+            if result.error_count or self.exclude is not None:
+                # incomplete totals are not served by the max_age shortcut
+                root_row[8:13] = [None, None, None, None, None]
+
+        self.cache.put_usage_entries([tuple(row) for row in cache_rows.values()],
+                                     removed_dirs=removed_dirs,
+                                     )
@@ -11,5 +11,8 @@ class ConfigHandlerException(Exception):
 class StorageManagerException(Exception):
     pass
 
+class DaemonTimeoutException(AllocatorException):
+    pass
+
 class TreeVisualizerException(Exception):
     pass
\ No newline at end of file
@@ -0,0 +1,271 @@
+# data_allocator/fsck.py
+
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from data_allocator.constants import TRASH_DIR_NAME
+from data_allocator.reaper import is_deleted_name
+
+DEFAULT_FSCK_WORKERS = 16
+
+# Top-level directories checked per task, so that a flat namespace
+# does not cost one task per branch.
+TOPS_PER_TASK = 64
+
+class FsckResult:
+    def __init__(self):
+        """
+        Findings of Fsck.check.
+
+        - missing: (drive, branch_path) of records whose directory is not on the drive.
+        - unregistered: (drive, rel_path) of directories that are not a branch,
+                        not inside a branch and do not lead to a branch recorded
+                        on that drive. Only the topmost such directory is listed.
+        - wrong_drive: (branch_path, recorded_drive, found_drive) of records
+                       whose directory is on another drive.
+        - errors: (drive, rel_path, message) of directories that could not be
+                  listed. Records below them are not checked.
+        - record_count: Number of records checked.
+        - dir_count: Number of directories listed.
+        """
+        self.missing = []
+        self.unregistered = []
+        self.wrong_drive = []
+        self.errors = []
+        self.record_count = 0
+        self.dir_count = 0
+
+    def problem_count(self):
+        return len(self.missing) + len(self.unregistered) + len(self.wrong_drive) + len(self.errors)
+
+    def merge(self, other):
+        self.missing.extend(other.missing)
+        self.unregistered.extend(other.unregistered)
+        self.wrong_drive.extend(other.wrong_drive)
+        self.errors.extend(other.errors)
+        self.record_count += other.record_count
+        self.dir_count += other.dir_count
+
+def _list_subdirs(path):
+    """
+    Names of the subdirectories of path, sorted by name + "/" as
+    StorageManager.iter_drive_locations_under sorts branch paths.
+    Symbolic links to directories are not followed, and directories
+    being deleted (see reaper.deleted_name) are left out.
+    """
+    with os.scandir(path) as entries:
+        names = [entry.name for entry in entries
+                 if entry.is_dir(follow_symlinks=False) and not is_deleted_name(entry.name)]
+    names.sort(key=lambda name: name + "/")
+    return names
+
+class _SortedStream:
+    """
+    An iterator with a look-ahead of one item, None when exhausted.
+    """
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.head = next(self._iterator, None)
+
+    def pop(self):
+        head = self.head
+        self.head = next(self._iterator, None)
+        return head
+
+class Fsck:
+    def __init__(self, allocator, workers=DEFAULT_FSCK_WORKERS):
+        """
+        Initialize a check of the database records against the drives.
+
+        Every drive is walked from its root, but only into the directories
+        that are recorded branches or lead to one, so the content of the
+        branches is not listed. The top-level directories of all drives are
+        checked in parallel. Within one, the sorted listing of each directory
+        is merged with the records on that drive, streamed from SQLite in the
+        same order, so a record costs no stat and no per-record object is
+        kept beyond the problems found.
+
+        Keyword arguments:
+        - allocator: Allocator giving access to the config and the database.
+        - workers: Number of threads listing directories.
+        """
+        self.allocator = allocator
+        self.workers = workers
+
+    def _top_names(self, drive, drive_path):
+        """
+        Top-level names on a drive's disk or among its records, sorted.
+        """
+        storage = self.allocator.storage
+        names = set(_list_subdirs(drive_path))
+        names.discard(TRASH_DIR_NAME)
+        names.update(branch_path for branch_path, branch_drive
+                     in storage.get_locations2drive_under("", max_depth=1).items() if branch_drive == drive)
+        # ancestors of deeper branches, on any drive; a name without
+        # records on this drive and without a directory costs one query
+        names.update(storage.get_branch_prefixes("", 1))
+        return sorted(names, key=lambda name: name + "/")
+
+    def _check_tops(self, drive, drive_path, tops):
+        """
+        Check the subtrees of some top-level names of one drive. Runs in a worker thread.
+        """
+        result = FsckResult()
+        for top in tops:
+            self._check_top(drive, drive_path, top, result)
+        return result
+
+    def _check_top(self, drive, drive_path, top, result):
+        records = _SortedStream(self.allocator.storage.iter_drive_locations_under(drive, top))
+        top_path = os.path.join(drive_path, top)
+        roots = [top] if os.path.isdir(top_path) and not os.path.islink(top_path) else []
+
+        # (directory, iterator over its subdirectories, whether it is in a branch)
+        stack = [("", iter(roots), False)]
+        while stack:
+            parent, children, in_branch = stack[-1]
+            name = next(children, None)
+            if name is None:
+                stack.pop()
+                continue
+
+            rel_path = parent + "/" + name if parent else name
+            key = rel_path + "/"
+
+            # records sorting before this directory have no directory
+            while records.head is not None and records.head + "/" < key:
+                result.missing.append((drive, records.pop()))
+                result.record_count += 1
+
+            is_branch = records.head == rel_path
+            if is_branch:
+                records.pop()
+                result.record_count += 1
+
+            if records.head is not None and records.head.startswith(key):
+                try:
+                    subdirs = _list_subdirs(os.path.join(drive_path, rel_path))
+                except OSError as e:
+                    result.errors.append((drive, rel_path, str(e)))
+                    while records.head is not None and records.head.startswith(key):
+                        records.pop()
+                    continue
+                result.dir_count += 1
+                stack.append((rel_path, iter(subdirs), in_branch or is_branch))
+            elif not is_branch and not in_branch:
+                result.unregistered.append((drive, rel_path))
+
+        while records.head is not None:
+            result.missing.append((drive, records.pop()))
+            result.record_count += 1
+
+    def check(self):
+        """
+        Compare the records with the directories on every drive.
+
+        Returns:
+        - FsckResult
+        """
+        result = FsckResult()
+        drive_paths = self.allocator.config.get_drive_paths()
+
+        reachable = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = []
+            for drive, drive_path in drive_paths.items():
+                try:
+                    tops = self._top_names(drive, drive_path)
+                except OSError as e:
+                    # an unreachable drive is reported once, not as every record missing
+                    result.errors.append((drive, "", str(e)))
+                    continue
+                reachable.add(drive)
+                result.dir_count += 1
+                for start in range(0, len(tops), TOPS_PER_TASK):
+                    futures.append(pool.submit(self._check_tops, drive, drive_path, tops[start:start + TOPS_PER_TASK]))
+
+            for future in futures:
+                result.merge(future.result())
+
+            # a missing branch whose directory is on another drive
+            def find_elsewhere(missing):
+                drive, branch_path = missing
+                for other, other_path in drive_paths.items():
+                    if other != drive and other in reachable and os.path.isdir(os.path.join(other_path, branch_path)):
+                        return other
+                return None
+
+            found = list(pool.map(find_elsewhere, result.missing))
+
+        unregistered = set(result.unregistered)
+        still_missing = []
+        for (drive, branch_path), other in zip(result.missing, found):
+            if other is None:
+                still_missing.append((drive, branch_path))
+            else:
+                result.wrong_drive.append((branch_path, drive, other))
+                # the directories leading to it only hold the misplaced branch
+                names = branch_path.split("/")
+                for depth in range(1, len(names) + 1):
+                    unregistered.discard((other, "/".join(names[:depth])))
+
+        result.missing = sorted(still_missing)
+        result.unregistered = sorted(unregistered)
+        result.wrong_drive.sort()
+        result.errors.sort()
+        return result
+
+    def _is_unregistered(self, drive, rel_path):
+        """
+        Whether a directory is still outside every branch recorded on its drive.
+        """
+        storage = self.allocator.storage
+        names = rel_path.split("/")
+        for depth in range(1, len(names) + 1):
+            if storage.get_drive("/".join(names[:depth])) == drive:
+                return False
+        return drive not in storage.get_locations2drive_under(rel_path).values()
+
+    def repair(self, result, trash_unregistered=False):
+        """
+        Fix the problems found by check().
+
+        - wrong_drive: the record is pointed at the drive holding the directory.
+        - missing: the record is deleted.
+        - unregistered: with trash_unregistered, the directory is moved into
+                        the drive's trash, to be removed by `reap`.
+
+        Each fix checks the problem again under the database write lock
+        and is skipped if it has gone, e.g. because of a concurrent command.
+
+        Returns:
+        - dict: number of fixes made per kind of problem
+        """
+        storage = self.allocator.storage
+        drive_paths = self.allocator.config.get_drive_paths()
+        fixed = {"wrong_drive": 0, "missing": 0, "unregistered": 0}
+
+        for branch_path, drive, other in result.wrong_drive:
+            with storage.transaction():
+                if (not os.path.isdir(os.path.join(drive_paths[drive], branch_path))
+                        and os.path.isdir(os.path.join(drive_paths[other], branch_path))
+                        and storage.update_drive(branch_path, drive, other)):
+                    fixed["wrong_drive"] += 1
+
+        for drive, branch_path in result.missing:
+            with storage.transaction():
+                if (storage.get_drive(branch_path) == drive
+                        and not os.path.isdir(os.path.join(drive_paths[drive], branch_path))):
+                    storage.delete_location(branch_path)
+                    storage.release_reservations([branch_path])
+                    fixed["missing"] += 1
+
+        if trash_unregistered:
+            for drive, rel_path in result.unregistered:
+                path = os.path.join(drive_paths[drive], rel_path)
+                with storage.transaction():
+                    if os.path.isdir(path) and self._is_unregistered(drive, rel_path):
+                        os.rename(path, self.allocator.make_trash_entry_path(drive, os.path.basename(rel_path)))
+                        fixed["unregistered"] += 1
+
+        return fixed
@@ -0,0 +1,313 @@
+# data_allocator/import_export.py
+
+import os
+import csv
+import json
+import heapq
+import queue
+import threading
+
+from data_allocator.storage_manager import branch_parent
+from data_allocator.exceptions import AllocatorException
+
+# Records checked and inserted per transaction.
+DEFAULT_IMPORT_CHUNK_SIZE = 10000
+
+# Scanned paths handed from a drive's scanner thread at a time, and the
+# number of such batches it may run ahead of the import.
+SCAN_BATCH_SIZE = 1000
+SCAN_QUEUE_SIZE = 16
+
+CSV_FIELDS = ("branch_path", "drive_name")
+
+def detect_format(path, fmt=None):
+    """
+    The format of a manifest: fmt if given, else "csv" for
+    a .csv file and "jsonl" for anything else.
+    """
+    if fmt:
+        return fmt
+    return "csv" if path.lower().endswith(".csv") else "jsonl"
+
+def read_manifest(stream, fmt="jsonl"):
+    """
+    Yield (branch_path, drive_name) from a JSONL or CSV stream in the
+    format written by write_export. Blank lines are skipped.
+
+    Raises:
+    - AllocatorException: On a line without both fields.
+    """
+    if fmt == "csv":
+        rows = csv.DictReader(stream)
+    else:
+        rows = (json.loads(line) for line in stream if line.strip())
+
+    for line_number, row in enumerate(rows, start=1):
+        branch_path = row.get("branch_path")
+        drive_name = row.get("drive_name")
+        if not branch_path or not drive_name:
+            raise AllocatorException(f"[ERROR] Manifest entry {line_number} needs a branch_path and a drive_name.")
+        yield branch_path.strip("/"), drive_name
+
+def write_export(storage, stream, fmt="jsonl"):
+    """
+    Write every branch record to a stream as JSONL or CSV, sorted by branch.
+    Records are streamed from the database, so memory use does not
+    depend on the size of the table.
+
+    Returns:
+    - int: Number of records written.
+    """
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(stream)
+        writer.writerow(CSV_FIELDS)
+        for count, row in enumerate(storage.iter_locations(), start=1):
+            writer.writerow(row)
+    else:
+        for count, (branch_path, drive_name) in enumerate(storage.iter_locations(), start=1):
+            stream.write(json.dumps({"branch_path": branch_path, "drive_name": drive_name}) + "\n")
+    return count
+
+def scan_drive(drive_path, depth, errors=None):
+    """
+    Yield the relative paths of the directories exactly depth levels below
+    drive_path, in the order of their path + "/". Hidden directories (e.g.
+    the trash and branches being deleted) and symbolic links are skipped.
+
+    Keyword arguments:
+    - drive_path: Root of the drive.
+    - depth: Depth of the directories to yield, 1 for the top level.
+    - errors: List to append (rel_path, message) to for directories that
+              cannot be listed. Without it, the OSError is raised.
+    """
+    def subdirs(rel_path):
+        try:
+            with os.scandir(os.path.join(drive_path, rel_path)) as entries:
+                names = [entry.name for entry in entries
+                         if entry.is_dir(follow_symlinks=False) and not entry.name.startswith(".")]
+        except OSError as e:
+            if errors is None:
+                raise
+            errors.append((rel_path, str(e)))
+            return []
+        names.sort(key=lambda name: name + "/")
+        return names
+
+    # (directory, iterator over its subdirectories, its depth)
+    stack = [("", iter(subdirs("")), 0)]
+    while stack:
+        parent, children, parent_depth = stack[-1]
+        name = next(children, None)
+        if name is None:
+            stack.pop()
+            continue
+
+        rel_path = parent + "/" + name if parent else name
+        if parent_depth + 1 == depth:
+            yield rel_path
+        else:
+            stack.append((rel_path, iter(subdirs(rel_path)), parent_depth + 1))
+
+def _scan_into(drive_path, depth, errors, out):
+    """
+    Run scan_drive in a thread, putting batches of paths on out,
+    then None, or the exception that stopped the scan.
+    """
+    try:
+        batch = []
+        for rel_path in scan_drive(drive_path, depth, errors):
+            batch.append(rel_path)
+            if len(batch) >= SCAN_BATCH_SIZE:
+                out.put(batch)
+                batch = []
+        if batch:
+            out.put(batch)
+        out.put(None)
+    except Exception as e:
+        out.put(e)
+
+def _drain(drive, out):
+    """
+    Yield (path + "/", path, drive) from the batches a scanner thread puts on out.
+    """
+    while True:
+        batch = out.get()
+        if batch is None:
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        for rel_path in batch:
+            yield rel_path + "/", rel_path, drive
+
+def scan_drives(drive_paths, depth, conflict, errors=None, storage=None):
+    """
+    Scan every drive in its own thread and yield (branch_path, drive_name)
+    of the directories found, in the order of their branch_path + "/".
+
+    The per-drive streams are merged, so a directory found on more than
+    one drive is reported to conflict and not yielded. With storage, a
+    directory that is not a branch recorded on its drive but leads to one
+    (the parent of a nested branch on another drive) is not counted as
+    found there. Each scanner runs
+    at most SCAN_QUEUE_SIZE batches ahead, so memory use does not depend
+    on the number of directories.
+
+    Keyword arguments:
+    - drive_paths: dictionary of drive name and mount path
+    - depth: Depth of the directories to import, 1 for the top level.
+    - conflict: Called with (branch_path, drive_name, reason).
+    - errors: List to append (drive_name, rel_path, message) to for
+              directories that cannot be listed.
+    - storage: StorageManager holding the records already made.
+    """
+    streams = []
+    per_drive_errors = {}
+    for drive, drive_path in drive_paths.items():
+        out = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+        per_drive_errors[drive] = []
+        thread = threading.Thread(target=_scan_into, args=(drive_path, depth, per_drive_errors[drive], out), daemon=True)
+        thread.start()
+        streams.append(_drain(drive, out))
+
+    group = []
+    for key, rel_path, drive in heapq.merge(*streams):
+        if group and group[0][0] != rel_path:
+            yield from _resolve_group(group, conflict, storage)
+            group = []
+        group.append((rel_path, drive))
+    yield from _resolve_group(group, conflict, storage)
+
+    if errors is not None:
+        for drive, drive_errors in per_drive_errors.items():
+            errors.extend((drive, rel_path, message) for rel_path, message in drive_errors)
+
+def _resolve_group(group, conflict, storage=None):
+    """
+    Yield the only location of a path, or report the drives it is on.
+    """
+    if group and storage is not None:
+        recorded = storage.get_drive(group[0][0])
+        group = [(rel_path, drive) for rel_path, drive in group
+                 if drive == recorded or not storage.has_locations_below(rel_path, drive)]
+
+    if len(group) == 1:
+        yield group[0]
+    elif group:
+        drives = ",".join(sorted(drive for _, drive in group))
+        conflict(group[0][0], drives, "found on more than one drive")
+
+class ImportResult:
+    def __init__(self):
+        """
+        Totals of Importer.import_locations.
+
+        - imported: Records inserted.
+        - existing: Records that were already in the database with the same drive.
+        - conflicts: Records not inserted because of a conflict.
+        """
+        self.imported = 0
+        self.existing = 0
+        self.conflicts = 0
+
+class Importer:
+    def __init__(self, allocator, chunk_size=DEFAULT_IMPORT_CHUNK_SIZE, verify=True, dry_run=False, nested=False):
+        """
+        Initialize a bulk import of branch records.
+
+        Records are checked and inserted chunk_size at a time, each chunk in
+        one transaction, so neither the input nor the table is held in memory.
+
+        Keyword arguments:
+        - allocator: Allocator giving access to the config and the database.
+        - chunk_size: Records per transaction.
+        - verify: Check that each branch's directory exists on its drive.
+        - dry_run: Check the records but do not insert them.
+        - nested: Accept branches inside a branch recorded on the same drive,
+                  as a manifest or export may list them. Directories found by
+                  a drive scan inside a branch are its content, not branches.
+        """
+        self.allocator = allocator
+        self.chunk_size = chunk_size
+        self.verify = verify
+        self.dry_run = dry_run
+        self.nested = nested
+
+    def import_locations(self, locations, conflict):
+        """
+        Record the branches that are not recorded yet.
+
+        A record conflicts if its drive is not configured, its directory is
+        missing (with verify), the branch is recorded on another drive, it is
+        repeated with another drive, or (without nested) its directory is
+        inside a branch recorded on the same drive.
+
+        Keyword arguments:
+        - locations: Iterable of (branch_path, drive_name).
+        - conflict: Called with (branch_path, drive_name, reason) for each conflict.
+
+        Returns:
+        - ImportResult
+        """
+        result = ImportResult()
+        chunk = []
+        for location in locations:
+            chunk.append(location)
+            if len(chunk) >= self.chunk_size:
+                self._import_chunk(chunk, conflict, result)
+                chunk = []
+        if chunk:
+            self._import_chunk(chunk, conflict, result)
+        return result
+
+    def _import_chunk(self, chunk, conflict, result):
+        storage = self.allocator.storage
+        drive_paths = self.allocator.config.get_drive_paths()
+
+        def reject(branch_path, drive_name, reason):
+            result.conflicts += 1
+            conflict(branch_path, drive_name, reason)
+
+        ancestors = set()
+        if not self.nested:
+            for branch_path, _ in chunk:
+                parent = branch_parent(branch_path)
+                while parent:
+                    ancestors.add(parent)
+                    parent = branch_parent(parent)
+
+        with storage.transaction():
+            recorded = storage.get_drives([branch_path for branch_path, _ in chunk])
+            recorded_ancestors = storage.get_drives(ancestors)
+
+            new = {}
+            for branch_path, drive_name in chunk:
+                if drive_name not in drive_paths:
+                    reject(branch_path, drive_name, "drive is not configured")
+                    continue
+
+                recorded_drive = recorded.get(branch_path, new.get(branch_path))
+                if recorded_drive == drive_name:
+                    result.existing += 1
+                    continue
+                if recorded_drive is not None:
+                    reject(branch_path, drive_name, f"recorded on {recorded_drive}")
+                    continue
+
+                if not self.nested:
+                    parent = branch_parent(branch_path)
+                    while parent and recorded_ancestors.get(parent, new.get(parent)) != drive_name:
+                        parent = branch_parent(parent)
+                    if parent:
+                        reject(branch_path, drive_name, f"inside branch '{parent}'")
+                        continue
+
+                if self.verify and not os.path.isdir(os.path.join(drive_paths[drive_name], branch_path)):
+                    reject(branch_path, drive_name, "no directory on the drive")
+                    continue
+
+                new[branch_path] = drive_name
+
+            if new and not self.dry_run:
+                storage.record_locations(new.items())
+            result.imported += len(new)
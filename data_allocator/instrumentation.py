@@ -0,0 +1,133 @@
+# data_allocator/instrumentation.py
+
+# Imported by the modules it instruments, so it only uses modules the
+# interpreter loads anyway. While no profile is enabled, a timed call
+# costs one extra function call and a counter one global lookup.
+
+import time
+import functools
+import threading
+
+from contextlib import contextmanager
+
+# The enabled Profile, or None
+_profile = None
+
+class Profile:
+    def __init__(self):
+        """
+        Per-operation latencies and counters of one run.
+
+        - timings: maps an operation name to [calls, total seconds]. Times of
+                   nested operations are included in their callers' times.
+        - counters: maps a counter name to its total, e.g. "sql.statements",
+                    "fs.stat" or "fs.bytes_walked".
+        """
+        self.started_at = time.perf_counter()
+        self.timings = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_timing(self, name, elapsed):
+        with self._lock:
+            timing = self.timings.setdefault(name, [0, 0.0])
+            timing[0] += 1
+            timing[1] += elapsed
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def trace_sql(self, statement):
+        """
+        SQLite trace callback: count the statements, per leading keyword.
+        """
+        keyword = statement.split(None, 1)[0].rstrip(";").upper() if statement.strip() else ""
+        with self._lock:
+            self.counters["sql.statements"] = self.counters.get("sql.statements", 0) + 1
+            name = "sql." + keyword
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def to_dict(self):
+        return {"elapsed_s": time.perf_counter() - self.started_at,
+                "timings": {name: {"calls": calls, "total_s": total}
+                            for name, (calls, total) in self.timings.items()},
+                "counters": dict(self.counters),
+                }
+
+    def report(self):
+        """
+        Return the timings, slowest first, and the counters as text.
+        """
+        lines = ["{:<40}{:>8}{:>12}{:>12}".format("operation", "calls", "total (ms)", "mean (ms)")]
+        for name, (calls, total) in sorted(self.timings.items(), key=lambda item: -item[1][1]):
+            lines.append("{:<40}{:>8}{:>12.3f}{:>12.3f}".format(name, calls, total * 1e3, total / calls * 1e3))
+
+        lines.append("")
+        lines.append("{:<40}{:>8}".format("counter", "total"))
+        for name, total in sorted(self.counters.items()):
+            lines.append("{:<40}{:>8}".format(name, total))
+
+        lines.append("")
+        lines.append("elapsed: {:.3f} ms".format((time.perf_counter() - self.started_at) * 1e3))
+        return "\n".join(lines) + "\n"
+
+def enable():
+    """
+    Start recording into a new Profile and return it. Connections opened
+    by StorageManager from now on report their SQL statements to it.
+    """
+    global _profile
+    _profile = Profile()
+    return _profile
+
+def disable():
+    global _profile
+    _profile = None
+
+def timed(name):
+    """
+    Decorator recording the latency of each call under name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = _profile
+            if profile is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.add_timing(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+@contextmanager
+def timer(name):
+    """
+    Record the latency of a block under name.
+    """
+    profile = _profile
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if profile is not None:
+            profile.add_timing(name, time.perf_counter() - start)
+
+def count(name, amount=1):
+    """
+    Add amount to a counter.
+    """
+    profile = _profile
+    if profile is not None:
+        profile.count(name, amount)
+
+def trace_connection(conn):
+    """
+    Count the statements a sqlite3 connection runs.
+    """
+    profile = _profile
+    if profile is not None:
+        conn.set_trace_callback(profile.trace_sql)
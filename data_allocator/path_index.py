@@ -0,0 +1,89 @@
+# data_allocator/path_index.py
+
+import os
+
+def normalize_path(path):
+    """
+    Absolute path without "..", "." or repeated and trailing separators.
+    Symbolic links are not resolved, so a path must use the same
+    spelling of a drive root as the config.
+    """
+    return os.path.normpath(os.path.abspath(path))
+
+class PathIndex:
+    def __init__(self, drive_paths):
+        """
+        Initialize a longest-prefix-match index over the drive roots.
+
+        A path is matched one component at a time, from the full path up
+        to the filesystem root, against a dictionary of the normalized
+        roots. The first hit is the longest matching root, and a root only
+        matches on a component boundary, so "/mnt/drive1x" is not on
+        "/mnt/drive1". The branch owning a path is matched the same way,
+        by looking up its parent directories in the database.
+
+        Keyword arguments:
+        - drive_paths: dictionary of drive name and mount path
+        """
+        self.drive_paths = drive_paths
+        self._roots = {normalize_path(drive_path): drive for drive, drive_path in drive_paths.items()}
+
+    def find_drive(self, path):
+        """
+        Find the drive a path is on.
+
+        Returns:
+        - (drive, rel_path) with rel_path relative to the drive root, using
+          "/" as in branch paths ("" for the root itself), or None if the
+          path is not on any configured drive.
+        """
+        head = normalize_path(path)
+        names = []
+        while True:
+            drive = self._roots.get(head)
+            if drive is not None:
+                return drive, "/".join(reversed(names))
+            head, name = os.path.split(head)
+            if not name:
+                return None
+            names.append(name)
+
+    def resolve(self, paths, storage):
+        """
+        Find the branch owning each of many paths: the deepest branch
+        recorded on the path's drive that contains it.
+
+        The parent directories of all paths are looked up at once with
+        StorageManager.get_drives, so the database is queried in chunks
+        rather than once per path.
+
+        Keyword arguments:
+        - paths: Iterable of filesystem paths.
+        - storage: StorageManager holding the records.
+
+        Returns:
+        - list: (branch_path, drive) for each path, in the order of paths.
+                branch_path is None for paths on a drive but in no branch,
+                and both are None for paths on no configured drive.
+        """
+        located = [self.find_drive(path) for path in paths]
+
+        candidates = set()
+        for location in located:
+            if location is not None and location[1]:
+                names = location[1].split("/")
+                candidates.update("/".join(names[:depth]) for depth in range(1, len(names) + 1))
+        branch2drive = storage.get_drives(candidates)
+
+        results = []
+        for location in located:
+            if location is None:
+                results.append((None, None))
+                continue
+
+            drive, rel_path = location
+            branch_path = rel_path
+            while branch_path and branch2drive.get(branch_path) != drive:
+                branch_path = branch_path.rpartition("/")[0]
+            results.append((branch_path or None, drive))
+        return results
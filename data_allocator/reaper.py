@@ -0,0 +1,239 @@
+# data_allocator/reaper.py
+
+import os
+import re
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from data_allocator.constants import DELETED_INFIX
+from data_allocator.transfer import RateLimiter
+
+DEFAULT_REAP_WORKERS = 16
+
+# Seconds between two progress reports.
+PROGRESS_INTERVAL = 1.0
+
+DELETED_NAME = re.compile(r"^\..+" + re.escape(DELETED_INFIX) + r"\d+-\d+$")
+
+def deleted_name(name):
+    """
+    Hidden name that a directory called name is renamed to, next to
+    itself, while it is deleted.
+    """
+    return f".{name}{DELETED_INFIX}{os.getpid()}-{time.time_ns()}"
+
+def is_deleted_name(name):
+    """
+    Whether name was made by deleted_name, i.e. a directory being deleted.
+    """
+    return DELETED_NAME.match(name) is not None
+
+class ReapResult:
+    def __init__(self):
+        """
+        Totals of a Reaper.reap call.
+
+        - entries_removed: Trash entries (deleted branches) removed completely.
+        - files_removed: Files and links unlinked.
+        - dirs_removed: Directories removed.
+        - error_count: Entries that could not be removed. They stay in the
+                       trash and are retried by the next reap.
+        - elapsed: Seconds since the reap started.
+        """
+        self.entries_removed = 0
+        self.files_removed = 0
+        self.dirs_removed = 0
+        self.error_count = 0
+        self.elapsed = 0.0
+
+def _empty_directory(path, limiter):
+    """
+    Unlink the files in one directory. Runs in a worker thread.
+
+    Returns:
+    - (subdirs, files, errors) where subdirs are the paths of the
+      subdirectories, which are left for other tasks.
+    """
+    subdirs = []
+    files = 0
+    errors = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                if limiter is not None:
+                    limiter.consume(1)
+                os.unlink(entry.path)
+                files += 1
+            except FileNotFoundError:
+                # removed by another reaper
+                continue
+            except OSError:
+                errors += 1
+
+    return subdirs, files, errors
+
+def _entry_time(path):
+    """
+    When a trash entry was deleted: the time_ns prefix of its name, or
+    its mtime for entries not named by delete_branch.
+    """
+    stamp = os.path.basename(path).split("-", 1)[0]
+    if stamp.isdigit():
+        return int(stamp) / 1e9
+    return os.lstat(path).st_mtime
+
+class Reaper:
+    def __init__(self, trash_paths, workers=DEFAULT_REAP_WORKERS, rate=None, progress=None):
+        """
+        Initialize a reaper that empties the trash directories
+        filled by delete_branch(defer=True).
+
+        Directories are emptied by a pool of worker threads, one directory
+        per task, so the unlinks of a large tree are spread over many
+        concurrent requests, which is what makes deleting on NFS fast.
+        A directory is removed by the main thread once its files are
+        unlinked and its subdirectories removed.
+
+        Keyword arguments:
+        - trash_paths: Iterable of trash directories, e.g. the values of
+                       Allocator.get_trash_paths(). Missing ones are skipped.
+        - workers: Number of unlink threads.
+        - rate: Cap on the files unlinked per second across all threads.
+                None for no cap.
+        - progress: Called with the running ReapResult about once
+                    a second, and once at the end.
+        """
+        self.trash_paths = list(trash_paths)
+        self.workers = workers
+        self.rate = rate
+        self.progress = progress
+
+    def pending(self, min_age=None):
+        """
+        Return the paths of the trash entries, oldest first.
+
+        Keyword arguments:
+        - min_age: Only entries deleted at least this many seconds ago.
+        """
+        now = time.time()
+        entries = []
+        for trash_path in self.trash_paths:
+            if not os.path.isdir(trash_path):
+                continue
+            for name in os.listdir(trash_path):
+                path = os.path.join(trash_path, name)
+                try:
+                    deleted_at = _entry_time(path)
+                except FileNotFoundError:
+                    continue
+                if min_age is None or now - deleted_at >= min_age:
+                    entries.append((deleted_at, path))
+
+        return [path for _, path in sorted(entries)]
+
+    def reap(self, min_age=None):
+        """
+        Remove the trash entries.
+
+        Keyword arguments:
+        - min_age: Only remove entries deleted at least this many seconds ago.
+
+        Returns:
+        - ReapResult
+        """
+        return self.remove(self.pending(min_age=min_age))
+
+    def remove(self, paths):
+        """
+        Remove files and directory trees with the worker pool, each path
+        counting as one entry. Used for the trash entries by reap, and for
+        the directories of a recursive delete.
+
+        Returns:
+        - ReapResult
+        """
+        result = ReapResult()
+        start = time.monotonic()
+        limiter = RateLimiter(self.rate, burst=self.rate) if self.rate else None
+
+        # parent of every directory being emptied (None for an entry), and
+        # the number of its subdirectories that are not removed yet
+        parents = {}
+        remaining = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {}
+            for path in paths:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    parents[path] = None
+                    pending[pool.submit(_empty_directory, path, limiter)] = path
+                    continue
+                try:
+                    os.unlink(path)
+                    result.files_removed += 1
+                    result.entries_removed += 1
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    result.error_count += 1
+
+            reported_at = time.monotonic()
+            while pending:
+                done, _ = wait(pending, timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    try:
+                        subdirs, files, errors = future.result()
+                    except FileNotFoundError:
+                        subdirs, files, errors = [], 0, 0
+                    except OSError:
+                        subdirs, files, errors = [], 0, 1
+
+                    result.files_removed += files
+                    result.error_count += errors
+                    remaining[path] = len(subdirs)
+                    for subdir in subdirs:
+                        parents[subdir] = path
+                        pending[pool.submit(_empty_directory, subdir, limiter)] = subdir
+                    if not subdirs:
+                        self._remove_directory(path, parents, remaining, result)
+
+                if self.progress is not None and time.monotonic() - reported_at >= PROGRESS_INTERVAL:
+                    result.elapsed = time.monotonic() - start
+                    self.progress(result)
+                    reported_at = time.monotonic()
+
+        result.elapsed = time.monotonic() - start
+        if self.progress is not None:
+            self.progress(result)
+        return result
+
+    def _remove_directory(self, path, parents, remaining, result):
+        """
+        Remove an emptied directory, then each ancestor
+        whose last subdirectory it was.
+        """
+        while True:
+            try:
+                os.rmdir(path)
+                result.dirs_removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # the entry stays in the trash, its ancestors cannot go either
+                result.error_count += 1
+
+            parent = parents.pop(path)
+            del remaining[path]
+            if parent is None:
+                if not os.path.lexists(path):
+                    result.entries_removed += 1
+                return
+
+            remaining[parent] -= 1
+            if remaining[parent]:
+                return
+            path = parent
@@ -0,0 +1,218 @@
+# data_allocator/rebalancer.py
+
+import os
+import bisect
+
+from data_allocator.transfer import copy_tree, compare_trees, remove_tree, DEFAULT_COPY_WORKERS
+from data_allocator.exceptions import AllocatorException, StorageManagerException
+
+class Rebalancer:
+    def __init__(self, allocator, workers=DEFAULT_COPY_WORKERS, bandwidth=None, checksum=True):
+        """
+        Initialize a rebalancer that moves branches between drives
+        to even out their free space.
+
+        A move copies the branch, verifies the copy, switches the branch's
+        record to the new drive in one transaction, then removes the old
+        copy. Every planned move is stored in the rebalance_moves table
+        first, so an interrupted run is finished by resume(). Branches should
+        not be written to while they are moved: a write that lands between
+        the verification and the switch is lost with the old copy.
+
+        Branches nested in a moving branch on the same drive are separate
+        branches and stay where they are.
+
+        Keyword arguments:
+        - allocator: Allocator giving access to the config and the database.
+        - workers: Number of file copy threads.
+        - bandwidth: Cap on the copy rate in bytes per second. None for no cap.
+        - checksum: Verify copies by SHA-256 before the old copy is removed.
+                    False to compare only the file sizes, which is faster
+                    but misses corrupted contents.
+        """
+        self.allocator = allocator
+        self.workers = workers
+        self.bandwidth = bandwidth
+        self.checksum = checksum
+
+    def pending_moves(self):
+        """
+        Moves of an earlier run that did not finish.
+
+        Returns:
+        - list of (branch_path, source_drive, target_drive, size, state)
+        """
+        return self.allocator.storage.get_rebalance_moves()
+
+    def _nested_on_drive(self, branch_path, drive):
+        """
+        Branches below branch_path recorded on the same drive,
+        relative to branch_path.
+        """
+        under = self.allocator.storage.get_locations2drive_under(branch_path)
+        prefix_len = len(branch_path) + 1
+        return {path[prefix_len:] for path, path_drive in under.items() if path_drive == drive}
+
+    def branch_sizes(self):
+        """
+        Size of the data each branch holds on its drive: its
+        measure_branch_disk_usage total less the totals of the branches
+        nested in it on the same drive. Branches without a directory
+        are left out. The branches are walked without the usage cache,
+        which misses files grown in place, so nothing is written to the
+        database. Space reserved for the branches is not released, as
+        measuring a branch here does not mean its data is complete.
+
+        Returns:
+        - dict: branch path to (drive name, size in bytes)
+        """
+        locations = self.allocator.storage.get_all_locations2drive()
+        totals = {}
+        for branch_path in locations:
+            try:
+                totals[branch_path] = self.allocator.measure_branch_disk_usage(branch_path, 
+                                                                               use_cache=False, 
+                                                                               release=False, 
+                                                                               ).size()
+            except AllocatorException:
+                continue
+
+        # sorted by component, a branch comes after its ancestors and within
+        # their subtrees, so a stack per drive holds its nearest ancestor there
+        sizes = {}
+        ancestors = {}
+        for branch_path in sorted(totals, key=lambda b: b.split("/")):
+            drive = locations[branch_path]
+            stack = ancestors.setdefault(drive, [])
+            while stack and not branch_path.startswith(stack[-1] + "/"):
+                stack.pop()
+            if stack:
+                sizes[stack[-1]] -= totals[branch_path]
+            sizes[branch_path] = totals[branch_path]
+            stack.append(branch_path)
+
+        return {branch_path: (locations[branch_path], size) for branch_path, size in sizes.items()}
+
+    def plan(self, band, dry_run=False):
+        """
+        Plan moves that bring the free space of the drives within band bytes
+        of each other.
+
+        The moves are chosen greedily: from the drive with the least free
+        space to the one with the most, the branch whose size is closest to
+        half the gap between them, as long as the move narrows the gap.
+        Each branch moves at most once.
+
+        Keyword arguments:
+        - band: Largest difference in free bytes left between any two drives.
+        - dry_run: Do not write to the database, not even the cache of
+                   free space.
+
+        Returns:
+        - (moves, free_before, free_after) where moves is a list of
+          (branch_path, source_drive, target_drive, size) and the others map
+          each available drive to its free bytes now and after the moves.
+        """
+        free_before = self.allocator.check_space(update_cache=not dry_run)
+        free_after = dict(free_before)
+        moves = []
+        if len(free_before) < 2:
+            return moves, free_before, free_after
+
+        # (size, branch) per drive, sorted by size
+        candidates = {drive: [] for drive in free_before}
+        for branch_path, (drive, size) in self.branch_sizes().items():
+            if drive in candidates and size > 0:
+                candidates[drive].append((size, branch_path))
+        for sized in candidates.values():
+            sized.sort()
+
+        while True:
+            source = min(free_after, key=free_after.get)
+            target = max(free_after, key=free_after.get)
+            gap = free_after[target] - free_after[source]
+            if gap <= band:
+                break
+
+            # moving size bytes leaves a gap of |gap - 2 * size|, so the best
+            # branch is the one nearest gap / 2, and only sizes below gap help
+            sized = candidates[source]
+            index = bisect.bisect_left(sized, (gap / 2, ""))
+            nearby = [i for i in (index - 1, index) if 0 <= i < len(sized) and sized[i][0] < gap]
+            if not nearby:
+                break
+            index = min(nearby, key=lambda i: abs(gap - 2 * sized[i][0]))
+            size, branch_path = sized.pop(index)
+
+            free_after[source] += size
+            free_after[target] -= size
+            moves.append((branch_path, source, target, size))
+
+        return moves, free_before, free_after
+
+    def execute(self, moves):
+        """
+        Record a plan and carry it out. See resume().
+        """
+        self.allocator.storage.put_rebalance_moves(moves)
+        return self.resume()
+
+    def resume(self):
+        """
+        Carry out the recorded moves in plan order.
+
+        Yields:
+        - (branch_path, source_drive, target_drive, size, status) after each
+          move, where status is "moved", or "skipped" if the branch was
+          deleted or moved elsewhere since it was planned. The partial copy
+          of a skipped move is removed (see Allocator.remove_partial_copy).
+
+        Raises:
+        - AllocatorException: If a copy does not verify. The move stays
+                              recorded and is retried by the next resume().
+        """
+        for branch_path, source, target, size, state in self.pending_moves():
+            status = self._move(branch_path, source, target, state)
+            yield branch_path, source, target, size, status
+
+    def _move(self, branch_path, source, target, state):
+        storage = self.allocator.storage
+        drive_paths = self.allocator.config.get_drive_paths()
+        source_path = os.path.join(drive_paths[source], branch_path)
+        target_path = os.path.join(drive_paths[target], branch_path)
+
+        if state == "pending":
+            if storage.get_drive(branch_path) != source:
+                self.allocator.remove_partial_copy(branch_path, target)
+                storage.delete_rebalance_move(branch_path)
+                return "skipped"
+
+            exclude = self._nested_on_drive(branch_path, source)
+            copy_tree(source_path,
+                      target_path,
+                      workers=self.workers,
+                      bandwidth=self.bandwidth,
+                      exclude=exclude,
+                      )
+            mismatched = compare_trees(source_path,
+                                       target_path,
+                                       workers=self.workers,
+                                       checksum=self.checksum,
+                                       exclude=exclude,
+                                       )
+            if mismatched:
+                raise AllocatorException(f"[ERROR] Copy of '{branch_path}' on '{target}' differs at '{mismatched[0]}' "
+                                         f"and {len(mismatched) - 1} more path(s).")
+
+            try:
+                storage.switch_location(branch_path, source, target)
+            except StorageManagerException as e:
+                raise AllocatorException(str(e)) from e
+
+        # switched: the record points at the copy, so the old one can go.
+        # Nested branches are looked up again, one may have been added since.
+        if os.path.isdir(source_path):
+            remove_tree(source_path, exclude=self._nested_on_drive(branch_path, source))
+        storage.delete_usage_entries_under([os.path.abspath(source_path)])
+        storage.delete_rebalance_move(branch_path)
+        return "moved"
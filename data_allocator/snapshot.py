@@ -0,0 +1,211 @@
+# data_allocator/snapshot.py
+
+# Read by `get` on every call, so it only uses modules the interpreter
+# loads anyway. Writing a snapshot needs a StorageManager.
+
+import os
+import mmap
+import struct
+
+SNAPSHOT_MAGIC = b"YLDASNAP"
+SNAPSHOT_VERSION = 1
+
+# magic, version, record count, then the offsets of the names, the
+# records and the drive table, then the database stamp (see db_stamp)
+HEADER = struct.Struct("<8sIQQQQqqqq")
+
+# offset of the name in the names section, its length in bytes, drive index
+RECORD = struct.Struct("<QIH2x")
+
+# length of one drive name in the drive table
+DRIVE_NAME_LENGTH = struct.Struct("<H")
+
+def db_stamp(db_path):
+    """
+    (mtime_ns, size) of the database file and of its write-ahead log.
+    A commit changes one of them. A missing or empty log gives (0, 0),
+    as SQLite deletes or truncates it when it is fully checkpointed.
+
+    On NFS, the attribute cache can hide a change for a few seconds
+    (the actimeo mount option).
+    """
+    st = os.stat(db_path)
+    try:
+        wal = os.stat(db_path + "-wal")
+        wal_stamp = (wal.st_mtime_ns, wal.st_size) if wal.st_size else (0, 0)
+    except FileNotFoundError:
+        wal_stamp = (0, 0)
+    return (st.st_mtime_ns, st.st_size) + wal_stamp
+
+class BranchSnapshot:
+    def __init__(self, file, mm):
+        """
+        A snapshot file opened by BranchSnapshot.open.
+        """
+        self._file = file
+        self._mm = mm
+        (_, _, self.count, self._names_offset, self._records_offset,
+         drives_offset, *stamp) = HEADER.unpack_from(mm, 0)
+        self.stamp = tuple(stamp)
+
+        self.drives = []
+        offset = drives_offset
+        while offset < len(mm):
+            (length, ) = DRIVE_NAME_LENGTH.unpack_from(mm, offset)
+            offset += DRIVE_NAME_LENGTH.size
+            self.drives.append(mm[offset:offset + length].decode())
+            offset += length
+
+    @classmethod
+    def open(cls, path):
+        """
+        Map a snapshot file into memory.
+
+        Returns:
+        - BranchSnapshot, or None if there is no snapshot at path or it was
+          written by another version.
+        """
+        try:
+            file = open(path, "rb")
+        except OSError:
+            return None
+
+        try:
+            mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            file.close()
+            return None
+
+        if len(mm) < HEADER.size or HEADER.unpack_from(mm, 0)[:2] != (SNAPSHOT_MAGIC, SNAPSHOT_VERSION):
+            mm.close()
+            file.close()
+            return None
+        return cls(file, mm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def is_fresh(self, db_path):
+        """
+        Whether the database is unchanged since the snapshot was written.
+        """
+        try:
+            return db_stamp(db_path) == self.stamp
+        except OSError:
+            return False
+
+    def get_drive(self, branch_path):
+        """
+        Binary search for a branch. Records are read in place from the
+        mapping; only the names probed are copied out for comparison.
+
+        Returns:
+        - The drive name, or None if the branch is not in the snapshot.
+        """
+        key = branch_path.encode()
+        mm = self._mm
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset, length, drive = RECORD.unpack_from(mm, self._records_offset + middle * RECORD.size)
+            start = self._names_offset + offset
+            name = mm[start:start + length]
+            if name < key:
+                low = middle + 1
+            elif name > key:
+                high = middle
+            else:
+                return self.drives[drive]
+        return None
+
+def write_snapshot(storage, path, retries=3):
+    """
+    Write every branch record to a snapshot file, sorted by branch_path in
+    the byte order SQLite uses, and swap it in atomically with os.replace.
+    Readers that have the old file open keep reading the old file.
+
+    Records are streamed from the database and the record table is spooled
+    to a temporary file, so memory use does not depend on the size of the
+    table. The snapshot is stamped with the database's db_stamp after the
+    log is checkpointed. If another connection commits while the snapshot
+    is written, it is written again, up to retries times; a snapshot that
+    is still stale is written anyway and is_fresh will report it.
+
+    Keyword arguments:
+    - storage: StorageManager of the database.
+    - path: Path of the snapshot file.
+    - retries: Attempts to write a snapshot without a concurrent commit.
+
+    Returns:
+    - int: Number of records written.
+    """
+    tmp_path = "{}.tmp-{}".format(path, os.getpid())
+    try:
+        for attempt in range(retries):
+            data_version = storage.get_data_version()
+            count = _write_file(storage, tmp_path)
+            storage.checkpoint()
+            stamp = db_stamp(storage.db_path)
+            if storage.get_data_version() == data_version:
+                break
+
+        with open(tmp_path, "r+b") as f:
+            header = bytearray(f.read(HEADER.size))
+            HEADER.pack_into(header, 0, *HEADER.unpack(bytes(header))[:6], *stamp)
+            f.seek(0)
+            f.write(header)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return count
+
+def _write_file(storage, path):
+    """
+    Write a snapshot without its stamp. Returns the number of records.
+    """
+    import tempfile
+
+    drives = {}
+    count = 0
+    with open(path, "wb") as f, tempfile.TemporaryFile() as records:
+        f.write(b"\0" * HEADER.size)
+        names_offset = f.tell()
+
+        name_offset = 0
+        for branch_path, drive_name in storage.iter_locations():
+            name = branch_path.encode()
+            f.write(name)
+            drive = drives.setdefault(drive_name, len(drives))
+            records.write(RECORD.pack(name_offset, len(name), drive))
+            name_offset += len(name)
+            count += 1
+
+        records_offset = f.tell()
+        records.seek(0)
+        while True:
+            chunk = records.read(1 << 20)
+            if not chunk:
+                break
+            f.write(chunk)
+
+        drives_offset = f.tell()
+        for drive_name in drives:
+            name = drive_name.encode()
+            f.write(DRIVE_NAME_LENGTH.pack(len(name)) + name)
+
+        f.seek(0)
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, count,
+                            names_offset, records_offset, drives_offset, 0, 0, 0, 0))
+
+    return count
@@ -1,109 +1,982 @@
 # data_allocator/storage_manager.py
 
 import sqlite3
+import threading
 import os
 
+from contextlib import contextmanager
+from data_allocator import instrumentation
+from data_allocator.constants import JOURNAL_MODE
 from data_allocator.exceptions import StorageManagerException
 
+# SQLite limits the number of host parameters in one statement
+# (999 in older builds), so IN (...) lookups are split into chunks.
+SQL_CHUNK_SIZE = 900
+
+# Stored in PRAGMA user_version once the tables and indexes below exist.
+# Raise it whenever _initialize_db changes, so older databases are upgraded.
+SCHEMA_VERSION = 1
+
+def branch_parent(branch_path):
+    """
+    Return the parent path of a branch, "" for a top-level branch.
+    """
+    return branch_path.rpartition("/")[0]
+
+def branch_depth(branch_path):
+    """
+    Return the number of path components in a branch, 0 for the root "".
+    """
+    return branch_path.count("/") + 1 if branch_path else 0
+
+def branch_range(root_branch):
+    """
+    Return the half-open key range [low, high) holding every branch
+    strictly below root_branch. "0" is the character after "/", so
+    the range covers exactly the keys starting with root_branch + "/".
+    """
+    if not root_branch:
+        return "", "\U0010ffff"
+    return root_branch + "/", root_branch + "0"
+
 class StorageManager:
-    def __init__(self, db_path):
+    def __init__(self, db_path, journal_mode=JOURNAL_MODE, busy_timeout=30.0):
         """
         Initialize the StorageManager with the database path.
+
+        A single connection is opened here and reused by every method
+        until close() is called. sqlite3 keeps the compiled form of each
+        query below in the per-connection statement cache, so repeated
+        calls do not re-parse the SQL.
+
+        Keyword arguments:
+        - db_path: Path to the SQLite database.
+        - journal_mode: SQLite journal mode (see JOURNAL_MODE), or None
+                        to keep the database's current mode. "WAL" lets
+                        readers proceed while a writer is active, but
+                        needs shared memory between clients, so it must
+                        not be used from several hosts over NFS.
+        - busy_timeout: Seconds to wait for a lock held by another
+                        connection before giving up.
         """
         self.db_path = db_path
+        self._lock = threading.RLock()
+        self._conn = None
+        self._tx_depth = 0
+        self._connect(journal_mode=journal_mode, busy_timeout=busy_timeout)
         self._initialize_db()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @instrumentation.timed("storage.connect")
+    def _connect(self, journal_mode, busy_timeout):
+        """
+        Open the shared connection and apply the connection pragmas.
+        """
+        conn = sqlite3.connect(self.db_path,
+                               timeout=busy_timeout,
+                               isolation_level=None,
+                               check_same_thread=False,
+                               cached_statements=256,
+                               )
+        instrumentation.trace_connection(conn)
+        if journal_mode:
+            try:
+                conn.execute("PRAGMA journal_mode={};".format(journal_mode))
+            except sqlite3.OperationalError:
+                # leaving WAL needs the only connection; a later open switches
+                pass
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA cache_size=-16000;")
+        self._conn = conn
+
+    def close(self):
+        """
+        Close the database connection. Safe to call more than once.
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @property
+    def conn(self):
+        """
+        The open connection. Raises if the manager has been closed.
+        """
+        if self._conn is None:
+            raise StorageManagerException(f"[ERROR] Database '{self.db_path}' is closed.")
+        return self._conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the enclosed statements in a single transaction,
+        rolling back if any of them fails.
+
+        The write lock is taken up front (BEGIN IMMEDIATE), so two writers
+        never deadlock on a lock upgrade. A writer waits up to busy_timeout
+        for the lock. Nested use, including the StorageManager methods called
+        inside, joins the outer transaction through a savepoint, which lets
+        callers such as Allocator group several calls into one atomic step.
+        """
+        with self._lock:
+            conn = self.conn
+            if self._tx_depth:
+                savepoint = "sp{}".format(self._tx_depth)
+                conn.execute("SAVEPOINT {};".format(savepoint))
+                self._tx_depth += 1
+                try:
+                    yield conn
+                except BaseException:
+                    conn.execute("ROLLBACK TO {};".format(savepoint))
+                    conn.execute("RELEASE {};".format(savepoint))
+                    raise
+                else:
+                    conn.execute("RELEASE {};".format(savepoint))
+                finally:
+                    self._tx_depth -= 1
+                return
+
+            try:
+                conn.execute("BEGIN IMMEDIATE;")
+            except sqlite3.OperationalError as e:
+                raise StorageManagerException(f"[ERROR] Database '{self.db_path}' is busy: {e}")
+
+            self._tx_depth = 1
+            try:
+                yield conn
+                conn.execute("COMMIT;")
+            except BaseException as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK;")
+                if isinstance(e, sqlite3.OperationalError):
+                    raise StorageManagerException(f"[ERROR] Database '{self.db_path}' is busy: {e}") from e
+                raise
+            finally:
+                self._tx_depth = 0
+
+    @instrumentation.timed("storage.initialize_db")
     def _initialize_db(self):
         """
         Initialize the database and create the table if it doesn't exist.
+
+        The schema version is read first without a lock, so opening an
+        up-to-date database does not wait for a writer. The write lock is
+        only taken to create or upgrade the tables.
         """
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
+        if self._schema_version() == SCHEMA_VERSION:
+            return
+
+        with self.transaction() as conn:
+            # another connection may have upgraded it while we waited
+            if self._schema_version() == SCHEMA_VERSION:
+                return
+            conn.execute('''
                 CREATE TABLE IF NOT EXISTS data_location (
                     branch_path TEXT PRIMARY KEY,
-                    drive_name TEXT
+                    drive_name TEXT,
+                    parent_path TEXT,
+                    depth INTEGER
                 );
             ''')
-            conn.commit()
+            self._migrate_parent_depth(conn)
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS data_location_depth
+                ON data_location (depth, branch_path);
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS data_location_parent
+                ON data_location (parent_path);
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS reservations (
+                    branch_path TEXT PRIMARY KEY,
+                    drive_name TEXT,
+                    reserved_bytes INTEGER,
+                    expires_at REAL
+                );
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS space_cache (
+                    drive_name TEXT PRIMARY KEY,
+                    free_bytes INTEGER,
+                    checked_at REAL
+                );
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS usage_cache (
+                    dir_path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER,
+                    own_apparent INTEGER,
+                    own_allocated INTEGER,
+                    own_files INTEGER,
+                    subdirs TEXT,
+                    linked TEXT,
+                    scanned_at_ns INTEGER,
+                    total_apparent INTEGER,
+                    total_allocated INTEGER,
+                    total_files INTEGER,
+                    total_dirs INTEGER,
+                    totals_at_ns INTEGER
+                );
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rebalance_moves (
+                    branch_path TEXT PRIMARY KEY,
+                    source_drive TEXT,
+                    target_drive TEXT,
+                    size INTEGER,
+                    state TEXT
+                );
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS hash_cache (
+                    dev INTEGER,
+                    inode INTEGER,
+                    mtime_ns INTEGER,
+                    size INTEGER,
+                    partial_hash TEXT,
+                    full_hash TEXT,
+                    PRIMARY KEY (dev, inode)
+                );
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS branch_moves (
+                    branch_path TEXT PRIMARY KEY,
+                    source_drive TEXT,
+                    target_drive TEXT,
+                    state TEXT
+                );
+            ''')
+            conn.execute("PRAGMA user_version = {};".format(SCHEMA_VERSION))
 
-    def record_location(self, branch_path, drive_name):
+    def _schema_version(self):
+        """
+        Return the schema version stored in the database, 0 if none.
+        """
+        try:
+            return self.conn.execute("PRAGMA user_version;").fetchone()[0]
+        except sqlite3.OperationalError as e:
+            raise StorageManagerException(f"[ERROR] Database '{self.db_path}' is busy: {e}") from e
+
+    def _migrate_parent_depth(self, conn):
+        """
+        Add and fill the parent_path/depth columns in databases
+        created before they existed.
+        """
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(data_location);")]
+        if "depth" in columns:
+            return
+
+        conn.execute("ALTER TABLE data_location ADD COLUMN parent_path TEXT;")
+        conn.execute("ALTER TABLE data_location ADD COLUMN depth INTEGER;")
+        branch_paths = [row[0] for row in conn.execute("SELECT branch_path FROM data_location;")]
+        conn.executemany('''
+            UPDATE data_location SET parent_path = ?, depth = ?
+            WHERE branch_path = ?;
+        ''', [(branch_parent(b), branch_depth(b), b) for b in branch_paths])
+
+    @instrumentation.timed("storage.record_location")
+    def record_location(self, branch_path, drive_name, reserved_bytes=None, expires_at=None):
         """
         Record the storage location of a branch.
 
         Keyword arguments:
         - branch_path: The path of the branch.
         - drive_name: The name of the drive.
+        - reserved_bytes: Also reserve this much space on the drive for the
+                          branch, in the same transaction.
+        - expires_at: time.time() after which the reservation lapses.
+        """
+        self.record_locations([(branch_path, drive_name)], 
+                              reserved_bytes=reserved_bytes, 
+                              expires_at=expires_at, 
+                              )
+
+    @instrumentation.timed("storage.record_locations")
+    def record_locations(self, locations, reserved_bytes=None, expires_at=None):
+        """
+        Record many branch locations in a single transaction.
+        Nothing is written if any of the branches is already recorded.
+
+        Keyword arguments:
+        - locations: Iterable of (branch_path, drive_name) tuples.
+        - reserved_bytes: Also reserve this much space for every branch.
+        - expires_at: time.time() after which the reservations lapse.
         """
-        if self.check_duplicates(branch_path):
-            raise StorageManagerException(f"[ERROR] Duplicate entry for '{branch_path}' exists.")
-        
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO data_location (branch_path, drive_name)
-                VALUES (?, ?);
-            ''', (branch_path, drive_name))
-            conn.commit()
+        locations = list(locations)
+        with self.transaction() as conn:
+            # the branch_path primary key rejects duplicates, no separate check is needed;
+            # the savepoint undoes the rows inserted before a duplicate
+            try:
+                with self.transaction():
+                    conn.executemany('''
+                        INSERT INTO data_location (branch_path, drive_name, parent_path, depth)
+                        VALUES (?, ?, ?, ?);
+                    ''', [(branch_path, drive_name, branch_parent(branch_path), branch_depth(branch_path))
+                          for branch_path, drive_name in locations])
+            except sqlite3.IntegrityError:
+                duplicate = self._first_duplicate([branch_path for branch_path, _ in locations])
+                raise StorageManagerException(f"[ERROR] Duplicate entry for '{duplicate}' exists.")
 
+            if reserved_bytes:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO reservations (branch_path, drive_name, reserved_bytes, expires_at)
+                    VALUES (?, ?, ?, ?);
+                ''', [(branch_path, drive_name, reserved_bytes, expires_at)
+                      for branch_path, drive_name in locations])
+
+    def _first_duplicate(self, branch_paths):
+        """
+        Name a branch that is recorded already or repeated in branch_paths.
+        """
+        seen = set()
+        for branch_path in branch_paths:
+            if branch_path in seen:
+                return branch_path
+            seen.add(branch_path)
+        existing = self.get_drives(branch_paths)
+        return next(iter(existing)) if existing else None
+
+    @instrumentation.timed("storage.get_reserved_bytes")
+    def get_reserved_bytes(self, now):
+        """
+        Return the space reserved on each drive by outstanding reservations.
+        Reservations that expired before now are deleted.
+
+        Keyword arguments:
+        - now: Current time.time().
+
+        Returns:
+        - drive2reserved: dictionary of drive name and reserved bytes
+        """
+        with self.transaction() as conn:
+            conn.execute('''
+                DELETE FROM reservations WHERE expires_at <= ?;
+            ''', (now, ))
+            cursor = conn.execute('''
+                SELECT drive_name, SUM(reserved_bytes) FROM reservations
+                GROUP BY drive_name;
+            ''')
+            drive2reserved = {row[0]: row[1] for row in cursor}
+
+        return drive2reserved
+
+    @instrumentation.timed("storage.release_reservations")
+    def release_reservations(self, branch_paths):
+        """
+        Drop the space reservations of branches, e.g. once their usage is measured.
+        """
+        with self.transaction() as conn:
+            conn.executemany('''
+                DELETE FROM reservations WHERE branch_path = ?;
+            ''', [(branch_path, ) for branch_path in branch_paths])
+
+    @instrumentation.timed("storage.get_drive")
     def get_drive(self, branch_path):
         """
         Retrieve the drive a given branch is stored in.
         Return None if the branch is not found.
         """
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
+        with self._lock:
+            result = self.conn.execute('''
                 SELECT drive_name FROM data_location
                 WHERE branch_path= ?;
-            ''', (branch_path,))
-            result = cursor.fetchone()
-        
+            ''', (branch_path,)).fetchone()
+
         if result:
             return result[0]
         else:
             return None
 
+    @instrumentation.timed("storage.get_drives")
+    def get_drives(self, branch_paths):
+        """
+        Retrieve the drives of many branches at once.
+        Branches that are not recorded are left out of the result.
+
+        Keyword arguments:
+        - branch_paths: Iterable of branch paths.
+
+        Returns:
+        - branch2drive: dictionary of branch and drive names
+        """
+        branch_paths = list(branch_paths)
+        branch2drive = {}
+        with self._lock:
+            for start in range(0, len(branch_paths), SQL_CHUNK_SIZE):
+                chunk = branch_paths[start:start + SQL_CHUNK_SIZE]
+                cursor = self.conn.execute('''
+                    SELECT branch_path, drive_name FROM data_location
+                    WHERE branch_path IN ({});
+                '''.format(", ".join("?" * len(chunk))), chunk)
+                branch2drive.update(cursor)
+
+        return branch2drive
+
     def check_duplicates(self, branch_path):
         """
         Check if a branch is already recorded.
         """
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
+        with self._lock:
+            count = self.conn.execute('''
                 SELECT COUNT(*) FROM data_location
                 WHERE branch_path = ?;
-            ''', (branch_path, ))
-            count = cursor.fetchone()[0]
-        
+            ''', (branch_path, )).fetchone()[0]
+
         return count > 0
 
+    @instrumentation.timed("storage.delete_location")
     def delete_location(self, branch_path):
         """
         Delete the record of a branch location.
+        Returns True if a record was deleted.
         """
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
+        with self.transaction() as conn:
+            cursor = conn.execute('''
                 DELETE FROM data_location
                 WHERE branch_path = ?;
             ''', (branch_path, ))
-            conn.commit()
-        
+
+        return cursor.rowcount > 0
+
+    @instrumentation.timed("storage.delete_locations_under")
+    def delete_locations_under(self, branch_path):
+        """
+        Delete the records and reservations of a branch and of every
+        branch below it, with range scans on branch_path.
+        Returns the number of records deleted.
+        """
+        low, high = branch_range(branch_path)
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+                DELETE FROM data_location
+                WHERE branch_path = ? OR (branch_path >= ? AND branch_path < ?);
+            ''', (branch_path, low, high))
+            conn.execute('''
+                DELETE FROM reservations
+                WHERE branch_path = ? OR (branch_path >= ? AND branch_path < ?);
+            ''', (branch_path, low, high))
+
+        return cursor.rowcount
+
+    @instrumentation.timed("storage.rename_locations_under")
+    def rename_locations_under(self, branch_path, new_path):
+        """
+        Rename a branch and every branch below it by replacing the
+        branch_path prefix with new_path, with range scans on branch_path.
+        Their reservations are renamed with them.
+
+        Returns:
+        - int: Number of records renamed.
+
+        Raises:
+        - StorageManagerException: If one of the new names is recorded already.
+        """
+        low, high = branch_range(branch_path)
+        # substr() counts from 1
+        tail = len(branch_path) + 1
+        with self.transaction() as conn:
+            try:
+                with self.transaction():
+                    cursor = conn.execute('''
+                        UPDATE data_location SET
+                            branch_path = ? || substr(branch_path, ?),
+                            parent_path = CASE WHEN branch_path = ? THEN ? ELSE ? || substr(parent_path, ?) END,
+                            depth = depth + ?
+                        WHERE branch_path = ? OR (branch_path >= ? AND branch_path < ?);
+                    ''', (new_path, tail, 
+                          branch_path, branch_parent(new_path), new_path, tail, 
+                          branch_depth(new_path) - branch_depth(branch_path), 
+                          branch_path, low, high, 
+                          ))
+                    conn.execute('''
+                        UPDATE reservations SET branch_path = ? || substr(branch_path, ?)
+                        WHERE branch_path = ? OR (branch_path >= ? AND branch_path < ?);
+                    ''', (new_path, tail, branch_path, low, high))
+            except sqlite3.IntegrityError:
+                raise StorageManagerException(f"[ERROR] A branch at or below '{new_path}' is recorded already.")
+
+        return cursor.rowcount
+
+    def get_data_version(self):
+        '''
+        Return SQLite's data_version, which changes whenever another
+        connection commits to the database. Used to tell when copies
+        of the records kept in memory are stale.
+        '''
+        with self._lock:
+            return self.conn.execute("PRAGMA data_version;").fetchone()[0]
+
+    def checkpoint(self):
+        '''
+        Copy the write-ahead log into the database file and empty it.
+        A no-op outside WAL mode.
+
+        Returns:
+        - bool: False if readers or writers kept the log from being emptied.
+        '''
+        with self._lock:
+            busy = self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchone()[0]
+        return not busy
+
+    def update_drive(self, branch_path, source_drive, target_drive):
+        '''
+        Point a branch recorded on source_drive at target_drive.
+        Space reserved for the branch moves with it.
+
+        Returns:
+        - bool: False if the branch is not recorded on source_drive.
+        '''
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+                UPDATE data_location SET drive_name = ?
+                WHERE branch_path = ? AND drive_name = ?;
+            ''', (target_drive, branch_path, source_drive))
+            if cursor.rowcount == 0:
+                return False
+
+            conn.execute('''
+                UPDATE reservations SET drive_name = ?
+                WHERE branch_path = ?;
+            ''', (target_drive, branch_path))
+
+        return True
+
+    def update_drive_under(self, branch_path, source_drive, target_drive):
+        '''
+        Point a branch recorded on source_drive and the branches below it
+        on the same drive at target_drive. Branches below it on other
+        drives are left alone. Space reserved for them moves with them.
+
+        Returns:
+        - int: Number of records updated, 0 if the branch itself
+               is not recorded on source_drive.
+        '''
+        low, high = branch_range(branch_path)
+        with self.transaction() as conn:
+            if self.get_drive(branch_path) != source_drive:
+                return 0
+
+            cursor = conn.execute('''
+                UPDATE data_location SET drive_name = ?
+                WHERE drive_name = ? AND (branch_path = ? OR (branch_path >= ? AND branch_path < ?));
+            ''', (target_drive, source_drive, branch_path, low, high))
+            conn.execute('''
+                UPDATE reservations SET drive_name = ?
+                WHERE drive_name = ? AND (branch_path = ? OR (branch_path >= ? AND branch_path < ?));
+            ''', (target_drive, source_drive, branch_path, low, high))
+
+        return cursor.rowcount
+
+    @instrumentation.timed("storage.get_all_locations2drive")
     def get_all_locations2drive(self):
         '''
-        Return a dictionary of all branch locations 
+        Return a dictionary of all branch locations
         and their corresponding drive names.
 
-        Return: 
+        Return:
         - locations2drive: dictionary of branch and drive names
         '''
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT * FROM data_location;
+        with self._lock:
+            cursor = self.conn.execute('''
+                SELECT branch_path, drive_name FROM data_location;
             ''')
-            locations = {row[0]: row[1] for row in cursor.fetchall()}
-        
+            locations = {row[0]: row[1] for row in cursor}
+
         return locations
 
+    @instrumentation.timed("storage.get_locations2drive_under")
+    def get_locations2drive_under(self, root_branch, max_depth=None):
+        '''
+        Return the branches strictly below root_branch and their drives.
+        The prefix filter runs in SQLite as a range scan on branch_path.
+
+        Keyword arguments:
+        - root_branch: The branch to list below, "" for the whole table.
+        - max_depth: Only return branches at most this many levels
+                     below root_branch. None for no limit.
+
+        Return:
+        - locations2drive: dictionary of branch and drive names
+        '''
+        low, high = branch_range(root_branch)
+        with self._lock:
+            if max_depth is None:
+                cursor = self.conn.execute('''
+                    SELECT branch_path, drive_name FROM data_location
+                    WHERE branch_path >= ? AND branch_path < ?;
+                ''', (low, high))
+            else:
+                # One index seek per level on (depth, branch_path)
+                root_depth = branch_depth(root_branch)
+                depths = list(range(root_depth + 1, root_depth + max_depth + 1))
+                cursor = self.conn.execute('''
+                    SELECT branch_path, drive_name FROM data_location
+                    WHERE depth IN ({}) AND branch_path >= ? AND branch_path < ?;
+                '''.format(", ".join("?" * len(depths))), depths + [low, high])
+            locations = {row[0]: row[1] for row in cursor}
+
+        return locations
+
+    def iter_locations(self, chunk_size=10000):
+        '''
+        Yield (branch_path, drive_name) of every branch, sorted by branch_path.
+        Rows are fetched chunk_size at a time, so only one chunk is held in memory.
+        '''
+        with self._lock:
+            cursor = self.conn.execute('''
+                SELECT branch_path, drive_name FROM data_location
+                ORDER BY branch_path;
+            ''')
+
+        try:
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+    def iter_drive_locations_under(self, drive_name, branch_path, chunk_size=10000):
+        '''
+        Yield the branches recorded on a drive at or below branch_path.
+
+        They come in the order of a depth-first walk that lists children
+        sorted by name + "/" (the order of branch_path || '/'), so they can be
+        merged with directory listings sorted the same way. Rows are fetched
+        chunk_size at a time, so only one chunk is held in memory.
+
+        Keyword arguments:
+        - drive_name: The drive to list.
+        - branch_path: The branch to list at and below.
+        - chunk_size: Rows fetched per call into SQLite.
+        '''
+        low, high = branch_range(branch_path)
+        with self._lock:
+            cursor = self.conn.execute('''
+                SELECT branch_path FROM data_location
+                WHERE drive_name = ? AND (branch_path = ? OR (branch_path >= ? AND branch_path < ?))
+                ORDER BY branch_path || '/';
+            ''', (drive_name, branch_path, low, high))
+
+        try:
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row[0]
+        finally:
+            cursor.close()
+
+    def has_locations_below(self, branch_path, drive_name):
+        '''
+        Whether a branch strictly below branch_path is recorded on drive_name.
+        '''
+        low, high = branch_range(branch_path)
+        with self._lock:
+            row = self.conn.execute('''
+                SELECT 1 FROM data_location
+                WHERE branch_path >= ? AND branch_path < ? AND drive_name = ?
+                LIMIT 1;
+            ''', (low, high, drive_name)).fetchone()
+
+        return row is not None
+
+    @instrumentation.timed("storage.get_branch_prefixes")
+    def get_branch_prefixes(self, root_branch, depth):
+        '''
+        Return the distinct ancestors at the given depth of the branches
+        below root_branch that are deeper than depth. These are the nodes
+        implied by deeper branches when a listing is cut off at depth.
+
+        Each prefix costs one index seek: after a prefix is found, the
+        scan jumps past all keys starting with it.
+
+        Keyword arguments:
+        - root_branch: The branch to search below, "" for the whole table.
+        - depth: Absolute depth of the prefixes to return.
+
+        Return:
+        - prefixes: list of branch paths
+        '''
+        low, high = branch_range(root_branch)
+        prefixes = []
+        with self._lock:
+            while True:
+                row = self.conn.execute('''
+                    SELECT branch_path FROM data_location
+                    WHERE branch_path >= ? AND branch_path < ? AND depth > ?
+                    ORDER BY branch_path LIMIT 1;
+                ''', (low, high, depth)).fetchone()
+                if row is None:
+                    break
+
+                prefix = "/".join(row[0].split("/")[:depth])
+                prefixes.append(prefix)
+                low = prefix + "0"
+
+        return prefixes
+
+    @instrumentation.timed("storage.get_space_cache")
+    def get_space_cache(self):
+        '''
+        Return the last free-space measurement of every drive.
+
+        Return:
+        - drive2space: dictionary of drive name and (free_bytes, checked_at),
+                       where free_bytes is None for a drive that did not answer
+        '''
+        with self._lock:
+            cursor = self.conn.execute('''
+                SELECT drive_name, free_bytes, checked_at FROM space_cache;
+            ''')
+            drive2space = {row[0]: (row[1], row[2]) for row in cursor}
+
+        return drive2space
+
+    @instrumentation.timed("storage.put_space_cache")
+    def put_space_cache(self, drive2free, checked_at):
+        '''
+        Store free-space measurements.
+
+        Keyword arguments:
+        - drive2free: dictionary of drive name and free bytes (None if unavailable)
+        - checked_at: time.time() of the measurement
+        '''
+        with self.transaction() as conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO space_cache (drive_name, free_bytes, checked_at)
+                VALUES (?, ?, ?);
+            ''', [(drive, free, checked_at) for drive, free in drive2free.items()])
+
+    @instrumentation.timed("storage.get_usage_entries")
+    def get_usage_entries(self, dir_paths):
+        '''
+        Return the cached disk usage rows of the given directories.
+        Directories without a row are left out.
+
+        Keyword arguments:
+        - dir_paths: Iterable of absolute directory paths.
+
+        Return:
+        - entries: dictionary of directory path and a tuple of the remaining
+                   usage_cache columns, in table order
+        '''
+        dir_paths = list(dir_paths)
+        entries = {}
+        with self._lock:
+            for start in range(0, len(dir_paths), SQL_CHUNK_SIZE):
+                chunk = dir_paths[start:start + SQL_CHUNK_SIZE]
+                cursor = self.conn.execute('''
+                    SELECT * FROM usage_cache
+                    WHERE dir_path IN ({});
+                '''.format(", ".join("?" * len(chunk))), chunk)
+                for row in cursor:
+                    entries[row[0]] = row[1:]
+
+        return entries
+
+    @instrumentation.timed("storage.put_usage_entries")
+    def put_usage_entries(self, entries, removed_dirs=()):
+        '''
+        Drop the rows of removed directories and write disk usage rows
+        in a single transaction.
+
+        Keyword arguments:
+        - entries: Iterable of usage_cache rows, dir_path first.
+        - removed_dirs: Directories whose rows, and the rows of
+                        everything below them, are deleted first.
+        '''
+        with self.transaction() as conn:
+            self._delete_usage_entries_under(conn, removed_dirs)
+            conn.executemany('''
+                INSERT OR REPLACE INTO usage_cache
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+            ''', entries)
+
+    def delete_usage_entries_under(self, dir_paths):
+        '''
+        Delete the cached disk usage of directories and everything below them.
+        '''
+        with self.transaction() as conn:
+            self._delete_usage_entries_under(conn, dir_paths)
+
+    def _delete_usage_entries_under(self, conn, dir_paths):
+        for dir_path in dir_paths:
+            low, high = branch_range(dir_path)
+            conn.execute('''
+                DELETE FROM usage_cache
+                WHERE dir_path = ? OR (dir_path >= ? AND dir_path < ?);
+            ''', (dir_path, low, high))
+
+    @instrumentation.timed("storage.get_hash_entries")
+    def get_hash_entries(self, keys):
+        '''
+        Return the cached hashes of files.
+
+        Keyword arguments:
+        - keys: Iterable of (st_dev, st_ino).
+
+        Return:
+        - dictionary of (st_dev, st_ino) and (mtime_ns, size, partial_hash, full_hash)
+                     for the files that have a row. full_hash may be None.
+        '''
+        inodes = {}
+        for dev, inode in keys:
+            inodes.setdefault(dev, []).append(inode)
+
+        entries = {}
+        with self._lock:
+            for dev, dev_inodes in inodes.items():
+                for start in range(0, len(dev_inodes), SQL_CHUNK_SIZE):
+                    chunk = dev_inodes[start:start + SQL_CHUNK_SIZE]
+                    cursor = self.conn.execute('''
+                        SELECT inode, mtime_ns, size, partial_hash, full_hash FROM hash_cache
+                        WHERE dev = ? AND inode IN ({});
+                    '''.format(", ".join("?" * len(chunk))), [dev] + chunk)
+                    for row in cursor:
+                        entries[(dev, row[0])] = row[1:]
+
+        return entries
+
+    @instrumentation.timed("storage.put_hash_entries")
+    def put_hash_entries(self, entries):
+        '''
+        Write file hashes in a single transaction, replacing older rows of the same files.
+
+        Keyword arguments:
+        - entries: Iterable of (st_dev, st_ino, mtime_ns, size, partial_hash, full_hash).
+        '''
+        with self.transaction() as conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO hash_cache (dev, inode, mtime_ns, size, partial_hash, full_hash)
+                VALUES (?, ?, ?, ?, ?, ?);
+            ''', entries)
+
+    def put_rebalance_moves(self, moves):
+        '''
+        Record a rebalance plan, every move in the "pending" state.
+
+        Keyword arguments:
+        - moves: Iterable of (branch_path, source_drive, target_drive, size).
+        '''
+        with self.transaction() as conn:
+            conn.executemany('''
+                INSERT INTO rebalance_moves (branch_path, source_drive, target_drive, size, state)
+                VALUES (?, ?, ?, ?, 'pending');
+            ''', moves)
+
+    def get_rebalance_moves(self):
+        '''
+        Return the unfinished rebalance moves in plan order.
+
+        Return:
+        - moves: list of (branch_path, source_drive, target_drive, size, state)
+        '''
+        with self._lock:
+            cursor = self.conn.execute('''
+                SELECT branch_path, source_drive, target_drive, size, state
+                FROM rebalance_moves ORDER BY rowid;
+            ''')
+            moves = cursor.fetchall()
+
+        return moves
+
+    def switch_location(self, branch_path, source_drive, target_drive):
+        '''
+        Point a branch at another drive and mark its rebalance move as
+        "switched", in one transaction. Space reserved for the branch
+        moves with it.
+
+        Raises:
+        - StorageManagerException: If the branch is no longer recorded on source_drive.
+        '''
+        with self.transaction() as conn:
+            if not self.update_drive(branch_path, source_drive, target_drive):
+                raise StorageManagerException(f"[ERROR] '{branch_path}' is no longer recorded on '{source_drive}'.")
+
+            conn.execute('''
+                UPDATE rebalance_moves SET state = 'switched'
+                WHERE branch_path = ?;
+            ''', (branch_path, ))
+
+    def delete_rebalance_move(self, branch_path):
+        '''
+        Forget a finished or abandoned rebalance move.
+        '''
+        with self.transaction() as conn:
+            conn.execute('''
+                DELETE FROM rebalance_moves
+                WHERE branch_path = ?;
+            ''', (branch_path, ))
+
+    def put_branch_move(self, branch_path, source_drive, target_drive):
+        '''
+        Record a move of a branch to another drive in the "pending" state.
+
+        Raises:
+        - StorageManagerException: If a move of the branch is recorded already.
+        '''
+        with self.transaction() as conn:
+            try:
+                conn.execute('''
+                    INSERT INTO branch_moves (branch_path, source_drive, target_drive, state)
+                    VALUES (?, ?, ?, 'pending');
+                ''', (branch_path, source_drive, target_drive))
+            except sqlite3.IntegrityError:
+                raise StorageManagerException(f"[ERROR] A move of '{branch_path}' is recorded already.")
+
+    def get_branch_moves(self):
+        '''
+        Return the unfinished branch moves in the order they were started.
+
+        Return:
+        - moves: list of (branch_path, source_drive, target_drive, state)
+        '''
+        with self._lock:
+            cursor = self.conn.execute('''
+                SELECT branch_path, source_drive, target_drive, state
+                FROM branch_moves ORDER BY rowid;
+            ''')
+            moves = cursor.fetchall()
+
+        return moves
+
+    def switch_branch_move(self, branch_path, source_drive, target_drive):
+        '''
+        Point a branch and the branches below it on the same drive at
+        target_drive (see update_drive_under) and mark its move as
+        "switched", in one transaction.
+
+        Raises:
+        - StorageManagerException: If the branch is no longer recorded on source_drive.
+        '''
+        with self.transaction() as conn:
+            if not self.update_drive_under(branch_path, source_drive, target_drive):
+                raise StorageManagerException(f"[ERROR] '{branch_path}' is no longer recorded on '{source_drive}'.")
+
+            conn.execute('''
+                UPDATE branch_moves SET state = 'switched'
+                WHERE branch_path = ?;
+            ''', (branch_path, ))
+
+    def delete_branch_move(self, branch_path):
+        '''
+        Forget a finished or abandoned branch move.
+        '''
+        with self.transaction() as conn:
+            conn.execute('''
+                DELETE FROM branch_moves
+                WHERE branch_path = ?;
+            ''', (branch_path, ))
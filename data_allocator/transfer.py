@@ -0,0 +1,356 @@
+# data_allocator/transfer.py
+
+import os
+import time
+import shutil
+import hashlib
+import secrets
+import functools
+import itertools
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from data_allocator.exceptions import AllocatorException
+
+DEFAULT_COPY_WORKERS = 8
+
+# Bytes read and written per call when a copy is rate limited or hashed.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Prefix of the directory, at the root of the destination, that copy_tree
+# writes each file into before renaming it into place. The rest of the name
+# is a random token drawn by each run.
+STAGING_PREFIX = ".allocator-copy-"
+
+class RateLimiter:
+    def __init__(self, bytes_per_second, burst=None):
+        """
+        Initialize a token bucket shared by the copy threads.
+
+        Keyword arguments:
+        - bytes_per_second: Average rate allowed across all threads.
+                            Any unit works, e.g. files per second.
+        - burst: Amount that may be taken at once after an idle period.
+                 Defaults to one second's worth, and at least one chunk.
+        """
+        self.rate = bytes_per_second
+        self.capacity = burst if burst is not None else max(bytes_per_second, COPY_CHUNK_SIZE)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        """
+        Take size bytes from the bucket, sleeping for as long as the
+        bucket is in debt. Later callers inherit the debt of earlier ones,
+        so the rate holds however many threads are copying.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+class TransferResult:
+    def __init__(self):
+        """
+        Totals of a copy_tree call.
+
+        - files_copied: Files (and symbolic links) written to the destination.
+        - files_skipped: Files already present with the same size and mtime.
+        - bytes_copied: Bytes written.
+        - dir_count: Directories walked, including the root.
+        """
+        self.files_copied = 0
+        self.files_skipped = 0
+        self.bytes_copied = 0
+        self.dir_count = 0
+
+def progress_counter(progress, stage):
+    """
+    Turn a progress(stage, files, bytes) callback into one taking the size
+    of each file as it is done, which copy_tree and compare_trees call from
+    their worker threads. files and bytes are the totals of the stage so far.
+
+    Returns:
+    - The per-file callback, or None if progress is None.
+    """
+    if progress is None:
+        return None
+
+    lock = threading.Lock()
+    totals = [0, 0]
+
+    def add(size):
+        with lock:
+            totals[0] += 1
+            totals[1] += size
+            progress(stage, totals[0], totals[1])
+    return add
+
+def _contains_excluded(rel_path, exclude):
+    """
+    Whether an excluded path lies below rel_path.
+    """
+    prefix = rel_path + "/"
+    return any(path.startswith(prefix) for path in exclude)
+
+def walk_files(root, exclude=()):
+    """
+    Walk a directory tree with os.scandir, skipping excluded subtrees.
+
+    Keyword arguments:
+    - root: Directory to walk.
+    - exclude: Set of directory paths relative to root, "/"-separated.
+
+    Yields:
+    - (rel_path, entry) for every directory, file and symbolic link below
+      root, parents before children. rel_path is "/"-separated.
+    """
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(root, rel_dir) if rel_dir else root) as entries:
+            for entry in entries:
+                rel_path = rel_dir + "/" + entry.name if rel_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if rel_path in exclude:
+                        continue
+                    yield rel_path, entry
+                    stack.append(rel_path)
+                else:
+                    yield rel_path, entry
+
+def _same_file(st, dst_path):
+    """
+    Whether dst_path looks like a finished copy of a file with stat st.
+    """
+    try:
+        dst_st = os.lstat(dst_path)
+    except FileNotFoundError:
+        return False
+    return dst_st.st_size == st.st_size and dst_st.st_mtime_ns == st.st_mtime_ns
+
+def _copy_file(src_path, dst_path, tmp_path, limiter):
+    """
+    Copy one file with its permissions and times. Runs in a worker thread.
+
+    The data goes to tmp_path in the staging directory first, so an
+    interrupted copy never leaves a truncated file that a later run would
+    take as finished.
+    """
+    if limiter is None:
+        shutil.copyfile(src_path, tmp_path)
+    else:
+        with open(src_path, "rb") as src, open(tmp_path, "wb") as dst:
+            while True:
+                chunk = src.read(COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                limiter.consume(len(chunk))
+                dst.write(chunk)
+    shutil.copystat(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+
+def _report_copied(progress, size, future):
+    """
+    Done callback of a file copy: report its size unless it failed.
+    """
+    if not future.cancelled() and future.exception() is None:
+        progress(size)
+
+def copy_tree(src, dst, workers=DEFAULT_COPY_WORKERS, bandwidth=None, exclude=(), progress=None):
+    """
+    Copy a directory tree, merging into dst if it exists.
+
+    Files are copied by a pool of worker threads. Files already in dst with
+    the same size and mtime are skipped, so an interrupted copy resumes
+    where it stopped. Symbolic links are copied as links. Hard links are
+    copied as separate files.
+
+    Each file is written into a staging directory at the root of dst, named
+    STAGING_PREFIX and a random token not used in src or dst, and renamed
+    into place once complete. The staging directory is removed when the
+    copy ends, unless the process is killed.
+
+    Keyword arguments:
+    - src: Source directory.
+    - dst: Destination directory.
+    - workers: Number of copy threads.
+    - bandwidth: Cap on the total copy rate in bytes per second. None for no cap.
+    - exclude: Set of directory paths relative to src that are not copied.
+    - progress: Called with the size of each file once it is copied,
+                from the copy threads. Skipped files are not reported.
+
+    Returns:
+    - TransferResult
+
+    Raises:
+    - AllocatorException: If src is not a directory.
+    """
+    if not os.path.isdir(src):
+        raise AllocatorException(f"[ERROR] Path '{src}' is not a directory.")
+
+    result = TransferResult()
+    limiter = RateLimiter(bandwidth) if bandwidth else None
+    os.makedirs(dst, exist_ok=True)
+    result.dir_count = 1
+    dirs = [""]
+
+    staging = _make_staging_dir(src, dst)
+    tmp_names = itertools.count()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = []
+            for rel_path, entry in walk_files(src, exclude):
+                src_path = entry.path
+                dst_path = os.path.join(dst, rel_path)
+                if entry.is_dir(follow_symlinks=False):
+                    os.makedirs(dst_path, exist_ok=True)
+                    result.dir_count += 1
+                    dirs.append(rel_path)
+                elif entry.is_symlink():
+                    if not os.path.lexists(dst_path):
+                        os.symlink(os.readlink(src_path), dst_path)
+                        result.files_copied += 1
+                    else:
+                        result.files_skipped += 1
+                else:
+                    st = entry.stat(follow_symlinks=False)
+                    if _same_file(st, dst_path):
+                        result.files_skipped += 1
+                        continue
+                    tmp_path = os.path.join(staging, str(next(tmp_names)))
+                    future = pool.submit(_copy_file, src_path, dst_path, tmp_path, limiter)
+                    if progress is not None:
+                        future.add_done_callback(functools.partial(_report_copied, progress, st.st_size))
+                    futures.append(future)
+                    result.files_copied += 1
+                    result.bytes_copied += st.st_size
+
+            for future in futures:
+                future.result()
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    # directory times last, deepest first, since copying into a directory changes them
+    for rel_path in reversed(dirs):
+        src_path = os.path.join(src, rel_path) if rel_path else src
+        shutil.copystat(src_path, os.path.join(dst, rel_path) if rel_path else dst)
+
+    return result
+
+def _make_staging_dir(src, dst):
+    """
+    Create the staging directory of a copy_tree run in dst.
+    """
+    while True:
+        name = STAGING_PREFIX + secrets.token_hex(8)
+        if os.path.lexists(os.path.join(src, name)):
+            continue
+        try:
+            os.mkdir(os.path.join(dst, name))
+        except FileExistsError:
+            continue
+        return os.path.join(dst, name)
+
+def _file_digest(path):
+    """
+    SHA-256 of a file. Runs in a worker thread.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def compare_trees(src, dst, workers=DEFAULT_COPY_WORKERS, checksum=False, exclude=(), progress=None):
+    """
+    Check that every file and link under src is in dst.
+
+    Files must match in size, and in SHA-256 with checksum. Links must
+    point to the same target. Extra files in dst are not reported.
+
+    Keyword arguments:
+    - src: Source directory.
+    - dst: Copy to check.
+    - workers: Number of hashing threads.
+    - checksum: Compare file contents, not only sizes.
+    - exclude: Set of directory paths relative to src that are not compared.
+    - progress: Called with the size of each file once it is compared.
+
+    Returns:
+    - list: Paths relative to src that are missing or differ, sorted.
+    """
+    mismatched = []
+    hashed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for rel_path, entry in walk_files(src, exclude):
+            dst_path = os.path.join(dst, rel_path)
+            try:
+                dst_st = os.lstat(dst_path)
+            except FileNotFoundError:
+                mismatched.append(rel_path)
+                continue
+
+            if entry.is_dir(follow_symlinks=False):
+                if not os.path.isdir(dst_path) or os.path.islink(dst_path):
+                    mismatched.append(rel_path)
+            elif entry.is_symlink():
+                if not os.path.islink(dst_path) or os.readlink(dst_path) != os.readlink(entry.path):
+                    mismatched.append(rel_path)
+            elif entry.stat(follow_symlinks=False).st_size != dst_st.st_size:
+                mismatched.append(rel_path)
+            elif checksum:
+                hashed.append((rel_path,
+                               dst_st.st_size,
+                               pool.submit(_file_digest, entry.path),
+                               pool.submit(_file_digest, dst_path),
+                               ))
+            elif progress is not None:
+                progress(dst_st.st_size)
+
+        for rel_path, size, src_digest, dst_digest in hashed:
+            if src_digest.result() != dst_digest.result():
+                mismatched.append(rel_path)
+            if progress is not None:
+                progress(size)
+
+    return sorted(mismatched)
+
+def remove_tree(path, exclude=()):
+    """
+    Remove a directory tree except the excluded subtrees.
+
+    The directories leading to an excluded subtree are kept, everything
+    else is removed. Without exclusions this is shutil.rmtree.
+
+    Keyword arguments:
+    - path: Directory to remove.
+    - exclude: Set of directory paths relative to path to keep.
+    """
+    if not exclude:
+        shutil.rmtree(path)
+        return
+
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(path, rel_dir) if rel_dir else path) as entries:
+            for entry in entries:
+                rel_path = rel_dir + "/" + entry.name if rel_dir else entry.name
+                if not entry.is_dir(follow_symlinks=False):
+                    os.unlink(entry.path)
+                elif rel_path in exclude:
+                    continue
+                elif _contains_excluded(rel_path, exclude):
+                    stack.append(rel_path)
+                else:
+                    shutil.rmtree(entry.path)
@@ -2,10 +2,9 @@
 
 import os
 
-import networkx as nx
-
-from collections import deque
-from data_allocator.storage_manager import StorageManager
+from data_allocator import instrumentation
+from data_allocator.branch_tree import BranchTree
+from data_allocator.storage_manager import StorageManager, branch_depth
 from data_allocator.exceptions import TreeVisualizerException
 
 class TreeVisualizer:
@@ -15,44 +14,38 @@ class TreeVisualizer:
         """
         self.storage = storage_manager
 
-    def build_tree(self, root_branch=None):
+    @instrumentation.timed("tree_visualizer.build_tree")
+    def build_tree(self, root_branch=None, max_depth=None, as_networkx=False):
         """
-        Build the tree structure using NetworkX DiGraph.
+        Build the tree structure as a BranchTree.
+
+        Only the branches below root_branch are read from the database,
+        so the cost depends on the size of the subtree, not of the table.
 
         Keyword arguments:
         - root_branch: The root branch to start building the tree from.
+        - max_depth: Only include nodes at most this many levels below
+                     root_branch. None for the whole subtree.
+        - as_networkx: Return a NetworkX DiGraph instead of a BranchTree.
 
         Returns:
-        - tree: A NetworkX DiGraph representing the tree structure.
+        - tree: A BranchTree (or DiGraph) representing the tree structure.
         """
-        tree = nx.DiGraph()
-        all_branches = self.storage.get_all_locations2drive()
-
         if not root_branch:
             root_branch = ""
-            branches2plot = list(all_branches.keys())
-        else:
-            branches2plot = [b for b in all_branches.keys() if b.startswith(root_branch) and (b != root_branch)] 
-
-        # sort the branches by length so that the parent nodes are added first
-        branches2plot.sort(key=len)
-
-        # build the tree
-        tree.add_node(root_branch)
-        for branch in branches2plot:
-            all_nodes = branch.replace(root_branch, "").lstrip("/").split("/")
-            if root_branch == "":
-                all_nodes_full_path = ["/".join(all_nodes[:i+1]) for i in range(len(all_nodes))]
-            else:
-                all_nodes_full_path = [root_branch + "/" + "/".join(all_nodes[:i+1]) for i in range(len(all_nodes))]
-
-            tree.add_edge(root_branch, all_nodes_full_path[0])
-            for i in range(0, len(all_nodes)-1):
-                parent = all_nodes_full_path[i]
-                child = all_nodes_full_path[i+1]
-
-                if not tree.has_edge(parent, child):
-                    tree.add_edge(parent, child)
+
+        tree = BranchTree(root_branch)
+        for branch in self.storage.get_locations2drive_under(root_branch, max_depth=max_depth):
+            tree.insert(branch)
+
+        if max_depth is not None and max_depth > 0:
+            # nodes at the cut-off depth that only exist as ancestors of deeper branches
+            cutoff = branch_depth(root_branch) + max_depth
+            for branch in self.storage.get_branch_prefixes(root_branch, cutoff):
+                tree.insert(branch)
+
+        if as_networkx:
+            return tree.to_networkx()
 
         return tree
 
@@ -68,6 +61,8 @@ class TreeVisualizer:
         Returns:
         - subtree (nx.DiGraph): The extracted subtree as a new graph.
         """
+        import networkx as nx
+
         descendants = nx.descendants(graph, root)  # Get all descendants
         subtree_nodes = {root} | descendants  # Include the root itself
         
@@ -82,27 +77,40 @@ class TreeVisualizer:
         return subtree
 
     @staticmethod
-    def tree2str(tree, indent_level=0, short_tree=False):
+    @instrumentation.timed("tree_visualizer.tree2str")
+    def tree2str(tree, indent_level=0, short_tree=False, annotations=None):
         """
-        String representation of a DiGraph tree.
+        String representation of a BranchTree or DiGraph tree.
+
+        annotations optionally maps node paths to a string printed
+        after the node, e.g. its size.
+
+        The tree is rendered with a single depth-first walk over an explicit
+        stack, visiting children in sorted order, so the cost is linear in
+        the number of nodes and deep trees do not hit the recursion limit.
         """
-        indent="    " * indent_level
-        root_nodes = [node for node in tree.nodes if tree.in_degree(node) == 0]
+        def node2str(node, level):
+            label = os.path.basename(node) if short_tree else node
+            if annotations and node in annotations:
+                label = "{}  [{}]".format(label, annotations[node])
+            return "    " * level + label + "\n"
+
+        if isinstance(tree, BranchTree):
+            return "".join(node2str(path, indent_level + level) for path, _, level in tree.walk())
+
+        root_nodes = [node for node, in_degree in tree.in_degree() if in_degree == 0]
 
         if not len(root_nodes) == 1:
             raise TreeVisualizerException("Tree has multiple roots")
-        
-        root_node = root_nodes[0]
 
-        child = list(tree.successors(root_node))
-        child.sort()
-        output_str = indent + "{}\n".format(os.path.basename(root_node) if short_tree else root_node)
+        lines = []
+        stack = [(root_nodes[0], indent_level)]
+        while stack:
+            node, level = stack.pop()
+            lines.append(node2str(node, level))
 
-        for c in child:
-            sub_tree = TreeVisualizer.get_subtree(tree, c)
-            output_str += TreeVisualizer.tree2str(sub_tree, 
-                                                  indent_level=indent_level+1, 
-                                                  short_tree=short_tree, 
-                                                  )
+            # push in reverse so the smallest child is popped first
+            child = sorted(tree.successors(node), reverse=True)
+            stack.extend((c, level + 1) for c in child)
 
-        return output_str
+        return "".join(lines)
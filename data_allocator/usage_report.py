@@ -0,0 +1,147 @@
+# data_allocator/usage_report.py
+
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from data_allocator.constants import TRASH_DIR_NAME
+from data_allocator.disk_usage import DiskUsageScanner, DEFAULT_WORKERS
+from data_allocator.reaper import is_deleted_name
+from data_allocator.tree_visualizer import TreeVisualizer
+
+class UsageReport:
+    def __init__(self, allocator, workers=DEFAULT_WORKERS, use_cache=False, refresh=False):
+        """
+        Initialize a usage report over every registered branch.
+
+        Each drive is scanned once, the drives in parallel, and every file
+        is attributed to the deepest branch registered on that drive above
+        it. Nested branches are therefore walked once, not once per ancestor.
+
+        Keyword arguments:
+        - allocator: Allocator giving access to the config and the database.
+        - workers: Number of scanner threads per drive.
+        - use_cache: Reuse the per-directory usage cache (see DiskUsageScanner).
+        - refresh: Walk everything and rewrite the cache.
+        """
+        self.allocator = allocator
+        self.workers = workers
+        self.use_cache = use_cache
+        self.refresh = refresh
+
+        self.tree = None
+        self.registered = {}
+        self.own = {}
+        self.totals = {}
+        self.error_count = 0
+
+    def _scan_drive(self, drive_path, root_branch, owners):
+        """
+        Scan root_branch on one drive. Returns the DiskUsageResult,
+        or None if the drive has no such directory.
+        """
+        path = os.path.abspath(os.path.join(drive_path, root_branch))
+        if not os.path.isdir(path):
+            return None
+
+        def exclude(rel_path):
+            # the trash and branches half-way through a delete are not usage
+            if os.path.join(root_branch, rel_path) == TRASH_DIR_NAME:
+                return True
+            return is_deleted_name(os.path.basename(rel_path))
+
+        scanner = DiskUsageScanner(workers=self.workers,
+                                   cache=self.allocator.storage if self.use_cache else None,
+                                   refresh=self.refresh,
+                                   owners=owners,
+                                   exclude=exclude,
+                                   )
+        return scanner.scan(path)
+
+    def build(self, root_branch=""):
+        """
+        Scan the drives and total the usage of every node below root_branch.
+
+        Keyword arguments:
+        - root_branch: The branch to report on, "" for everything.
+
+        Returns:
+        - self
+        """
+        root_branch = root_branch or ""
+        storage = self.allocator.storage
+        self.tree = TreeVisualizer(storage_manager=storage).build_tree(root_branch=root_branch)
+        self.registered = storage.get_locations2drive_under(root_branch)
+        root_drive = storage.get_drive(root_branch) if root_branch else None
+        if root_drive:
+            self.registered[root_branch] = root_drive
+
+        # owners are given relative to the scanned directory
+        prefix_len = len(root_branch) + 1 if root_branch else 0
+        drive_owners = {drive: set() for drive in self.allocator.config.get_drive_paths()}
+        for branch, drive in self.registered.items():
+            if drive in drive_owners:
+                drive_owners[drive].add(branch[prefix_len:])
+
+        drive_paths = self.allocator.config.get_drive_paths()
+        with ThreadPoolExecutor(max_workers=len(drive_paths) or 1) as pool:
+            futures = {drive: pool.submit(self._scan_drive, drive_path, root_branch, drive_owners[drive])
+                       for drive, drive_path in drive_paths.items()}
+            results = {drive: future.result() for drive, future in futures.items()}
+
+        self.own = {}
+        self.error_count = 0
+        for result in results.values():
+            if result is None:
+                continue
+            self.error_count += result.error_count
+            for owner, (apparent, allocated) in result.by_owner.items():
+                branch = root_branch + "/" + owner if (root_branch and owner) else (owner or root_branch)
+                sizes = self.own.get(branch, (0, 0))
+                self.own[branch] = (sizes[0] + apparent, sizes[1] + allocated)
+
+        # children come after their parent in the walk, so the reverse
+        # order totals every child before its parent
+        self.totals = {}
+        for path, node, _ in reversed(list(self.tree.walk())):
+            apparent, allocated = self.own.get(path, (0, 0))
+            if node.children:
+                prefix = path + "/" if path else ""
+                for name in node.children:
+                    child_apparent, child_allocated = self.totals[prefix + name]
+                    apparent += child_apparent
+                    allocated += child_allocated
+            self.totals[path] = (apparent, allocated)
+
+        return self
+
+    def size(self, branch, allocated=False):
+        """
+        Total size of a node, including everything below it.
+        """
+        return self.totals[branch][1 if allocated else 0]
+
+    def tree2str(self, short_tree=False, allocated=False, format_size=str):
+        """
+        The branch tree as printed by `ls`, with each node's total size.
+        """
+        annotations = {path: format_size(self.size(path, allocated=allocated)) for path in self.totals}
+        return TreeVisualizer.tree2str(self.tree, short_tree=short_tree, annotations=annotations)
+
+    def to_records(self, allocated=False):
+        """
+        One dictionary per node, largest first.
+        """
+        records = []
+        for path, (apparent, allocated_size) in self.totals.items():
+            own_apparent, own_allocated = self.own.get(path, (0, 0))
+            records.append({"branch": path,
+                            "drive": self.registered.get(path),
+                            "apparent_size": apparent,
+                            "allocated_size": allocated_size,
+                            "own_apparent_size": own_apparent,
+                            "own_allocated_size": own_allocated,
+                            })
+
+        key = "allocated_size" if allocated else "apparent_size"
+        records.sort(key=lambda record: (-record[key], record["branch"]))
+        return records
@@ -1,12 +1,33 @@
 # tests/AllocatorTest.py
 
 import unittest
+import json
+import time
 import os
 import shutil
-from data_allocator.allocator import Allocator
+import threading
+import multiprocessing
+
+from unittest import mock
+from data_allocator.allocator import Allocator, _running_probes
 from data_allocator.config_handler import ConfigHandler
 from data_allocator.exceptions import AllocatorException
 
+def allocate_concurrently(config_path, db_path, branch_names):
+    """
+    Allocate branches from a separate process.
+    Returns the number of allocations that succeeded.
+    """
+    allocated = 0
+    with Allocator(config_path=config_path, db_path=db_path) as allocator:
+        for branch_name in branch_names:
+            try:
+                allocator.allocate(branch_name)
+                allocated += 1
+            except AllocatorException:
+                pass
+    return allocated
+
 class TestAllocator(unittest.TestCase):
     @classmethod
     def setUp(cls):
@@ -32,6 +53,7 @@ class TestAllocator(unittest.TestCase):
         """
         Clean up by removing the test directories.
         """
+        cls.allocator.close()
         if os.path.exists(cls.wdir):
             for root, dirs, files in os.walk(cls.wdir, topdown=False):
                 for name in files:
@@ -49,6 +71,155 @@ class TestAllocator(unittest.TestCase):
 
         self.allocator.delete_branch("test_branch")
 
+    def test_allocate_many(self):
+        """
+        Test allocating a batch of branches.
+        """
+        branch_names = ["batch/b{}".format(i) for i in range(20)]
+        paths = self.allocator.allocate_many(branch_names)
+
+        self.assertEqual(len(paths), len(branch_names))
+        for branch_name, path in zip(branch_names, paths):
+            self.assertTrue(os.path.isdir(path))
+            self.assertEqual(self.allocator.get_path(branch_name), path)
+
+    def test_allocate_many_spreads_drives(self):
+        """
+        Test that a batch is split across drives by free space.
+        """
+        self.allocator.check_space = lambda: {"drive1": 300, "drive2": 100}
+        self.allocator.allocate_many(["spread/b{}".format(i) for i in range(8)])
+
+        drives = list(self.allocator.storage.get_all_locations2drive().values())
+        self.assertEqual(drives.count("drive1"), 6)
+        self.assertEqual(drives.count("drive2"), 2)
+
+    def test_allocate_many_duplicate(self):
+        """
+        Test that a batch containing a recorded branch allocates nothing.
+        """
+        self.allocator.allocate("dup_branch")
+        with self.assertRaises(AllocatorException):
+            self.allocator.allocate_many(["new_branch", "dup_branch"])
+        with self.assertRaises(AllocatorException):
+            self.allocator.allocate_many(["new_branch", "new_branch"])
+
+        self.assertIsNone(self.allocator.storage.get_drive("new_branch"))
+
+    def make_allocator(self, **options):
+        """
+        Allocator whose config has extra options.
+        """
+        config_path = os.path.join(self.wdir, "config.json")
+        with open(config_path, "w") as f:
+            json.dump(dict(options, drives={"drive1": self.drive1, "drive2": self.drive2}), f)
+        return Allocator(config_path=config_path, db_path=self.db_path)
+
+    def test_journal_mode(self):
+        """
+        Test that the database keeps the rollback journal unless the config asks for WAL.
+        """
+        journal_mode = "PRAGMA journal_mode;"
+        self.assertEqual(self.allocator.storage.conn.execute(journal_mode).fetchone()[0], "delete")
+        self.allocator.close()
+
+        with self.make_allocator(journal_mode="WAL") as allocator:
+            self.assertEqual(allocator.storage.conn.execute(journal_mode).fetchone()[0], "wal")
+
+    def test_check_space_cached(self):
+        """
+        Test that free space is re-used within the cache TTL.
+        """
+        with self.make_allocator(space_cache_ttl=60) as allocator, \
+                mock.patch("data_allocator.allocator.shutil.disk_usage", wraps=shutil.disk_usage) as disk_usage:
+            first = allocator.check_space()
+            second = allocator.check_space()
+
+        self.assertEqual(first, second)
+        self.assertEqual(disk_usage.call_count, 2)
+
+    def test_check_space_timeout(self):
+        """
+        Test that a drive that does not answer in time is skipped, and not probed again until it answers.
+        """
+        real_disk_usage = shutil.disk_usage
+        answer = threading.Event()
+        probed = []
+
+        def slow_drive1(path):
+            probed.append(path)
+            if path == self.drive1:
+                answer.wait(10)
+            return real_disk_usage(path)
+
+        with self.make_allocator(space_cache_ttl=0, space_check_timeout=0.2) as allocator, \
+                mock.patch("data_allocator.allocator.shutil.disk_usage", side_effect=slow_drive1):
+            try:
+                start = time.monotonic()
+                space_info = allocator.check_space(include_unavailable=True)
+                self.assertLess(time.monotonic() - start, 1.5)
+                self.assertIsNone(space_info["drive1"])
+
+                path = allocator.allocate("timeout_branch")
+                self.assertTrue(path.startswith(self.drive2))
+                self.assertEqual(probed.count(self.drive1), 1)
+                self.assertEqual(probed.count(self.drive2), 2)
+            finally:
+                answer.set()
+                _running_probes[self.drive1].join()
+
+            self.assertIsNotNone(allocator.check_space(include_unavailable=True)["drive1"])
+            self.assertEqual(probed.count(self.drive1), 2)
+
+    def test_reservations_spread_allocations(self):
+        """
+        Test that reserved space steers concurrent allocations to other drives.
+        """
+        self.allocator.check_space = lambda: {"drive1": 1000, "drive2": 900}
+
+        first = self.allocator.allocate("reserved_a", expected_size=300)
+        second = self.allocator.allocate("reserved_b", expected_size=300)
+        self.assertTrue(first.startswith(self.drive1))
+        self.assertTrue(second.startswith(self.drive2))
+
+        # measuring a branch releases its reservation
+        self.allocator.calculate_branch_disk_usage("reserved_a")
+        self.assertEqual(self.allocator.storage.get_reserved_bytes(now=time.time()), {"drive2": 300})
+
+        with self.assertRaises(AllocatorException):
+            self.allocator.allocate("too_big", expected_size=2000)
+
+    def test_reservations_expire(self):
+        """
+        Test that expired reservations no longer count.
+        """
+        self.allocator.allocate("expiring", expected_size=300)
+        self.assertEqual(sum(self.allocator.storage.get_reserved_bytes(now=time.time()).values()), 300)
+        self.assertEqual(self.allocator.storage.get_reserved_bytes(now=time.time() + 10**8), {})
+
+    def test_allocate_many_expected_size(self):
+        """
+        Test batch placement by projected free space.
+        """
+        self.allocator.check_space = lambda: {"drive1": 1000, "drive2": 500}
+        self.allocator.allocate_many(["sized/b{}".format(i) for i in range(4)], expected_size=200)
+
+        drives = list(self.allocator.storage.get_all_locations2drive().values())
+        self.assertEqual(drives.count("drive1"), 3)
+        self.assertEqual(drives.count("drive2"), 1)
+        self.assertEqual(self.allocator.storage.get_reserved_bytes(now=time.time()),
+                         {"drive1": 600, "drive2": 200})
+
+    def test_parse_size(self):
+        """
+        Test parsing human readable sizes.
+        """
+        self.assertEqual(Allocator.parse_size("512"), 512)
+        self.assertEqual(Allocator.parse_size("10K"), 10 * 1024)
+        self.assertEqual(Allocator.parse_size("1.5GB"), int(1.5 * 1024**3))
+        with self.assertRaises(AllocatorException):
+            Allocator.parse_size("lots")
+
     def test_get_path(self):
         """
         Test retrieving the path for an existing branch.
@@ -58,6 +229,19 @@ class TestAllocator(unittest.TestCase):
         self.assertTrue(os.path.exists(path))
         self.assertIn("test_branch", path)
 
+    def test_get_paths(self):
+        """
+        Test retrieving many paths in input order, with None for missing branches.
+        """
+        self.allocator.allocate_many(["b{}".format(i) for i in range(2000)])
+        names = ["b1999", "missing", "b0", "b1999"] + ["b{}".format(i) for i in range(1000, 2000)]
+        paths = self.allocator.get_paths(names)
+        self.assertEqual(len(paths), len(names))
+        self.assertIsNone(paths[1])
+        for name, path in zip(names, paths):
+            if name != "missing":
+                self.assertEqual(path, self.allocator.get_path(name))
+
     def test_delete_branch(self):
         """
         Test deleting a branch and its record.
@@ -67,6 +251,220 @@ class TestAllocator(unittest.TestCase):
         with self.assertRaises(Exception):
             self.allocator.get_path("test_branch")
 
+    def test_delete_branch_leaves_nothing(self):
+        """
+        Test that deleting a branch removes the renamed directory as well.
+        """
+        path = self.allocator.allocate("project/test_branch")
+        with open(os.path.join(path, "file.txt"), "w") as f:
+            f.write("data")
+
+        self.allocator.delete_branch("project/test_branch")
+        self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+    def test_delete_branch_defer(self):
+        """
+        Test that a deferred delete moves the branch into the drive's trash.
+        """
+        path = self.allocator.allocate("project/test_branch")
+        with open(os.path.join(path, "file.txt"), "w") as f:
+            f.write("data")
+        drive = self.allocator.storage.get_drive("project/test_branch")
+
+        self.allocator.delete_branch("project/test_branch", defer=True)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(self.allocator.storage.check_duplicates("project/test_branch"))
+
+        trash_path = self.allocator.get_trash_paths()[drive]
+        entries = os.listdir(trash_path)
+        self.assertEqual(len(entries), 1)
+        self.assertTrue(entries[0].endswith("-test_branch"))
+        self.assertEqual(os.listdir(os.path.join(trash_path, entries[0])), ["file.txt"])
+
+        with self.assertRaises(AllocatorException):
+            self.allocator.make_directory(os.path.join(trash_path, "other"))
+
+    def make_subtree(self):
+        """
+        Record projA with nested branches on both drives, and a sibling projA-b.
+        """
+        for branch_path, drive_path in (("projA", self.drive1),
+                                        ("projA/run1", self.drive2),
+                                        ("projA/run1/sub", self.drive2),
+                                        ("projA/run2", self.drive1),
+                                        ("projA-b", self.drive1),
+                                        ):
+            os.makedirs(os.path.join(drive_path, branch_path, "data"), exist_ok=True)
+            with open(os.path.join(drive_path, branch_path, "data", "file.txt"), "w") as f:
+                f.write("data")
+            self.allocator.storage.record_location(branch_path, os.path.basename(drive_path))
+        # a record whose directory is gone
+        self.allocator.storage.record_location("projA/gone", "drive2")
+
+    def test_delete_branch_recursive(self):
+        """
+        Test that a recursive delete removes every record and directory below the branch.
+        """
+        self.make_subtree()
+        self.allocator.delete_branch("projA", recursive=True, workers=4)
+
+        self.assertEqual(self.allocator.get_subtree_locations("projA"), {})
+        self.assertEqual(self.allocator.storage.get_drive("projA-b"), "drive1")
+        self.assertEqual(sorted(os.listdir(self.drive1)), ["projA-b"])
+        self.assertEqual(os.listdir(self.drive2), [])
+
+        with self.assertRaises(AllocatorException):
+            self.allocator.delete_branch("projA", recursive=True)
+
+    def test_delete_branch_recursive_defer(self):
+        """
+        Test that a deferred recursive delete moves the topmost directory of each drive into its trash.
+        """
+        self.make_subtree()
+        self.allocator.delete_branch("projA", defer=True, recursive=True)
+
+        self.assertEqual(self.allocator.get_subtree_locations("projA"), {})
+        trash_paths = self.allocator.get_trash_paths()
+        self.assertEqual([entry.split("-", 2)[2] for entry in os.listdir(trash_paths["drive1"])], ["projA"])
+        self.assertEqual([entry.split("-", 2)[2] for entry in os.listdir(trash_paths["drive2"])], ["run1"])
+        self.assertFalse(os.path.exists(os.path.join(self.drive2, "projA")))
+
+    def test_move_branch_rename(self):
+        """
+        Test that a rename moves the records and the directories on every drive.
+        """
+        self.make_subtree()
+        self.allocator.move_branch("projA", new_name="lab/projX")
+
+        self.assertEqual(self.allocator.get_subtree_locations("projA"), {})
+        self.assertEqual(self.allocator.get_subtree_locations("lab/projX"), {"lab/projX": "drive1", 
+                                                                             "lab/projX/run1": "drive2", 
+                                                                             "lab/projX/run1/sub": "drive2", 
+                                                                             "lab/projX/run2": "drive1", 
+                                                                             "lab/projX/gone": "drive2", 
+                                                                             })
+        self.assertTrue(os.path.isfile(os.path.join(self.drive1, "lab/projX/run2/data/file.txt")))
+        self.assertTrue(os.path.isfile(os.path.join(self.drive2, "lab/projX/run1/sub/data/file.txt")))
+        self.assertEqual(sorted(os.listdir(self.drive1)), ["lab", "projA-b"])
+        self.assertEqual(os.listdir(self.drive2), ["lab"])
+
+    def test_move_branch_rejects(self):
+        """
+        Test that a move onto a recorded branch or into itself changes nothing.
+        """
+        self.make_subtree()
+        for new_name in ("projA-b", "projA/run3", "projA"):
+            with self.assertRaises(AllocatorException):
+                self.allocator.move_branch("projA", new_name=new_name)
+        # drive2 holds projA/run1
+        with self.assertRaises(AllocatorException):
+            self.allocator.move_branch("projA", drive="drive2")
+        self.assertEqual(len(self.allocator.get_subtree_locations("projA")), 5)
+        self.assertEqual(self.allocator.pending_moves(), [])
+
+    def test_move_branch_drive(self):
+        """
+        Test that a move to another drive copies the branch and the branches nested in it.
+        """
+        self.make_subtree()
+        self.allocator.storage.record_location("projA-b/data", "drive1")
+        progress = []
+        result = self.allocator.move_branch("projA-b", 
+                                            new_name="projB", 
+                                            drive="drive2", 
+                                            progress=lambda *args: progress.append(args), 
+                                            )
+
+        self.assertEqual(result.files_copied, 1)
+        self.assertEqual(progress, [("copy", 1, 4), ("verify", 1, 4)])
+        self.assertEqual(self.allocator.get_subtree_locations("projB"), {"projB": "drive2", "projB/data": "drive2"})
+        self.assertTrue(os.path.isfile(os.path.join(self.drive2, "projB", "data", "file.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.drive1, "projB")))
+        self.assertEqual(self.allocator.pending_moves(), [])
+
+    def test_move_branch_resume(self):
+        """
+        Test that a move whose copy does not verify stays recorded and is finished later.
+        """
+        self.make_subtree()
+        with mock.patch("data_allocator.allocator.compare_trees", return_value=["data/file.txt"]) as compare:
+            with self.assertRaises(AllocatorException):
+                self.allocator.move_branch("projA-b", drive="drive2")
+        # the copy is verified by SHA-256 unless asked otherwise
+        self.assertTrue(compare.call_args.kwargs["checksum"])
+        self.assertEqual(self.allocator.pending_moves(), [("projA-b", "drive1", "drive2", "pending")])
+        self.assertEqual(self.allocator.storage.get_drive("projA-b"), "drive1")
+        with self.assertRaises(AllocatorException):
+            self.allocator.move_branch("projA-b", new_name="projB")
+
+        moved = list(self.allocator.resume_moves())
+        self.assertEqual([move[:3] for move in moved], [("projA-b", "drive1", "drive2")])
+        self.assertEqual(moved[0][3].files_skipped, 1)
+        self.assertEqual(self.allocator.storage.get_drive("projA-b"), "drive2")
+        self.assertFalse(os.path.exists(os.path.join(self.drive1, "projA-b")))
+        self.assertEqual(self.allocator.pending_moves(), [])
+
+    def test_move_branch_dropped(self):
+        """
+        Test that a move of a branch deleted since is dropped with its partial copy.
+        """
+        self.make_subtree()
+        with mock.patch("data_allocator.allocator.compare_trees", return_value=["data/file.txt"]):
+            with self.assertRaises(AllocatorException):
+                self.allocator.move_branch("projA-b", drive="drive2")
+        self.assertTrue(os.path.isdir(os.path.join(self.drive2, "projA-b")))
+        self.allocator.delete_branch("projA-b")
+
+        moved = list(self.allocator.resume_moves())
+        self.assertEqual(moved, [("projA-b", "drive1", "drive2", None)])
+        self.assertFalse(os.path.exists(os.path.join(self.drive2, "projA-b")))
+        self.assertEqual(self.allocator.pending_moves(), [])
+
+    def test_allocate_rolls_back_on_mkdir_failure(self):
+        """
+        Test that a failed mkdir leaves no record behind.
+        """
+        with mock.patch("data_allocator.allocator.os.makedirs", side_effect=PermissionError("denied")):
+            with self.assertRaises(PermissionError):
+                self.allocator.allocate("test_branch")
+
+        self.assertFalse(self.allocator.storage.check_duplicates("test_branch"))
+        path = self.allocator.allocate("test_branch")
+        self.assertTrue(os.path.isdir(path))
+
+    def test_allocate_duplicate_leaves_no_directory(self):
+        """
+        Test that a rejected duplicate does not create a directory.
+        """
+        path = self.allocator.allocate("test_branch")
+        shutil.rmtree(path)
+
+        with self.assertRaises(AllocatorException):
+            self.allocator.allocate("test_branch")
+        self.assertFalse(os.path.exists(path))
+
+    def test_allocate_concurrent_processes(self):
+        """
+        Test that processes allocating overlapping names record each name
+        exactly once, with exactly one directory per name.
+        """
+        branch_names = [f"project/branch_{i}" for i in range(20)]
+        with multiprocessing.get_context("spawn").Pool(8) as pool:
+            counts = pool.starmap(allocate_concurrently, 
+                                  [(self.config_path, self.db_path, branch_names)] * 8, 
+                                  )
+
+        self.assertEqual(sum(counts), len(branch_names))
+        locations = self.allocator.storage.get_all_locations2drive()
+        self.assertEqual(sorted(locations), sorted(branch_names))
+
+        on_disk = []
+        for drive in (self.drive1, self.drive2):
+            project = os.path.join(drive, "project")
+            if os.path.isdir(project):
+                on_disk.extend("project/" + name for name in os.listdir(project))
+        self.assertEqual(sorted(on_disk), sorted(branch_names))
+
     def test_calculate_branch_disk_usage_empty(self):
         """
         Test calculating disk usage for an empty branch.
@@ -95,6 +493,24 @@ class TestAllocator(unittest.TestCase):
         
         self.allocator.delete_branch("single_file_branch")
 
+    def test_calculate_branch_disk_usage_grown_file(self):
+        """
+        Test that a file grown in place is measured exactly, while the opt-in usage cache misses it.
+        """
+        self.allocator.allocate("grown_branch")
+        test_file = os.path.join(self.allocator.get_path("grown_branch"), "test.txt")
+        with open(test_file, "wb") as f:
+            f.write(b"x" * 10)
+        # an old directory mtime, which appending to the file does not change
+        dir_mtime_ns = time.time_ns() - 10**10
+        os.utime(os.path.dirname(test_file), ns=(dir_mtime_ns, dir_mtime_ns))
+        self.allocator.measure_branch_disk_usage("grown_branch", use_cache=True)
+        with open(test_file, "ab") as f:
+            f.write(b"x" * 100)
+
+        self.assertEqual(self.allocator.calculate_branch_disk_usage("grown_branch"), 110)
+        self.assertEqual(self.allocator.measure_branch_disk_usage("grown_branch", use_cache=True).size(), 10)
+
     def test_calculate_branch_disk_usage_multiple_files(self):
         """
         Test calculating disk usage for a branch with multiple files.
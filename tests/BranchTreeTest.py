@@ -0,0 +1,70 @@
+# tests/BranchTreeTest.py
+
+import unittest
+
+from data_allocator.branch_tree import BranchTree
+from data_allocator.exceptions import TreeVisualizerException
+
+class TestBranchTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = BranchTree()
+        for branch in ["ProjectA/SubA1", "ProjectA/SubA2", "ProjectB/SubB1/Sub.1", "ProjectB"]:
+            self.tree.insert(branch)
+
+    def test_insert(self):
+        """Test that inserting a branch adds its ancestors."""
+        self.assertIn("ProjectA", self.tree)
+        self.assertIn("ProjectB/SubB1", self.tree)
+        self.assertNotIn("ProjectC", self.tree)
+        self.assertTrue(self.tree.has_edge("", "ProjectA"))
+        self.assertTrue(self.tree.has_edge("ProjectB/SubB1", "ProjectB/SubB1/Sub.1"))
+        self.assertFalse(self.tree.has_edge("ProjectA", "ProjectB/SubB1"))
+        self.assertEqual(self.tree.find("ProjectB/SubB1/Sub.1").path, "ProjectB/SubB1/Sub.1")
+
+    def test_walk(self):
+        """Test depth-first order with sorted children."""
+        walked = [(path, level) for path, _, level in self.tree.walk()]
+        self.assertEqual(walked, [("", 0),
+                                  ("ProjectA", 1),
+                                  ("ProjectA/SubA1", 2),
+                                  ("ProjectA/SubA2", 2),
+                                  ("ProjectB", 1),
+                                  ("ProjectB/SubB1", 2),
+                                  ("ProjectB/SubB1/Sub.1", 3),
+                                  ])
+
+    def test_subtree(self):
+        """Test that subtrees keep full paths."""
+        subtree = self.tree.subtree("ProjectB")
+        walked = [path for path, _, _ in subtree.walk()]
+        self.assertEqual(walked, ["ProjectB", "ProjectB/SubB1", "ProjectB/SubB1/Sub.1"])
+
+        with self.assertRaises(TreeVisualizerException):
+            self.tree.subtree("ProjectC")
+
+    def test_descendant_count(self):
+        """Test counting nodes below a branch."""
+        self.assertEqual(self.tree.descendant_count(), 6)
+        self.assertEqual(self.tree.descendant_count("ProjectB"), 2)
+        self.assertEqual(self.tree.descendant_count("ProjectA/SubA1"), 0)
+        self.assertEqual(len(self.tree), 7)
+
+    def test_rooted_tree(self):
+        """Test a tree rooted below the namespace root."""
+        tree = BranchTree("ProjectB")
+        tree.insert("ProjectB/SubB1/Sub.1")
+        self.assertTrue(tree.has_edge("ProjectB", "ProjectB/SubB1"))
+
+        with self.assertRaises(TreeVisualizerException):
+            tree.insert("ProjectBX/SubB1")
+
+    def test_to_networkx(self):
+        """Test conversion to a NetworkX DiGraph."""
+        graph = self.tree.to_networkx()
+        self.assertEqual(graph.number_of_nodes(), 7)
+        self.assertTrue(graph.has_edge("", "ProjectA"))
+        self.assertTrue(graph.has_edge("ProjectB/SubB1", "ProjectB/SubB1/Sub.1"))
+
+if __name__ == "__main__":
+    unittest.main()
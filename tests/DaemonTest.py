@@ -0,0 +1,98 @@
+# tests/DaemonTest.py
+
+import unittest
+import threading
+import shutil
+import socket
+import time
+import os
+
+from data_allocator.client import DaemonClient
+from data_allocator.daemon import AllocatorDaemon
+from data_allocator.storage_manager import StorageManager
+from data_allocator.exceptions import AllocatorException, DaemonTimeoutException
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = "wdir"
+        os.makedirs(os.path.join(self.wdir, "drive1"), exist_ok=True)
+        os.makedirs(os.path.join(self.wdir, "drive2"), exist_ok=True)
+        self.socket_path = os.path.join(self.wdir, "daemon.sock")
+        self.db_path = os.path.join(self.wdir, "test.db")
+
+        self.daemon = AllocatorDaemon(socket_path=self.socket_path,
+                                      config_path=os.path.join("example_config", "config.json"),
+                                      db_path=self.db_path,
+                                      )
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+        self.client = DaemonClient.connect(self.socket_path)
+
+    def tearDown(self):
+        self.client.close()
+        self.daemon.shutdown()
+        self.thread.join()
+        self.daemon.server_close()
+        shutil.rmtree(self.wdir)
+        return super().tearDown()
+
+    def test_commands(self):
+        """Test allocate, get, ls and delete through the daemon."""
+        path = self.client.call("allocate", branch_name="project/run1")
+        self.assertTrue(os.path.isdir(path))
+        self.assertEqual(self.client.call("get", branch_name="project/run1"), path)
+        self.assertIn("project/run1", self.client.call("ls"))
+
+        self.client.call("delete", branch_name="project/run1")
+        self.assertFalse(os.path.exists(path))
+        with self.assertRaises(AllocatorException) as context:
+            self.client.call("get", branch_name="project/run1")
+        self.assertIn("No location found", str(context.exception))
+
+    def test_errors(self):
+        """Test that errors are raised in the client as the daemon's exception class."""
+        self.client.call("allocate", branch_name="dup")
+        with self.assertRaises(AllocatorException):
+            self.client.call("allocate", branch_name="dup")
+        with self.assertRaises(AllocatorException):
+            self.client.call("no_such_command")
+        with self.assertRaises(AllocatorException):
+            self.client.call("get", missing_argument="x")
+        self.assertEqual(self.client.call("ping"), "pong")
+
+    def test_sees_other_writers(self):
+        """Test that records written by another process are served."""
+        self.assertEqual(self.client.call("ping"), "pong")
+        with StorageManager(db_path=self.db_path) as storage:
+            storage.record_location("external", "drive2")
+
+        path = self.client.call("get", branch_name="external")
+        self.assertEqual(path, os.path.join(self.wdir, "drive2", "external"))
+
+    def test_not_running(self):
+        """Test that connecting without a daemon returns None."""
+        self.assertIsNone(DaemonClient.connect(os.path.join(self.wdir, "missing.sock")))
+
+    def test_wedged_daemon(self):
+        """Test that a daemon that accepts but never answers times out."""
+        wedged_path = os.path.join(self.wdir, "wedged.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(wedged_path)
+            server.listen(1)
+            with DaemonClient.connect(wedged_path, timeout=0.2) as client:
+                start = time.monotonic()
+                with self.assertRaises(DaemonTimeoutException):
+                    client.call("get", branch_name="project/run1")
+                self.assertLess(time.monotonic() - start, 2)
+
+    def test_second_daemon_refused(self):
+        """Test that a second daemon on the same socket is refused."""
+        with self.assertRaises(AllocatorException):
+            AllocatorDaemon(socket_path=self.socket_path,
+                            config_path=os.path.join("example_config", "config.json"),
+                            db_path=self.db_path,
+                            )
+
+if __name__ == "__main__":
+    unittest.main()
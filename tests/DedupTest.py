@@ -0,0 +1,113 @@
+# tests/DedupTest.py
+
+import unittest
+import shutil
+import os
+
+from data_allocator.allocator import Allocator
+from data_allocator.dedup import Deduplicator
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = "wdir"
+        os.makedirs(os.path.join(self.wdir, "drive1"), exist_ok=True)
+        os.makedirs(os.path.join(self.wdir, "drive2"), exist_ok=True)
+        self.allocator = Allocator(config_path=os.path.join("example_config", "config.json"),
+                                   db_path=os.path.join(self.wdir, "test.db"),
+                                   )
+
+        for branch, drive in {"projA": "drive1",
+                              "projA/run1": "drive1",
+                              "projB": "drive1",
+                              "projC": "drive2",
+                              }.items():
+            os.makedirs(os.path.join(self.wdir, drive, branch), exist_ok=True)
+            self.allocator.storage.record_location(branch, drive)
+
+        # with 16-byte blocks: "same" is held three times, "middle" has the
+        # same head and tail but another middle, "tail" another tail
+        same = b"h" * 16 + b"m" * 32 + b"t" * 16
+        self.write("drive1", "projA/reads.fq", same)
+        self.write("drive1", "projA/run1/sub/reads.fq", same)
+        self.write("drive2", "projC/copy.fq", same)
+        self.write("drive1", "projB/middle.fq", b"h" * 16 + b"x" * 32 + b"t" * 16)
+        self.write("drive1", "projB/tail.fq", b"h" * 16 + b"m" * 32 + b"y" * 16)
+        # short files are hashed whole by the partial hash
+        self.write("drive1", "projB/short.txt", b"abc")
+        self.write("drive2", "projC/short.txt", b"abc")
+        self.write("drive2", "projC/empty.txt", b"")
+        self.write("drive1", "projB/empty.txt", b"")
+
+    def tearDown(self):
+        self.allocator.close()
+        shutil.rmtree(self.wdir)
+        return super().tearDown()
+
+    def write(self, drive, rel_path, content):
+        path = os.path.join(self.wdir, drive, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+
+    def summary(self, result):
+        return [(size, [(drive, branch_path, os.path.basename(path)) for drive, branch_path, path, _ in files])
+                for size, _, files in result.groups]
+
+    def test_scan(self):
+        """Test that identical files are grouped by branch and that only colliding files are hashed whole."""
+        result = Deduplicator(self.allocator, workers=4, block_size=16).scan()
+        self.assertEqual(self.summary(result), [(64, [("drive1", "projA", "reads.fq"),
+                                                      ("drive1", "projA/run1", "reads.fq"),
+                                                      ("drive2", "projC", "copy.fq"),
+                                                      ]),
+                                                (3, [("drive1", "projB", "short.txt"),
+                                                     ("drive2", "projC", "short.txt"),
+                                                     ]),
+                                                ])
+        self.assertEqual(result.reclaimable_bytes(), 2 * 64 + 3)
+        self.assertEqual(result.file_count, 9)
+        # empty files are not considered, tail.fq is ruled out by its partial hash
+        self.assertEqual(result.partial_hashes, 7)
+        self.assertEqual(result.full_hashes, 4)
+
+        result = Deduplicator(self.allocator, workers=4, block_size=16).scan(root_branch="projA")
+        self.assertEqual(len(result.groups), 1)
+        self.assertEqual(result.copies(result.groups[0][2]), 2)
+
+    def test_cache(self):
+        """Test that a rerun reuses the hashes of unchanged files."""
+        Deduplicator(self.allocator, workers=4, block_size=16).scan()
+        result = Deduplicator(self.allocator, workers=4, block_size=16).scan()
+        self.assertEqual((result.partial_hashes, result.full_hashes, result.bytes_hashed), (0, 0, 0))
+        self.assertEqual(result.cache_hits, 11)
+        self.assertEqual(len(result.groups), 2)
+
+        path = os.path.join(self.wdir, "drive1", "projB", "middle.fq")
+        mtime_ns = os.stat(path).st_mtime_ns
+        self.write("drive1", "projB/middle.fq", b"h" * 16 + b"m" * 32 + b"t" * 16)
+        os.utime(path, ns=(mtime_ns, mtime_ns + 10**9))
+        result = Deduplicator(self.allocator, workers=4, block_size=16).scan()
+        self.assertEqual((result.partial_hashes, result.full_hashes), (1, 1))
+        self.assertEqual(result.copies(result.groups[0][2]), 4)
+
+    def test_hardlink(self):
+        """Test that the copies on one drive become hard links and other drives are left alone."""
+        deduplicator = Deduplicator(self.allocator, workers=4, block_size=16)
+        linked = deduplicator.hardlink(deduplicator.scan())
+        self.assertEqual((linked.files_linked, linked.bytes_reclaimed, linked.error_count), (1, 64, 0))
+
+        first = os.stat(os.path.join(self.wdir, "drive1", "projA", "reads.fq"))
+        second = os.stat(os.path.join(self.wdir, "drive1", "projA", "run1", "sub", "reads.fq"))
+        other = os.stat(os.path.join(self.wdir, "drive2", "projC", "copy.fq"))
+        self.assertEqual(first.st_ino, second.st_ino)
+        self.assertEqual(first.st_nlink, 2)
+        self.assertEqual(other.st_nlink, 1)
+
+        result = deduplicator.scan()
+        self.assertEqual(result.copies(result.groups[0][2]), 2)
+        self.assertEqual(len(result.groups[0][2]), 3)
+        self.assertEqual(deduplicator.hardlink(result).files_linked, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# tests/DiskUsageTest.py
+
+import unittest
+import shutil
+import os
+
+from data_allocator.disk_usage import DiskUsageScanner
+from data_allocator.storage_manager import StorageManager
+from data_allocator.exceptions import AllocatorException
+
+class TestDiskUsageScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.test_path = "wdir/test_disk_usage"
+        os.makedirs(os.path.join(self.test_path, "a", "b"), exist_ok=True)
+        os.makedirs(os.path.join(self.test_path, "c"), exist_ok=True)
+
+        self.files = {"root.txt": b"x" * 10,
+                      os.path.join("a", "a.txt"): b"x" * 100,
+                      os.path.join("a", "b", "b.txt"): b"x" * 1000,
+                      os.path.join("c", "c.txt"): b"x" * 5,
+                      }
+        for rel_path, content in self.files.items():
+            with open(os.path.join(self.test_path, rel_path), "wb") as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_path)
+        return super().tearDown()
+
+    def test_scan(self):
+        """Test totals of a parallel scan."""
+        result = DiskUsageScanner(workers=4).scan(self.test_path)
+        self.assertEqual(result.apparent_size, 1115)
+        self.assertEqual(result.file_count, 4)
+        self.assertEqual(result.dir_count, 4)
+        self.assertGreaterEqual(result.allocated_size, 0)
+        self.assertEqual(result.by_depth, {})
+
+    def test_hard_links_counted_once(self):
+        """Test that a file with several hard links is counted once."""
+        os.link(os.path.join(self.test_path, "a", "b", "b.txt"),
+                os.path.join(self.test_path, "c", "b_link.txt"))
+
+        result = DiskUsageScanner().scan(self.test_path)
+        self.assertEqual(result.apparent_size, 1115)
+        self.assertEqual(result.file_count, 4)
+
+    def test_breakdown(self):
+        """Test the per-directory breakdown."""
+        result = DiskUsageScanner(breakdown_depth=1).scan(self.test_path)
+        self.assertEqual(sorted(result.by_depth), ["", "a", "c"])
+        self.assertEqual(result.by_depth[""][0], 1115)
+        self.assertEqual(result.by_depth["a"][0], 1100)
+        self.assertEqual(result.by_depth["c"][0], 5)
+
+    def test_missing_root(self):
+        """Test that an unreadable root raises."""
+        with self.assertRaises(AllocatorException):
+            DiskUsageScanner().scan(os.path.join(self.test_path, "missing"))
+
+class TestDiskUsageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = "wdir/test_disk_usage_cache"
+        self.test_path = os.path.abspath(os.path.join(self.wdir, "branch"))
+        os.makedirs(os.path.join(self.test_path, "a", "b"), exist_ok=True)
+        os.makedirs(os.path.join(self.test_path, "c"), exist_ok=True)
+        for rel_path, size in [("a/a.txt", 100), ("a/b/b.txt", 1000), ("c/c.txt", 5)]:
+            with open(os.path.join(self.test_path, rel_path), "wb") as f:
+                f.write(b"x" * size)
+
+        # age the directories past the racy window so their listings are reused
+        for dir_path in ["a/b", "a", "c", ""]:
+            os.utime(os.path.join(self.test_path, dir_path), (1e9, 1e9))
+
+        self.storage = StorageManager(db_path=os.path.join(self.wdir, "test.db"))
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.wdir)
+        return super().tearDown()
+
+    def scan(self, **kwargs):
+        max_age = kwargs.pop("max_age", None)
+        return DiskUsageScanner(cache=self.storage, **kwargs).scan(self.test_path, max_age=max_age)
+
+    def test_unchanged_directories_reused(self):
+        """Test that directories with an unchanged mtime are not listed again."""
+        self.assertEqual(self.scan().apparent_size, 1105)
+
+        # rewriting a file in place leaves the directory mtime alone
+        with open(os.path.join(self.test_path, "a", "b", "b.txt"), "wb") as f:
+            f.write(b"x" * 10)
+        os.utime(os.path.join(self.test_path, "a", "b"), (1e9, 1e9))
+        self.assertEqual(self.scan().apparent_size, 1105)
+
+        # a refresh walks everything again
+        self.assertEqual(self.scan(refresh=True).apparent_size, 115)
+
+    def test_changed_directory_rescanned(self):
+        """Test that a directory whose mtime changed is listed again."""
+        self.scan()
+        with open(os.path.join(self.test_path, "c", "new.txt"), "wb") as f:
+            f.write(b"x" * 20)
+
+        result = self.scan()
+        self.assertEqual(result.apparent_size, 1125)
+        self.assertEqual(result.file_count, 4)
+
+    def test_removed_directory_dropped(self):
+        """Test that cache rows of removed directories are deleted."""
+        self.scan()
+        b_path = os.path.join(self.test_path, "a", "b")
+        self.assertIn(b_path, self.storage.get_usage_entries([b_path]))
+
+        shutil.rmtree(b_path)
+        self.assertEqual(self.scan().apparent_size, 105)
+        self.assertNotIn(b_path, self.storage.get_usage_entries([b_path]))
+
+    def test_max_age(self):
+        """Test that recent totals are returned without touching the filesystem."""
+        self.scan()
+        shutil.rmtree(os.path.join(self.test_path, "a"))
+
+        self.assertEqual(self.scan(max_age=3600).apparent_size, 1105)
+        self.assertEqual(self.scan(max_age=0).apparent_size, 5)
+
+if __name__ == "__main__":
+    unittest.main()
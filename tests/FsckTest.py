@@ -0,0 +1,111 @@
+# tests/FsckTest.py
+
+import unittest
+import shutil
+import os
+
+from data_allocator.allocator import Allocator
+from data_allocator.fsck import Fsck
+from data_allocator.reaper import deleted_name
+from data_allocator.constants import TRASH_DIR_NAME
+
+class TestFsck(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = "wdir"
+        os.makedirs(os.path.join(self.wdir, "drive1"), exist_ok=True)
+        os.makedirs(os.path.join(self.wdir, "drive2"), exist_ok=True)
+        self.allocator = Allocator(config_path=os.path.join("example_config", "config.json"),
+                                   db_path=os.path.join(self.wdir, "test.db"),
+                                   )
+
+        # consistent: nested branches on both drives, with content directories
+        for branch, drive in {"projA": "drive1",
+                              "projA/run1": "drive2",
+                              "projA/data/run2": "drive1",
+                              "projA-b": "drive1",
+                              "projB/run1": "drive2",
+                              }.items():
+            os.makedirs(os.path.join(self.wdir, drive, branch, "content", "deeper"), exist_ok=True)
+            self.allocator.storage.record_location(branch, drive)
+
+    def tearDown(self):
+        self.allocator.close()
+        shutil.rmtree(self.wdir)
+        return super().tearDown()
+
+    def test_clean(self):
+        """Test that a consistent tree has no problems."""
+        result = Fsck(self.allocator, workers=4).check()
+        self.assertEqual(result.problem_count(), 0)
+        self.assertEqual(result.record_count, 5)
+
+    def test_problems(self):
+        """Test that missing, unregistered and wrong-drive branches are found."""
+        shutil.rmtree(os.path.join(self.wdir, "drive2", "projB", "run1"))
+        self.allocator.storage.record_location("projC/gone", "drive1")
+        os.makedirs(os.path.join(self.wdir, "drive2", "stray", "inner"))
+        # content of branch projA on drive1, but not of any branch on drive2
+        os.makedirs(os.path.join(self.wdir, "drive1", "projA", "data", "stray"))
+        os.makedirs(os.path.join(self.wdir, "drive2", "projA", "stray"))
+        os.makedirs(os.path.join(self.wdir, "drive1", TRASH_DIR_NAME, "123-1-old"))
+        os.makedirs(os.path.join(self.wdir, "drive1", "moved"))
+        self.allocator.storage.record_location("moved", "drive2")
+
+        result = Fsck(self.allocator).check()
+        self.assertEqual(result.missing, [("drive1", "projC/gone"), ("drive2", "projB/run1")])
+        self.assertEqual(result.unregistered, [("drive2", "projA/stray"), ("drive2", "stray")])
+        self.assertEqual(result.wrong_drive, [("moved", "drive2", "drive1")])
+        self.assertEqual(result.errors, [])
+
+    def test_repair(self):
+        """Test that repair fixes the records and trashes unregistered directories."""
+        shutil.rmtree(os.path.join(self.wdir, "drive2", "projB", "run1"))
+        os.makedirs(os.path.join(self.wdir, "drive2", "stray"))
+        os.makedirs(os.path.join(self.wdir, "drive1", "moved"))
+        self.allocator.storage.record_location("moved", "drive2")
+
+        checker = Fsck(self.allocator)
+        fixed = checker.repair(checker.check(), trash_unregistered=True)
+        self.assertEqual(fixed, {"wrong_drive": 1, "missing": 1, "unregistered": 1})
+
+        self.assertEqual(self.allocator.storage.get_drive("moved"), "drive1")
+        self.assertIsNone(self.allocator.storage.get_drive("projB/run1"))
+        self.assertFalse(os.path.exists(os.path.join(self.wdir, "drive2", "stray")))
+        # the parent of the dropped record is left and is now unregistered
+        result = checker.check()
+        self.assertEqual(result.unregistered, [("drive2", "projB")])
+        self.assertEqual(result.problem_count(), 1)
+
+    def test_skips_deleted(self):
+        """Test that directories being deleted are not reported or trashed."""
+        doomed = [os.path.join(self.wdir, "drive2", deleted_name("lab"), "data"),
+                  os.path.join(self.wdir, "drive2", "projB", deleted_name("run2"), "data"),
+                  ]
+        for path in doomed:
+            os.makedirs(path)
+
+        checker = Fsck(self.allocator)
+        result = checker.check()
+        self.assertEqual(result.problem_count(), 0)
+        checker.repair(result, trash_unregistered=True)
+        for path in doomed:
+            self.assertTrue(os.path.isdir(path))
+
+    def test_nested_wrong_drive(self):
+        """Test that the unregistered parent of a wrong-drive branch is not reported."""
+        os.makedirs(os.path.join(self.wdir, "drive2", "lab", "run1"))
+        self.allocator.storage.record_location("lab/run1", "drive1")
+
+        checker = Fsck(self.allocator)
+        result = checker.check()
+        self.assertEqual(result.wrong_drive, [("lab/run1", "drive1", "drive2")])
+        self.assertEqual(result.problem_count(), 1)
+
+        fixed = checker.repair(result, trash_unregistered=True)
+        self.assertEqual(fixed, {"wrong_drive": 1, "missing": 0, "unregistered": 0})
+        self.assertTrue(os.path.isdir(os.path.join(self.wdir, "drive2", "lab", "run1")))
+        self.assertEqual(checker.check().problem_count(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+# tests/ImportExportTest.py
+
+import unittest
+import shutil
+import io
+import os
+
+from data_allocator.allocator import Allocator
+from data_allocator.import_export import Importer, scan_drive, scan_drives, read_manifest, write_export
+from data_allocator.exceptions import AllocatorException
+
+class TestImportExport(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = "wdir"
+        self.drive1 = os.path.join(self.wdir, "drive1")
+        self.drive2 = os.path.join(self.wdir, "drive2")
+        for path in ("labA/proj1/data", "labA/proj2", "labB/proj3", ".allocator_trash/1-1-x/y", "labC"):
+            os.makedirs(os.path.join(self.drive1, path), exist_ok=True)
+        for path in ("labA/proj4", "labB/proj3"):
+            os.makedirs(os.path.join(self.drive2, path), exist_ok=True)
+        self.allocator = Allocator(config_path=os.path.join("example_config", "config.json"),
+                                   db_path=os.path.join(self.wdir, "test.db"),
+                                   )
+        self.conflicts = []
+
+    def tearDown(self):
+        self.allocator.close()
+        shutil.rmtree(self.wdir)
+        return super().tearDown()
+
+    def report(self, branch_path, drive_name, reason):
+        self.conflicts.append((branch_path, drive_name, reason))
+
+    def test_scan_drive(self):
+        """Test that a scan yields the directories at one depth in branch order."""
+        self.assertEqual(list(scan_drive(self.drive1, 2)), ["labA/proj1", "labA/proj2", "labB/proj3"])
+        self.assertEqual(list(scan_drive(self.drive1, 1)), ["labA", "labB", "labC"])
+
+    def test_scan_drives(self):
+        """Test that directories found on both drives are conflicts."""
+        drive_paths = self.allocator.config.get_drive_paths()
+        found = list(scan_drives(drive_paths, 2, self.report))
+        self.assertEqual(found, [("labA/proj1", "drive1"), ("labA/proj2", "drive1"), ("labA/proj4", "drive2")])
+        self.assertEqual(self.conflicts, [("labB/proj3", "drive1,drive2", "found on more than one drive")])
+
+    def test_scan_drives_nested(self):
+        """Test that the parent of a branch nested on another drive is not found on that drive."""
+        storage = self.allocator.storage
+        storage.record_location("labA/proj4", "drive2")
+        drive_paths = self.allocator.config.get_drive_paths()
+
+        found = list(scan_drives(drive_paths, 1, self.report, storage=storage))
+        self.assertEqual(found, [("labA", "drive1"), ("labC", "drive1")])
+        self.assertEqual(self.conflicts, [("labB", "drive1,drive2", "found on more than one drive")])
+
+        # a directory recorded as a branch counts as found, whatever is nested in it
+        storage.record_location("labA", "drive2")
+        self.conflicts = []
+        found = list(scan_drives(drive_paths, 1, self.report, storage=storage))
+        self.assertEqual(found, [("labC", "drive1")])
+        self.assertEqual(self.conflicts[0], ("labA", "drive1,drive2", "found on more than one drive"))
+
+    def test_import(self):
+        """Test that existing, conflicting and nested records are not inserted."""
+        storage = self.allocator.storage
+        storage.record_location("labA/proj2", "drive1")
+        storage.record_location("labA/proj4", "drive1")
+        storage.record_location("labC", "drive1")
+
+        locations = [("labA/proj1", "drive1"),
+                     ("labA/proj2", "drive1"),
+                     ("labA/proj4", "drive2"),
+                     ("labC/sub", "drive1"),
+                     ("labB/proj3", "drive3"),
+                     ("labB/missing", "drive1"),
+                     ("labB/proj3", "drive2"),
+                     ]
+        result = Importer(self.allocator, chunk_size=3).import_locations(locations, self.report)
+
+        self.assertEqual((result.imported, result.existing, result.conflicts), (2, 1, 4))
+        self.assertEqual([reason for _, _, reason in self.conflicts], ["recorded on drive1",
+                                                                       "inside branch 'labC'",
+                                                                       "drive is not configured",
+                                                                       "no directory on the drive",
+                                                                       ])
+        self.assertEqual(storage.get_drive("labA/proj1"), "drive1")
+        self.assertEqual(storage.get_drive("labB/proj3"), "drive2")
+        self.assertEqual(storage.get_drive("labA/proj4"), "drive1")
+
+    def test_dry_run(self):
+        """Test that a dry run writes nothing."""
+        result = Importer(self.allocator, dry_run=True).import_locations([("labA/proj1", "drive1")], self.report)
+        self.assertEqual(result.imported, 1)
+        self.assertIsNone(self.allocator.storage.get_drive("labA/proj1"))
+
+    def test_round_trip(self):
+        """Test that an export read back as a manifest gives the same records."""
+        storage = self.allocator.storage
+        # labA/proj1 is nested in labA on the same drive
+        records = [("labA", "drive1"), ("labA/proj1", "drive1"), ("labA/proj4", "drive2"), ("labB", "drive1")]
+        storage.record_locations(records)
+
+        for fmt in ("jsonl", "csv"):
+            stream = io.StringIO()
+            self.assertEqual(write_export(storage, stream, fmt=fmt), 4)
+            stream.seek(0)
+            self.assertEqual(list(read_manifest(stream, fmt=fmt)), records)
+
+            # and imports whole into an empty database
+            stream.seek(0)
+            with Allocator(config_path=os.path.join("example_config", "config.json"),
+                           db_path=os.path.join(self.wdir, f"import-{fmt}.db"),
+                           ) as allocator:
+                result = Importer(allocator, nested=True).import_locations(read_manifest(stream, fmt=fmt), self.report)
+                self.assertEqual((result.imported, result.conflicts), (4, 0))
+                self.assertEqual(allocator.storage.get_drives(branch for branch, _ in records), dict(records))
+        self.assertEqual(self.conflicts, [])
+
+    def test_bad_manifest(self):
+        """Test that a manifest entry without a drive is rejected."""
+        with self.assertRaises(AllocatorException):
+            list(read_manifest(io.StringIO('{"branch_path": "labA"}\n')))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+# tests/InstrumentationTest.py
+
+import unittest
+import shutil
+import os
+
+from data_allocator import instrumentation
+from data_allocator.allocator import Allocator
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = "wdir"
+        os.makedirs(os.path.join(self.wdir, "drive1"), exist_ok=True)
+        os.makedirs(os.path.join(self.wdir, "drive2"), exist_ok=True)
+        self.config_path = os.path.join("example_config", "config.json")
+        self.db_path = os.path.join(self.wdir, "test.db")
+
+    def tearDown(self):
+        instrumentation.disable()
+        shutil.rmtree(self.wdir)
+        return super().tearDown()
+
+    def test_profile(self):
+        """Test that timings and counters are recorded while a profile is enabled."""
+        profile = instrumentation.enable()
+        with Allocator(config_path=self.config_path, db_path=self.db_path) as allocator:
+            allocator.allocate("projA/run1")
+            allocator.get_path("projA/run1")
+            allocator.calculate_branch_disk_usage("projA/run1")
+
+        self.assertEqual(profile.timings["allocator.allocate"][0], 1)
+        self.assertGreater(profile.timings["allocator.allocate"][1], 0)
+        self.assertEqual(profile.timings["storage.get_drive"][0], 2)
+        self.assertGreater(profile.counters["sql.statements"], 0)
+        self.assertGreater(profile.counters["sql.SELECT"], 0)
+        self.assertEqual(profile.counters["fs.mkdir"], 2)
+        self.assertEqual(profile.counters["fs.scandir"], 1)
+
+        data = profile.to_dict()
+        self.assertEqual(data["timings"]["allocator.allocate"]["calls"], 1)
+        self.assertIn("allocator.allocate", profile.report())
+
+    def test_disabled(self):
+        """Test that nothing is recorded once the profile is disabled."""
+        profile = instrumentation.enable()
+        instrumentation.disable()
+        with Allocator(config_path=self.config_path, db_path=self.db_path) as allocator:
+            allocator.allocate("projA/run1")
+
+        self.assertEqual(profile.timings, {})
+        self.assertEqual(profile.counters, {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+# tests/PathIndexTest.py
+
+import unittest
+import shutil
+import os
+
+from data_allocator.allocator import Allocator
+from data_allocator.path_index import PathIndex
+from data_allocator.exceptions import AllocatorException
+
+class TestPathIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = "wdir"
+        os.makedirs(os.path.join(self.wdir, "drive1"), exist_ok=True)
+        os.makedirs(os.path.join(self.wdir, "drive2"), exist_ok=True)
+        self.allocator = Allocator(config_path=os.path.join("example_config", "config.json"),
+                                   db_path=os.path.join(self.wdir, "test.db"),
+                                   )
+        self.allocator.storage.record_locations([("projA", "drive1"),
+                                                 ("projA/run1", "drive2"),
+                                                 ("projB/run2", "drive2"),
+                                                 ])
+
+    def tearDown(self):
+        self.allocator.close()
+        shutil.rmtree(self.wdir)
+        return super().tearDown()
+
+    def test_find_drive(self):
+        """Test that drive roots only match on a path component boundary."""
+        index = PathIndex({"drive1": "/mnt/drive1", "drive2": "/mnt/drive1/nested", "drive3": "/"})
+        self.assertEqual(index.find_drive("/mnt/drive1/projA/x.bam"), ("drive1", "projA/x.bam"))
+        self.assertEqual(index.find_drive("/mnt/drive1/"), ("drive1", ""))
+        self.assertEqual(index.find_drive("/mnt/drive1//nested/../projA"), ("drive1", "projA"))
+        self.assertEqual(index.find_drive("/mnt/drive1/nested/projA"), ("drive2", "projA"))
+        self.assertEqual(index.find_drive("/mnt/drive1x/projA"), ("drive3", "mnt/drive1x/projA"))
+        self.assertIsNone(PathIndex({"drive1": "/mnt/drive1"}).find_drive("/mnt/drive1x/projA"))
+
+    def test_resolve(self):
+        """Test that the deepest branch recorded on the path's drive owns it."""
+        drive1 = os.path.join(self.wdir, "drive1")
+        drive2 = os.path.join(self.wdir, "drive2")
+        paths = [os.path.join(drive1, "projA", "run1", "x.bam"),
+                 os.path.join(drive2, "projA", "run1", "x.bam"),
+                 os.path.join(drive2, "projA", "other"),
+                 os.path.abspath(os.path.join(drive2, "projB", "run2")),
+                 os.path.join(drive1, "projA"),
+                 os.path.join(drive1),
+                 self.wdir + "/drive1x/projA",
+                 ]
+        self.assertEqual(self.allocator.resolve_paths(paths), [("projA", "drive1"),
+                                                               ("projA/run1", "drive2"),
+                                                               (None, "drive2"),
+                                                               ("projB/run2", "drive2"),
+                                                               ("projA", "drive1"),
+                                                               (None, "drive1"),
+                                                               (None, None),
+                                                               ])
+
+    def test_prefix_sibling_rejected(self):
+        """Test that a directory next to a drive sharing its prefix is not created."""
+        with self.assertRaises(AllocatorException):
+            self.allocator.make_directory(os.path.join(self.wdir, "drive1x", "projA"))
+        self.assertFalse(os.path.exists(os.path.join(self.wdir, "drive1x")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+# tests/RebalancerTest.py
+
+import unittest
+import shutil
+import time
+import os
+
+from unittest import mock
+from data_allocator.allocator import Allocator
+from data_allocator.rebalancer import Rebalancer
+from data_allocator.exceptions import AllocatorException
+
+class TestRebalancer(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = "wdir"
+        os.makedirs(os.path.join(self.wdir, "drive1"), exist_ok=True)
+        os.makedirs(os.path.join(self.wdir, "drive2"), exist_ok=True)
+        self.allocator = Allocator(config_path=os.path.join("example_config", "config.json"),
+                                   db_path=os.path.join(self.wdir, "test.db"),
+                                   )
+
+        # everything on drive1, which the mocked free space below says is full
+        sizes = {"big": 4000, "medium": 200, "small": 100, "big/nested": 50}
+        for branch, size in sizes.items():
+            path = os.path.join(self.wdir, "drive1", branch)
+            os.makedirs(path, exist_ok=True)
+            self.allocator.storage.record_location(branch, "drive1")
+            with open(os.path.join(path, "data.bin"), "wb") as f:
+                f.write(b"x" * size)
+
+        patcher = mock.patch.object(self.allocator, "check_space", return_value={"drive1": 100, "drive2": 10000})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.allocator.close()
+        shutil.rmtree(self.wdir)
+        return super().tearDown()
+
+    def test_branch_sizes(self):
+        """Test that nested branches on the same drive are not counted twice."""
+        sizes = Rebalancer(self.allocator).branch_sizes()
+        self.assertEqual(sizes["big"], ("drive1", 4000))
+        self.assertEqual(sizes["big/nested"], ("drive1", 50))
+
+    def test_plan(self):
+        """Test that the plan narrows the gap to the band."""
+        moves, free_before, free_after = Rebalancer(self.allocator).plan(band=1000)
+        self.assertEqual(moves[0], ("big", "drive1", "drive2", 4000))
+        self.assertEqual(free_before, {"drive1": 100, "drive2": 10000})
+        self.assertLess(abs(free_after["drive2"] - free_after["drive1"]), abs(10000 - 100))
+        self.assertEqual(self.allocator.storage.get_rebalance_moves(), [])
+
+        moves, _, _ = Rebalancer(self.allocator).plan(band=20000)
+        self.assertEqual(moves, [])
+
+    def test_plan_keeps_reservations(self):
+        """Test that planning leaves reservations alone and a dry run writes nothing."""
+        self.allocator.storage.conn.execute('''
+            INSERT INTO reservations VALUES ('medium', 'drive1', 5000, ?);
+        ''', (time.time() + 3600, ))
+        Rebalancer(self.allocator).plan(band=1000, dry_run=True)
+        self.assertEqual(self.allocator.storage.get_reserved_bytes(now=time.time()), {"drive1": 5000})
+        count = self.allocator.storage.conn.execute("SELECT COUNT(*) FROM usage_cache;").fetchone()[0]
+        self.assertEqual(count, 0)
+
+        Rebalancer(self.allocator).plan(band=1000)
+        self.assertEqual(self.allocator.storage.get_reserved_bytes(now=time.time()), {"drive1": 5000})
+
+    def test_execute(self):
+        """Test that a move switches the record and leaves nested branches in place."""
+        rebalancer = Rebalancer(self.allocator)
+        results = list(rebalancer.execute([("big", "drive1", "drive2", 4000)]))
+        self.assertEqual(results, [("big", "drive1", "drive2", 4000, "moved")])
+
+        self.assertEqual(self.allocator.storage.get_drive("big"), "drive2")
+        self.assertEqual(os.path.getsize(os.path.join(self.wdir, "drive2", "big", "data.bin")), 4000)
+        self.assertEqual(os.listdir(os.path.join(self.wdir, "drive1", "big")), ["nested"])
+        self.assertFalse(os.path.exists(os.path.join(self.wdir, "drive2", "big", "nested")))
+        self.assertEqual(self.allocator.storage.get_drive("big/nested"), "drive1")
+        self.assertEqual(rebalancer.pending_moves(), [])
+
+    def test_resume(self):
+        """Test that a move interrupted by a failed verification is finished by resume."""
+        rebalancer = Rebalancer(self.allocator)
+        with mock.patch("data_allocator.rebalancer.compare_trees", return_value=["data.bin"]) as compare:
+            with self.assertRaises(AllocatorException):
+                list(rebalancer.execute([("small", "drive1", "drive2", 100)]))
+        # the copy is verified by SHA-256 unless asked otherwise
+        self.assertTrue(compare.call_args.kwargs["checksum"])
+
+        self.assertEqual(self.allocator.storage.get_drive("small"), "drive1")
+        self.assertEqual(rebalancer.pending_moves(), [("small", "drive1", "drive2", 100, "pending")])
+
+        self.assertEqual([result[-1] for result in rebalancer.resume()], ["moved"])
+        self.assertEqual(self.allocator.storage.get_drive("small"), "drive2")
+        self.assertFalse(os.path.exists(os.path.join(self.wdir, "drive1", "small")))
+
+    def test_resume_skips_deleted_branch(self):
+        """Test that a planned move of a branch deleted since is dropped."""
+        self.allocator.storage.put_rebalance_moves([("medium", "drive1", "drive2", 200)])
+        self.allocator.delete_branch("medium")
+
+        rebalancer = Rebalancer(self.allocator)
+        self.assertEqual([result[-1] for result in rebalancer.resume()], ["skipped"])
+        self.assertEqual(rebalancer.pending_moves(), [])
+
+    def test_resume_removes_partial_copy(self):
+        """Test that a dropped move removes its copy but not the branches recorded on the target."""
+        rebalancer = Rebalancer(self.allocator)
+        with mock.patch("data_allocator.rebalancer.compare_trees", return_value=["data.bin"]):
+            with self.assertRaises(AllocatorException):
+                list(rebalancer.execute([("big", "drive1", "drive2", 4000)]))
+        self.assertTrue(os.path.isfile(os.path.join(self.wdir, "drive2", "big", "data.bin")))
+
+        # big is dropped, and a branch is placed below it on the target meanwhile
+        self.allocator.storage.delete_location("big")
+        os.makedirs(os.path.join(self.wdir, "drive2", "big", "run2"))
+        self.allocator.storage.record_location("big/run2", "drive2")
+
+        self.assertEqual([result[-1] for result in rebalancer.resume()], ["skipped"])
+        self.assertEqual(os.listdir(os.path.join(self.wdir, "drive2", "big")), ["run2"])
+        self.assertEqual(rebalancer.pending_moves(), [])
+
+if __name__ == "__main__":
+    unittest.main()
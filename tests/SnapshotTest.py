@@ -0,0 +1,76 @@
+# tests/SnapshotTest.py
+
+import unittest
+import shutil
+import os
+
+from data_allocator.allocator import Allocator
+from data_allocator.storage_manager import StorageManager
+from data_allocator.snapshot import BranchSnapshot, write_snapshot
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = "wdir"
+        os.makedirs(os.path.join(self.wdir, "drive1"), exist_ok=True)
+        os.makedirs(os.path.join(self.wdir, "drive2"), exist_ok=True)
+        self.db_path = os.path.join(self.wdir, "test.db")
+        self.snapshot_path = os.path.join(self.wdir, "branches.snapshot")
+        self.storage = StorageManager(self.db_path)
+        self.storage.record_locations([("projA", "drive1"),
+                                       ("projA/run1", "drive2"),
+                                       ("projA-b", "drive2"),
+                                       ("projé", "drive1"),
+                                       ] + [("bulk/b{}".format(i), "drive2") for i in range(1000)])
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.wdir)
+        return super().tearDown()
+
+    def test_lookup(self):
+        """Test that every record is found and unknown names are not."""
+        self.assertEqual(write_snapshot(self.storage, self.snapshot_path), 1004)
+        with BranchSnapshot.open(self.snapshot_path) as snapshot:
+            self.assertTrue(snapshot.is_fresh(self.db_path))
+            for branch_path, drive_name in self.storage.iter_locations():
+                self.assertEqual(snapshot.get_drive(branch_path), drive_name)
+            for branch_path in ("", "proj", "projA/", "projA/run", "zzz"):
+                self.assertIsNone(snapshot.get_drive(branch_path))
+
+    def test_stale(self):
+        """Test that a commit makes the snapshot stale, and a reopened database does not."""
+        write_snapshot(self.storage, self.snapshot_path)
+        self.storage.close()
+        with StorageManager(self.db_path) as storage:
+            storage.get_drive("projA")
+
+        with BranchSnapshot.open(self.snapshot_path) as snapshot:
+            self.assertTrue(snapshot.is_fresh(self.db_path))
+            self.storage = StorageManager(self.db_path)
+            self.storage.delete_location("projA")
+            self.assertFalse(snapshot.is_fresh(self.db_path))
+
+    def test_invalid(self):
+        """Test that a missing or foreign file is not opened."""
+        self.assertIsNone(BranchSnapshot.open(self.snapshot_path))
+        with open(self.snapshot_path, "wb") as f:
+            f.write(b"not a snapshot" * 10)
+        self.assertIsNone(BranchSnapshot.open(self.snapshot_path))
+
+    def test_allocator_fallback(self):
+        """Test that the Allocator uses the database for branches missing from a stale snapshot."""
+        write_snapshot(self.storage, self.snapshot_path)
+        with Allocator(config_path=os.path.join("example_config", "config.json"),
+                       db_path=self.db_path,
+                       snapshot_path=self.snapshot_path,
+                       ) as allocator:
+            self.assertTrue(allocator.get_path("projA/run1").endswith(os.path.join("drive2", "projA", "run1")))
+            allocator.allocate("projB")
+            self.assertIn("projB", allocator.get_path("projB"))
+            paths = allocator.get_paths(["projB", "nope", "projA"])
+            self.assertIsNone(paths[1])
+            self.assertTrue(paths[0].endswith("projB"))
+
+if __name__ == "__main__":
+    unittest.main()
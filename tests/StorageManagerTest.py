@@ -1,8 +1,10 @@
 # tests/StorageManagerTest.py
 
 import unittest
+import sqlite3
 import os
 from data_allocator.storage_manager import StorageManager
+from data_allocator.exceptions import StorageManagerException
 
 class TestStorageManager(unittest.TestCase):
     @classmethod
@@ -11,6 +13,7 @@ class TestStorageManager(unittest.TestCase):
         Setup a temporary database for testing.
         """
         cls.db_path = "wdir/test.db"
+        os.makedirs("wdir", exist_ok=True)
         cls.storage = StorageManager(db_path=cls.db_path)
 
     @classmethod
@@ -18,6 +21,7 @@ class TestStorageManager(unittest.TestCase):
         """
         Clean up by removing the test database.
         """
+        cls.storage.close()
         if os.path.exists(cls.db_path):
             os.remove(cls.db_path)
 
@@ -46,5 +50,111 @@ class TestStorageManager(unittest.TestCase):
         location = self.storage.get_drive("test_delete")
         self.assertIsNone(location)
 
+    def test_locations_under(self):
+        """
+        Test prefix and depth limited subtree queries.
+        """
+        for branch in ["projA", "projA/run1", "projA/run1/x", "projA-2/run1", "projB/deep/er/run"]:
+            self.storage.record_location(branch, "drive1")
+
+        under = self.storage.get_locations2drive_under("projA")
+        self.assertEqual(sorted(under), ["projA/run1", "projA/run1/x"])
+
+        under = self.storage.get_locations2drive_under("projA", max_depth=1)
+        self.assertEqual(sorted(under), ["projA/run1"])
+
+        under = self.storage.get_locations2drive_under("", max_depth=1)
+        self.assertEqual(sorted(under), ["projA"])
+        self.assertEqual(len(self.storage.get_locations2drive_under("")), 5)
+
+    def test_rename_locations_under(self):
+        """
+        Test that a prefix rename updates parents and depths, and keeps siblings.
+        """
+        for branch in ["projA", "projA/run1", "projA/run1/x", "projA-2"]:
+            self.storage.record_location(branch, "drive1")
+
+        self.assertEqual(self.storage.rename_locations_under("projA", "lab/projB"), 3)
+        rows = self.storage.conn.execute('''
+            SELECT branch_path, parent_path, depth FROM data_location ORDER BY branch_path;
+        ''').fetchall()
+        self.assertEqual(rows, [("lab/projB", "lab", 2), 
+                                ("lab/projB/run1", "lab/projB", 3), 
+                                ("lab/projB/run1/x", "lab/projB/run1", 4), 
+                                ("projA-2", "", 1), 
+                                ])
+
+        with self.assertRaises(StorageManagerException):
+            self.storage.rename_locations_under("lab/projB", "projA-2")
+        self.assertEqual(self.storage.get_drive("lab/projB"), "drive1")
+
+    def test_branch_prefixes(self):
+        """
+        Test finding ancestors implied by deeper branches.
+        """
+        for branch in ["projA/run1/x", "projA/run1/y", "projA/run2/z", "projA-2/run1", "projB"]:
+            self.storage.record_location(branch, "drive1")
+
+        self.assertEqual(sorted(self.storage.get_branch_prefixes("", 1)), ["projA", "projA-2"])
+        self.assertEqual(self.storage.get_branch_prefixes("projA", 2), ["projA/run1", "projA/run2"])
+        self.assertEqual(self.storage.get_branch_prefixes("projA", 3), [])
+
+    def test_migrate_parent_depth(self):
+        """
+        Test that databases without parent/depth columns are upgraded.
+        """
+        self.storage.close()
+        os.remove(self.db_path)
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("CREATE TABLE data_location (branch_path TEXT PRIMARY KEY, drive_name TEXT);")
+            conn.execute("INSERT INTO data_location VALUES ('old/branch', 'drive1');")
+        conn.close()
+
+        type(self).storage = StorageManager(db_path=self.db_path)
+        row = self.storage.conn.execute('''
+            SELECT parent_path, depth FROM data_location WHERE branch_path = 'old/branch';
+        ''').fetchone()
+        self.assertEqual(row, ("old", 2))
+
+    def test_open_while_writing(self):
+        """
+        Test that an up-to-date database opens and reads while another connection holds the write lock.
+        """
+        self.storage.record_location("test_busy", "drive1")
+        writer = sqlite3.connect(self.db_path, isolation_level=None)
+        writer.execute("BEGIN IMMEDIATE;")
+        try:
+            with StorageManager(db_path=self.db_path, busy_timeout=0.1) as storage:
+                self.assertEqual(storage.get_drive("test_busy"), "drive1")
+        finally:
+            writer.execute("ROLLBACK;")
+            writer.close()
+
+    def test_connection_reused(self):
+        """
+        Test that consecutive calls share one connection.
+        """
+        conn = self.storage.conn
+        self.storage.record_location("test_reuse", "drive1")
+        self.storage.get_drive("test_reuse")
+        self.assertIs(conn, self.storage.conn)
+
+    def test_close(self):
+        """
+        Test the close()/context-manager lifecycle.
+        """
+        with StorageManager(db_path=self.db_path) as storage:
+            storage.record_location("test_close", "drive2")
+            self.assertEqual(storage.get_drive("test_close"), "drive2")
+
+        with self.assertRaises(StorageManagerException):
+            storage.get_drive("test_close")
+
+        # closing twice is a no-op
+        storage.close()
+
+        # data written before close is visible to a new connection
+        self.assertEqual(self.storage.get_drive("test_close"), "drive2")
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,103 @@
+# tests/TransferTest.py
+
+import unittest
+import shutil
+import time
+import os
+
+from data_allocator.transfer import RateLimiter, STAGING_PREFIX, copy_tree, compare_trees, remove_tree
+from data_allocator.exceptions import AllocatorException
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.src = "wdir/test_transfer/src"
+        self.dst = "wdir/test_transfer/dst"
+        os.makedirs(os.path.join(self.src, "a", "b"), exist_ok=True)
+        os.makedirs(os.path.join(self.src, "nested", "inner"), exist_ok=True)
+
+        self.files = {"root.txt": b"x" * 10,
+                      os.path.join("a", "a.txt"): b"x" * 100,
+                      os.path.join("a", "b", "b.txt"): b"x" * 1000,
+                      os.path.join("nested", "inner", "n.txt"): b"x" * 5,
+                      }
+        for rel_path, content in self.files.items():
+            with open(os.path.join(self.src, rel_path), "wb") as f:
+                f.write(content)
+        os.symlink("root.txt", os.path.join(self.src, "link"))
+
+    def tearDown(self):
+        shutil.rmtree("wdir/test_transfer")
+        return super().tearDown()
+
+    def test_copy_tree(self):
+        """Test that a copy matches and a second copy skips everything."""
+        result = copy_tree(self.src, self.dst, workers=4)
+        self.assertEqual(result.files_copied, 5)
+        self.assertEqual(result.bytes_copied, 1115)
+        self.assertEqual(compare_trees(self.src, self.dst, checksum=True), [])
+        self.assertEqual(os.readlink(os.path.join(self.dst, "link")), "root.txt")
+
+        result = copy_tree(self.src, self.dst)
+        self.assertEqual(result.files_copied, 0)
+        self.assertEqual(result.files_skipped, 5)
+
+    def test_copy_tree_exclude(self):
+        """Test that excluded directories are not copied."""
+        copy_tree(self.src, self.dst, exclude={"nested/inner"})
+        self.assertTrue(os.path.isdir(os.path.join(self.dst, "nested")))
+        self.assertFalse(os.path.exists(os.path.join(self.dst, "nested", "inner")))
+        self.assertEqual(compare_trees(self.src, self.dst, exclude={"nested/inner"}), [])
+
+    def test_copy_tree_part_names(self):
+        """Test that files named like temporary copies are copied and verified, and no staging is left."""
+        for name in ("root.txt.part", ".root.txt.part-1", STAGING_PREFIX + "0123456789abcdef"):
+            with open(os.path.join(self.src, name), "wb") as f:
+                f.write(b"y" * 3)
+
+        copy_tree(self.src, self.dst, workers=4)
+        with open(os.path.join(self.dst, "root.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"x" * 10)
+        for name in ("root.txt.part", ".root.txt.part-1", STAGING_PREFIX + "0123456789abcdef"):
+            with open(os.path.join(self.dst, name), "rb") as f:
+                self.assertEqual(f.read(), b"y" * 3)
+        self.assertEqual(compare_trees(self.src, self.dst, checksum=True), [])
+
+        os.remove(os.path.join(self.dst, ".root.txt.part-1"))
+        self.assertEqual(compare_trees(self.src, self.dst), [".root.txt.part-1"])
+        copy_tree(self.src, self.dst, workers=4)
+        self.assertEqual(sorted(os.listdir(self.dst)), sorted(os.listdir(self.src)))
+
+    def test_copy_tree_missing_source(self):
+        """Test that a missing source raises."""
+        with self.assertRaises(AllocatorException):
+            copy_tree(os.path.join(self.src, "missing"), self.dst)
+
+    def test_compare_trees(self):
+        """Test that missing and changed files are reported."""
+        copy_tree(self.src, self.dst)
+        os.remove(os.path.join(self.dst, "root.txt"))
+        with open(os.path.join(self.dst, "a", "a.txt"), "wb") as f:
+            f.write(b"y" * 100)
+
+        self.assertEqual(compare_trees(self.src, self.dst), ["root.txt"])
+        self.assertEqual(compare_trees(self.src, self.dst, checksum=True), ["a/a.txt", "root.txt"])
+
+    def test_remove_tree_exclude(self):
+        """Test that excluded directories and the directories above them are kept."""
+        remove_tree(self.src, exclude={"nested/inner"})
+        self.assertEqual(os.listdir(self.src), ["nested"])
+        self.assertEqual(os.listdir(os.path.join(self.src, "nested", "inner")), ["n.txt"])
+
+    def test_rate_limiter(self):
+        """Test that the limiter sleeps off what exceeds the rate."""
+        rate = 10 * 1024 * 1024
+        limiter = RateLimiter(rate)
+        limiter.consume(rate)
+
+        start = time.monotonic()
+        limiter.consume(rate // 5)
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -26,6 +26,7 @@ class TestTreeVisualizer(unittest.TestCase):
         self.storage.record_location("ProjectB/SubB2/Sub.1", "drive2")
 
     def tearDown(self):
+        self.storage.close()
         shutil.rmtree(self.test_path)
         return super().tearDown()
 
@@ -73,6 +74,39 @@ class TestTreeVisualizer(unittest.TestCase):
                           "    Sub.1\n"
         self.assertEqual(self.visualizer.tree2str(tree, short_tree=True).strip(), expected_output.strip())
 
+    def test_max_depth(self):
+        """Test that build_tree stops at max_depth but keeps implied nodes."""
+        tree = self.visualizer.build_tree(max_depth=1)
+        self.assertEqual(sorted(path for path, _, _ in tree.walk()), ["", "ProjectA", "ProjectB"])
+
+        tree = self.visualizer.build_tree(root_branch="ProjectB", max_depth=1)
+        self.assertEqual(sorted(path for path, _, _ in tree.walk()), ["ProjectB", "ProjectB/SubB1", "ProjectB/SubB2"])
+
+        tree = self.visualizer.build_tree(root_branch="ProjectB", max_depth=0)
+        self.assertEqual([path for path, _, _ in tree.walk()], ["ProjectB"])
+
+    def test_as_networkx(self):
+        """Test that the DiGraph form renders the same as the BranchTree."""
+        tree = self.visualizer.build_tree()
+        graph = self.visualizer.build_tree(as_networkx=True)
+
+        self.assertIsInstance(graph, nx.DiGraph)
+        self.assertTrue(graph.has_edge("ProjectB/SubB1", "ProjectB/SubB1/Sub.1"))
+        self.assertEqual(self.visualizer.tree2str(graph), self.visualizer.tree2str(tree))
+        self.assertEqual(self.visualizer.tree2str(graph, short_tree=True),
+                         self.visualizer.tree2str(tree, short_tree=True))
+
+    def test_deep_tree(self):
+        """Test that very deep trees render without recursion errors."""
+        depth = 5000
+        nodes = ["/".join(["d"] * (i + 1)) for i in range(depth)]
+        tree = nx.DiGraph()
+        tree.add_edges_from(zip(nodes[:-1], nodes[1:]))
+
+        lines = self.visualizer.tree2str(tree, short_tree=True).splitlines()
+        self.assertEqual(len(lines), depth)
+        self.assertEqual(lines[-1], "    " * (depth - 1) + "d")
+
     def test_multiple_roots_exception(self):
         """Test that trees with multiple roots raise an exception."""
         tree = nx.DiGraph()
@@ -0,0 +1,88 @@
+# tests/UsageReportTest.py
+
+import unittest
+import shutil
+import json
+import os
+
+from data_allocator.allocator import Allocator
+from data_allocator.usage_report import UsageReport
+
+class TestUsageReport(unittest.TestCase):
+
+    def setUp(self):
+        self.wdir = "wdir"
+        os.makedirs(os.path.join(self.wdir, "drive1"), exist_ok=True)
+        os.makedirs(os.path.join(self.wdir, "drive2"), exist_ok=True)
+        self.allocator = Allocator(config_path=os.path.join("example_config", "config.json"),
+                                   db_path=os.path.join(self.wdir, "test.db"),
+                                   )
+
+        # place the branches explicitly so the test does not depend on free space
+        sizes = {"projA": 10, "projA/run1": 100, "projA/run1/deep": 1000, "projB/run1": 7}
+        drives = {"projA": "drive1", "projA/run1": "drive2", "projA/run1/deep": "drive2", "projB/run1": "drive1"}
+        for branch, drive in drives.items():
+            path = os.path.join(self.wdir, drive, branch)
+            os.makedirs(path, exist_ok=True)
+            self.allocator.storage.record_location(branch, drive)
+            with open(os.path.join(path, "data.bin"), "wb") as f:
+                f.write(b"x" * sizes[branch])
+
+        # a file outside any branch
+        with open(os.path.join(self.wdir, "drive1", "loose.bin"), "wb") as f:
+            f.write(b"x" * 3)
+
+    def tearDown(self):
+        self.allocator.close()
+        shutil.rmtree(self.wdir)
+        return super().tearDown()
+
+    def test_rollup(self):
+        """Test that files go to the deepest branch and totals roll up."""
+        report = UsageReport(self.allocator, use_cache=False).build()
+
+        self.assertEqual(report.own["projA"][0], 10)
+        self.assertEqual(report.own["projA/run1"][0], 100)
+        self.assertEqual(report.own["projA/run1/deep"][0], 1000)
+        self.assertEqual(report.own[""][0], 3)
+
+        self.assertEqual(report.size("projA"), 1110)
+        self.assertEqual(report.size("projA/run1"), 1100)
+        self.assertEqual(report.size("projB"), 7)
+        self.assertEqual(report.size(""), 1120)
+
+    def test_root_branch(self):
+        """Test a report restricted to a subtree."""
+        report = UsageReport(self.allocator, use_cache=True).build(root_branch="projA/run1")
+        self.assertEqual(report.size("projA/run1"), 1100)
+        self.assertEqual(report.size("projA/run1/deep"), 1000)
+
+    def test_skips_deleted(self):
+        """Test that the trash and branches being deleted are not counted."""
+        for rel_path in [os.path.join(".allocator_trash", "123-1-old"), os.path.join("projA", ".run9.deleted-1-2")]:
+            path = os.path.join(self.wdir, "drive1", rel_path)
+            os.makedirs(path)
+            with open(os.path.join(path, "data.bin"), "wb") as f:
+                f.write(b"x" * 500)
+
+        for use_cache in [False, True]:
+            report = UsageReport(self.allocator, use_cache=use_cache).build()
+            self.assertEqual(report.own["projA"][0], 10)
+            self.assertEqual(report.own[""][0], 3)
+            self.assertEqual(report.size(""), 1120)
+
+    def test_output(self):
+        """Test the annotated tree and the JSON records."""
+        report = UsageReport(self.allocator).build()
+
+        lines = report.tree2str(short_tree=True).splitlines()
+        self.assertIn("    projA  [1110]", lines)
+        self.assertIn("            deep  [1000]", lines)
+
+        records = json.loads(json.dumps(report.to_records()))
+        self.assertEqual(records[0]["branch"], "")
+        self.assertEqual(records[1]["branch"], "projA")
+        self.assertEqual(records[1]["drive"], "drive1")
+
+if __name__ == "__main__":
+    unittest.main()